@@ -0,0 +1,81 @@
+'''
+Benchmark of the bytes read from the DB by the bidding and winner paths, which leave the deferred AuctionItems
+description columns out. Lots are given descriptions at the 10,000/15,000 character column limits, and the bytes
+of every row value returned by the DB are totted up per call. For comparison, the cost of loading one whole lot
+row, descriptions included, is shown as well.
+
+    python bench/descriptions.py [purchases]
+
+Runs on the scratch SQLite DB from tests/support.py unless NEORAFFLE_TEST_DB is set, and only measures SQLite
+connections, whose rows are counted through the sqlite3 row factory.
+'''
+import logging, os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tests import support
+from sqlalchemy import event
+from sqlalchemy.orm import undefer_group
+from classes import neoraffle as module
+
+fetched = [0]
+
+
+def countRow(cursor, row):
+    fetched[0] += sum(len(value) if isinstance(value, basestring) else 8 for value in row if value is not None)
+    return row
+
+
+def countRows(dbapi_connection, connection_record):
+    dbapi_connection.row_factory = countRow
+
+
+def measure(call):
+    fetched[0] = 0
+    call()
+
+    return fetched[0]
+
+
+def loadWholeLot(lot):
+    session = module.Session()
+
+    try:
+        session.query(module.AuctionItems).options(undefer_group('descriptions')).filter(module.AuctionItems.iid == lot).one()
+    finally:
+        session.close()
+
+
+def main():
+    logging.basicConfig(level="WARNING")
+    purchases = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    lots = 20
+
+    event.listen(module.sqlengine, "connect", countRows)
+    module.sqlengine.dispose()
+
+    raffle = support.resetDatabase()
+    support.registerUsers(raffle, range(1, 12))
+
+    for i in xrange(lots):
+        raffle.addItemToDatabase(1, "Lot {0}".format(i), "d" * 10000, "1", "2", 1 if i % 2 else 2, htmldescription="h" * 15000)
+
+    def buy():
+        for i in xrange(purchases):
+            lot = 1 + i % lots
+
+            if lot % 2:
+                raffle.makePurchase('auction', 2 + i % 10, lot, bid=str(10 + i))
+            else:
+                raffle.makePurchases(2 + i % 10, [('raffle', lot, '1')])
+
+    print "{0:<34} {1:9.0f} bytes".format("per purchase", measure(buy) / float(purchases))
+    print "{0:<34} {1:9} bytes".format("whole lot row, for comparison", measure(lambda: loadWholeLot(1)))
+    print "{0:<34} {1:9} bytes".format("pickWinners ({0} lots)".format(lots), measure(lambda: raffle.pickWinners("seed")))
+    print "{0:<34} {1:9} bytes".format("fetchWinners", measure(raffle.fetchWinners))
+    print "{0:<34} {1:9} bytes".format("fetchItems", measure(raffle.fetchItems))
+    print "{0:<34} {1:9} bytes".format("fetchItems(descriptions=True)", measure(lambda: raffle.fetchItems(descriptions=True)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+'''
+Benchmark of the winner drawing engine (classes/neoraffledraw.py) on a synthetic raffle held in memory, against the
+list based draw pickWinners used to make: shuffle the lot's tickets, sample one, then filter out the winner's other
+tickets and shuffle again for every winner.
+
+    python bench/draw.py [lots] [tickets] [winners per lot] [processes]
+
+The list based draw is only timed on the first 10 lots, as it is far slower; its time is scaled up to all lots.
+'''
+import os, random, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tests import support # Makes the classes package importable.
+from classes.neoraffledraw import groupTickets, drawLots
+
+
+def listDraw(tickets, quantity):
+    tickets = list(tickets)
+    random.shuffle(tickets)
+    winners = []
+
+    for _ in xrange(quantity):
+        if not tickets:
+            break
+
+        buyer = random.sample(tickets, 1)[0][0]
+        winners.append(buyer)
+        tickets = [ticket for ticket in tickets if not ticket[0] == buyer]
+        random.shuffle(tickets)
+
+    return winners
+
+
+def main():
+    args = [int(arg) for arg in sys.argv[1:]]
+    lots, tickets, quantity, processes = (args + [500, 1000000, 10, 0][len(args):])[:4]
+    rng = random.Random(1)
+
+    # Tickets are bought in purchases of 1 to 20 by 5,000 buyers, numbered in purchase order:
+    rows, tid = dict((lot, []) for lot in xrange(lots)), 1
+    while tid <= tickets:
+        count = rng.randint(1, 20)
+        rows[rng.randrange(lots)].append((rng.randrange(5000), tid, count))
+        tid += count
+
+    start = time.time()
+    holdings = dict((lot, groupTickets(lotrows)) for lot, lotrows in rows.iteritems())
+    grouped = time.time()
+    drawLots([(lot, holdings[lot], quantity, "seed") for lot in xrange(lots)], processes)
+    drawn = time.time()
+
+    sample = range(min(lots, 10))
+    singles = dict((lot, [(buyer, first + i) for buyer, first, count in rows[lot] for i in xrange(count)]) for lot in sample)
+    start2 = time.time()
+    for lot in sample:
+        listDraw(singles[lot], quantity)
+    listtime = (time.time() - start2) * lots / len(sample)
+
+    print "{0} lots, {1} tickets, {2} winners per lot:".format(lots, tid - 1, quantity)
+    print "  group tickets  {0:8.2f}s".format(grouped - start)
+    print "  fenwick draw   {0:8.2f}s ({1} processes)".format(drawn - grouped, processes)
+    print "  list draw      {0:8.2f}s (estimated from {1} lots)".format(listtime, len(sample))
+
+
+if __name__ == "__main__":
+    main()
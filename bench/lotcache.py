@@ -0,0 +1,46 @@
+'''
+Benchmark of single ticket raffle purchases with the lot cache cold (lot row loaded and exclusively locked) and warm
+(lot details re-read under a shared lock). Reports purchases per second and statements sent per purchase.
+
+    python bench/lotcache.py [purchases]
+
+Runs on the scratch SQLite DB from tests/support.py unless NEORAFFLE_TEST_DB is set. SQLite has no row locks, so
+this only shows the per-purchase cost; the gain from buyers of a lot no longer queueing on its row needs MariaDB.
+'''
+import logging, os, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tests import support
+
+
+def run(raffle, purchases):
+    with support.statements() as sql:
+        start = time.time()
+
+        for i in xrange(purchases):
+            raffle.makePurchase('raffle', 2 + i % 19, 1 + i % 50, quantity='1')
+
+        elapsed = time.time() - start
+
+    return purchases / elapsed, float(len(sql)) / purchases
+
+
+def main():
+    logging.basicConfig(level="WARNING")
+    purchases = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+    raffle = support.resetDatabase()
+    support.registerUsers(raffle, range(1, 21))
+
+    for i in xrange(50):
+        raffle.addItemToDatabase(1, "Lot {0}".format(i), "Description", "1", "2", 1)
+
+    print "cold {0:6.0f} purchases/s  {1:.1f} statements/purchase".format(*run(raffle, purchases))
+    raffle.warmLotCache()
+    print "warm {0:6.0f} purchases/s  {1:.1f} statements/purchase".format(*run(raffle, purchases))
+    print "lot cache", raffle.getCacheStats()['lots']
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+'''
+Benchmark of the DB connection pool (DBPOOL setting): purchase posts made with a connection per session ('null')
+against a pool of reused connections ('queue'). Reports posts per second and the DB connections opened.
+
+    python bench/pool.py [posts]
+
+Runs on the scratch SQLite DB from tests/support.py unless NEORAFFLE_TEST_DB is set. SQLite connections are cheap
+to open, so the gain against a networked MariaDB server is larger than shown here.
+'''
+import logging, os, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tests import support
+from sqlalchemy import event
+from classes import neoraffle as module
+
+
+def run(pool, posts):
+    module.dbsettings['DBPOOL'] = pool
+    engine = module.createSqlEngine(module.settings['CONNECTIONSTRING'])
+    connections = []
+    event.listen(engine, "connect", lambda dbapi_connection, connection_record: connections.append(1))
+    module.Session.configure(bind=engine)
+
+    raffle = module.neoraffle(initilize=False)
+    start = time.time()
+
+    for i in xrange(posts):
+        raffle.makePurchases(2 + i % 10, [('raffle', 1 + i % 20, '1'), ('raffle', 1 + (i + 7) % 20, '1')])
+
+    elapsed = time.time() - start
+    engine.dispose()
+
+    return posts / elapsed, len(connections)
+
+
+def main():
+    logging.basicConfig(level="WARNING")
+    posts = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+
+    raffle = support.resetDatabase()
+    support.registerUsers(raffle, range(1, 12))
+
+    for i in xrange(20):
+        raffle.addItemToDatabase(1, "Lot {0}".format(i), "Description", "1", "1", 1)
+
+    for pool in ('null', 'queue'):
+        rate, connections = run(pool, posts)
+        print "DBPOOL={0:<6} {1:7.0f} posts/s  {2:5} connections opened for {3} posts".format(pool, rate, connections, posts)
+
+
+if __name__ == "__main__":
+    main()
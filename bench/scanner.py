@@ -0,0 +1,56 @@
+'''
+Benchmark of the plugin's post scanner (scanPost) against the scans processNotification and its handlers used to
+make: six command substring checks, then the form or purchase line regexes over the whole body again.
+
+    python bench/scanner.py [iterations]
+'''
+import os, re, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tests import support
+
+COMMANDS = ["NEORAFFLE REGISTER", "NEORAFFLE ITEM ADD", "NEORAFFLE PURCHASE", "NEORAFFLE BID", "NEORAFFLE BUY", "NEORAFFLE DELETE"]
+RAFFLEFORM = re.compile("\\[b\\]RAFFLE ITEM\\[\\/b\\].+?Quantity:\\s?[^\\n]+\\n?", re.DOTALL)
+RAFFLEITEM = re.compile("\\[b\\](?P<type>RAFFLE) ITEM\\[\\/b\\].+?Item Title:\\s?(?P<title>.+?)\\nItem Description:\\s?(?P<description>.+?)Ticket Price:\\s?(?P<price>.+?)Quantity:\\s?(?P<quantity>[^\\n]+)", re.DOTALL)
+AUCTIONFORM = re.compile("\\[b\\]AUCTION ITEM\\[\\/b\\].+?Quantity:\\s?[^\\n]+\\n?", re.DOTALL)
+AUCTIONITEM = re.compile("\\[b\\](?P<type>AUCTION) ITEM\\[\\/b\\].+?Item Title:\\s?(?P<title>.+?)\\nItem Description:\\s?(?P<description>.+?)Quantity:\\s?(?P<quantity>[^\\n]+)", re.DOTALL)
+BUYLINE = re.compile("(?P<type>Buy):?\\s?#?(?P<item>\\d+?) (?P<quantity>[0-9,]+)", re.IGNORECASE)
+BIDLINE = re.compile("(?P<type>Bid):?\\s?#?(?P<item>\\d+?) (?P<bid>[0-9,]+)", re.IGNORECASE)
+
+
+def oldForms(body):
+    commands = [command for command in COMMANDS if command in body]
+    forms = [RAFFLEITEM.search(form).groupdict() for form in RAFFLEFORM.findall(body)]
+    forms += [AUCTIONITEM.search(form).groupdict() for form in AUCTIONFORM.findall(body)]
+    return commands, forms
+
+
+def oldPurchases(body):
+    commands = [command for command in COMMANDS if command in body]
+    return commands, BUYLINE.findall(body) + BIDLINE.findall(body)
+
+
+def timed(function, body, iterations):
+    start = time.time()
+
+    for _ in xrange(iterations):
+        function(body)
+
+    return (time.time() - start) / iterations * 1000
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    scanPost = support.loadPlugin().scanPost
+
+    forms = "NEORAFFLE ITEM ADD\n" + "".join("[b]RAFFLE ITEM[/b]\nItem Title: Game {0}\nItem Description: {1}\nTicket Price: 10\nQuantity: 2\n\n".format(i, "A boxed game with manual. " * 20) \
+            if i % 2 else "[b]AUCTION ITEM[/b]\nItem Title: Rare {0}\nItem Description: {1}\nQuantity: 1\n\n".format(i, "Signed. " * 40) for i in xrange(50))
+    bids = "NEORAFFLE PURCHASE\nHere are my bids for this year, good luck all!\n" + "".join(("Buy: {0} {1}\n" if i % 2 else "Bid: #{0} {1},000\n").format(i, i + 1) for i in xrange(200))
+
+    for name, body, old in (("50 item forms", forms, oldForms), ("200 purchase lines", bids, oldPurchases)):
+        print "{0:<20} old {1:6.2f} ms/post  scanPost {2:6.2f} ms/post".format(name, timed(old, body, iterations), timed(scanPost, body, iterations))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+'''
+Benchmark of raffle ticket purchases in 'rows' ticket storage. Compares:
+
+    orm      - one TicketPurchases object added and flushed per ticket, as purchases used to be stored.
+    bulk     - one multi-row insert, numbers read back under the user row lock (DBLOCKING on).
+    perrow   - one insert per ticket, numbers taken from each insert (DBLOCKING off). This isn't a bulk insert: without
+               the lock there's no safe way to read back the numbers of a multi-row insert, so it only saves the ORM's
+               per-object overhead.
+
+orm only times the ticket inserts, whereas bulk and perrow time a whole makePurchase call, including the user and lot
+reads and the currency hold. So for a handful of tickets orm looks the cheapest.
+
+    python bench/tickets.py [quantity ...]
+
+Quantities default to 1, 100 and 10,000 tickets. Runs on the scratch SQLite DB from tests/support.py unless
+NEORAFFLE_TEST_DB is set, e.g. to a mysql:// URL to measure against MariaDB, where each insert is a round trip to the
+server and the gap between the bulk and per ticket inserts is wider.
+'''
+import logging, os, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tests import support
+from classes import neoraffle as module
+
+
+def orm(quantity):
+    session = module.Session()
+
+    try:
+        for _ in xrange(quantity):
+            session.add(module.TicketPurchases(ticketbuyer=2, itemid=1))
+            session.flush()
+        session.commit()
+    finally:
+        session.close()
+
+
+def purchase(raffle, locking, quantity):
+    module.dbsettings['DBLOCKING'] = locking
+
+    try:
+        raffle.makePurchase('raffle', 2, 1, quantity=str(quantity))
+    finally:
+        module.dbsettings['DBLOCKING'] = True
+
+
+def timed(function, *args):
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+
+def main():
+    logging.basicConfig(level="WARNING")
+    quantities = [int(arg) for arg in sys.argv[1:]] or [1, 100, 10000]
+
+    raffle = support.resetDatabase()
+    support.registerUsers(raffle, (1, 2))
+    raffle.addItemToDatabase(1, "Lot", "Description", "1", "1", 1)
+
+    for quantity in quantities:
+        print "{0:>6} tickets: orm {1:.3f}s  bulk {2:.3f}s  perrow {3:.3f}s".format(quantity, timed(orm, quantity), \
+              timed(purchase, raffle, True, quantity), timed(purchase, raffle, False, quantity))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+'''
+Module: Async NeoRaffle
+License: Released under WTFPL <http://www.wtfpl.net/txt/copying/>
+
+===========
+Info
+===========
+Non-blocking facade over the NeoRaffle module. Calls are queued onto a pool of worker threads and return straight
+away, so the bot's IRC and notification handlers aren't held up by slow DB queries. Each call accepts optional
+callback and errback keyword arguments which are run on the worker thread with the result or exception.
+
+    raffle = asyncneoraffle()
+    raffle.makePurchase('raffle', userid, lot, quantity='5', callback=announce, errback=complain)
+    raffle.getUserAvailableCurrency(userid).get() # Block for the result when it's needed.
+'''
+import logging
+
+from multiprocessing.pool import ThreadPool
+
+from neoraffle import neoraffle, dbsettings
+
+# Module-level instance of logger:
+log = logging.getLogger(__name__)
+
+# neoraffle methods available through the facade:
+ASYNCMETHODS = ('handleNeoraffleRegistration', 'addItemToDatabase', 'makePurchase', 'makePurchases', 'pickWinners',
+                'fetchWinners', 'verifyDraw', 'isUserRegistered', 'getNumOwnedItems', 'getUserAvailableCurrency',
+                'setUserAvailableCurrency', 'fetchRegisteredUsers', 'getRegistrationStamp', 'fetchItems', 'deleteItem',
+                'editItem', 'fetchTranslations', 'saveTranslations', 'reconcile', 'warmLotCache', 'clearLotCache')
+
+
+class asyncneoraffle:
+    '''Runs neoraffle methods on a pool of worker threads.
+
+    Every method in ASYNCMETHODS takes the same arguments as on neoraffle, plus:
+        [optional] callback - Called with the method's return value when it succeeds.
+        [optional] errback - Called with the exception instance when it fails.
+
+    and returns a multiprocessing AsyncResult whose get() returns the value or re-raises the exception.
+
+    Attributes:
+        raffle - The neoraffle instance calls are made on.'''
+
+    def __init__(self, raffle=None, workers=None):
+        '''Facade constructor.
+
+        Args:
+            [optional] raffle (obj) - neoraffle instance to use. A new one is created if not given.
+            [optional] workers (int) - Number of worker threads. (default: ASYNCWORKERS setting)'''
+
+        self.raffle = raffle if raffle is not None else neoraffle()
+        self.__pool = ThreadPool(int(workers or dbsettings['ASYNCWORKERS']))
+
+    def __getattr__(self, name):
+        if not name in ASYNCMETHODS:
+            raise AttributeError("asyncneoraffle has no method {0}".format(name))
+
+        method = getattr(self.raffle, name)
+
+        def call(*args, **kwargs):
+            callback, errback = kwargs.pop('callback', None), kwargs.pop('errback', None)
+            return self.submit(method, *args, callback=callback, errback=errback, **kwargs)
+
+        return call
+
+    def submit(self, function, *args, **kwargs):
+        '''Run any function on the worker pool, e.g. a plugin handler making several raffle calls.
+
+        Args:
+            function - Callable to run.
+            *args, **kwargs - Arguments for the callable. callback and errback are taken as described above.
+
+        Returns:
+            multiprocessing AsyncResult for the call.'''
+
+        callback, errback = kwargs.pop('callback', None), kwargs.pop('errback', None)
+
+        def run():
+            try:
+                result = function(*args, **kwargs)
+            except Exception as e:
+                if errback is None:
+                    log.exception("Unhandled error in async NeoRaffle call {0}.".format(getattr(function, '__name__', function)))
+                else:
+                    errback(e)
+                raise
+
+            if callback is not None:
+                try:
+                    callback(result)
+                except Exception:
+                    log.exception("Error in callback for async NeoRaffle call {0}.".format(getattr(function, '__name__', function)))
+
+            return result
+
+        return self.__pool.apply_async(run)
+
+    def close(self, wait=True):
+        '''Stop accepting calls and shut the worker pool down.
+
+        Args:
+            [optional] wait (bool) - Block until calls already queued have finished. (default: True)'''
+
+        self.__pool.close()
+
+        if wait:
+            self.__pool.join()
@@ -31,16 +31,24 @@ The raffle module is capable of supporting whichever DBs SQLAlchemy is capable o
 MariaDB <https://mariadb.org/> backend and that is the recommended choice. See help(neoraffle) for further details
 of the available methods.
 '''
-import logging, random
+import logging, random, time, os, binascii, threading
 
-from sqlalchemy import create_engine, ForeignKey
-from sqlalchemy import Column, Date, Integer, String, Table, Boolean
+from collections import namedtuple
+from hashlib import sha256
+
+from functools import wraps
+
+from sqlalchemy import create_engine, event, inspect, ForeignKey
+from sqlalchemy import Column, Date, Integer, String, Table, Boolean, Index
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, backref, sessionmaker
-from sqlalchemy.sql.expression import func
+from sqlalchemy.orm import relationship, backref, sessionmaker, aliased, deferred, undefer_group
+from sqlalchemy.sql.expression import func, select, desc, literal, or_, exists
 from sqlalchemy.orm.exc import NoResultFound#
-from sqlalchemy.pool import NullPool
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import NullPool, QueuePool
+from sqlalchemy.exc import IntegrityError, DisconnectionError, OperationalError
+
+from neoraffledraw import DRAWALGORITHM, groupTickets, drawLots, hashSeed
+from neorafflecache import lrucache
 
 try:
     from salemconfig import settings
@@ -53,9 +61,231 @@ except ImportError:
 # Module-level instance of logger:
 log = logging.getLogger(__name__)
 
-# Some ORM stuff for the DB - let's do some alchemy:
-sqlengine = create_engine("{0}://{1}".format(settings['DBTYPE'], settings['CONNECTIONSTRING']), poolclass=NullPool)
+# DB defaults. These can be overridden in salemconfig settings:
+#    DBPOOL - 'queue' to keep a pool of reusable connections, 'null' to open a fresh connection per session.
+#    DBPOOLSIZE - Number of connections kept open in the pool.
+#    DBPOOLOVERFLOW - Number of extra connections allowed above DBPOOLSIZE under load.
+#    DBPOOLPREPING - Test pooled connections with a lightweight query before handing them out.
+#    DBPOOLRECYCLE - Seconds after which pooled connections are replaced (keep below MariaDB's wait_timeout).
+#    DBLOCKING - Lock the lot and user rows touched by a purchase (SELECT ... FOR UPDATE) for the whole transaction.
+#                Without it, ticket and lot rows are inserted one at a time so that their IDs come from their own insert.
+#    DBRETRIES - Number of attempts made at a purchase transaction which loses a deadlock or lock wait.
+#    TICKETSTORAGE - 'rows' to store one ticketpurchases row per ticket, 'blocks' to store one ticketblocks row per purchase.
+#    DRAWPROCESSES - Number of worker processes the command line draw (python neoraffle.py draw) spreads lots over. 0 draws
+#                    in the calling process. Draws made through the bot always run in the bot's process, see drawLots.
+#    USERCACHESIZE - Number of members whose registration, currency and owned item count are cached. 0 disables the cache.
+#    USERCACHETTL - Seconds a cached member entry is trusted for, bounding staleness from changes made by other processes.
+#    LOTCACHESIZE - Number of lots whose details are cached while the lot cache is warm (bidding phase). 0 disables the cache.
+#    ASYNCWORKERS - Number of worker threads asyncneoraffle runs DB calls on. Keep within the connection pool size.
+#    USERPAGESIZE - Number of usernames fetched per query when listing every registered user.
+#    REPLICACONNECTIONSTRING - Connection string of a read replica for read-only queries. None reads everything from the primary.
+#                              Only MariaDB/MySQL replicas are used, as the replica's lag can't be checked on other DBs.
+#    REPLICAMAXLAG - Seconds the replica may fall behind the primary before reads go back to the primary. Data written
+#                    through this module is also read back from the primary for this long, though only by the process
+#                    which wrote it; other processes may read the older data from the replica meanwhile.
+#    REPLICALAGCHECK - Seconds between checks of how far the replica is behind.
+dbsettings = {
+              'DBPOOL': 'null' if settings['DBTYPE'].startswith('sqlite') else 'queue',
+              'DBPOOLSIZE': 5,
+              'DBPOOLOVERFLOW': 10,
+              'DBPOOLPREPING': True,
+              'DBPOOLRECYCLE': 3600,
+              'DBLOCKING': True,
+              'DBRETRIES': 3,
+              'TICKETSTORAGE': 'rows',
+              'DRAWPROCESSES': 0,
+              'USERCACHESIZE': 1000,
+              'USERCACHETTL': 60,
+              'LOTCACHESIZE': 10000,
+              'ASYNCWORKERS': 4,
+              'USERPAGESIZE': 500,
+              'REPLICACONNECTIONSTRING': None,
+              'REPLICAMAXLAG': 5,
+              'REPLICALAGCHECK': 10,
+}
+dbsettings.update((k, settings[k]) for k in dbsettings if k in settings)
+
+# Member details cache shared by every neoraffle instance in the process, so a change made through one instance
+# is seen by the others straight away:
+usercache = lrucache(int(dbsettings['USERCACHESIZE']), dbsettings['USERCACHETTL'])
+
+# Auction type names mapped to their IDs in the auctiontypes table. The table is seeded from this map and never changes.
+AUCTIONTYPES = {'raffle': 1, 'auction': 2}
+
+# Currency ledger entry types. Every change to a user's currency or held currency is recorded under one of these:
+#    opening - Balance carried over when the ledger was added to an existing DB.
+#    registration - Currency granted on registering.
+#    itembonus - Bonus granted (or taken back) for offering an item.
+#    tickethold - Currency held for raffle tickets.
+#    bidhold - Currency held for an auction bid.
+#    bidrefund - Held currency released when a bid is outbid.
+#    adminadjust - Manual change made by an admin.
+LEDGERTYPES = ('opening', 'registration', 'itembonus', 'tickethold', 'bidhold', 'bidrefund', 'adminadjust')
+
+# Read-only snapshot of the lot details a raffle ticket purchase needs, as held in the lot cache:
+lotinfo = namedtuple('lotinfo', 'iid title price quantity auctiontype offeredby')
+
+# Lot cache shared by every neoraffle instance in the process, so warming it or dropping an edited lot applies to all
+# of them. Purchases only use it while warm is set, see neoraffle.warmLotCache:
+lotcache = lrucache(int(dbsettings['LOTCACHESIZE']))
+_lotcachestate = {'warm':False}
+
+def markupHash(markup):
+    '''Return the hex SHA-256 of a piece of item markup, the key it's stored under in the markuptranslations table.'''
+    return sha256(markup.encode('utf-8') if isinstance(markup, unicode) else markup).hexdigest()
+
+def _pingConnection(dbapi_connection, connection_record, connection_proxy):
+    '''Pool checkout listener which discards connections the DB server has dropped since they were pooled.'''
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("SELECT 1")
+    except:
+        raise DisconnectionError("Pooled DB connection failed ping check.")
+    finally:
+        cursor.close()
+
+def _logConnection(dbapi_connection, connection_record):
+    log.debug("Opened new DB connection.")
+
+def _disableSqliteAutobegin(dbapi_connection, connection_record):
+    # pysqlite only opens a transaction on the first write, which would let the reads of a purchase go stale.
+    dbapi_connection.isolation_level = None
+
+def _beginSqliteImmediate(session, transaction, connection):
+    # SQLite has no row locks, so sessions which write take the DB write lock up front instead of SELECT ... FOR UPDATE.
+    if not transaction.nested:
+        connection.execute("BEGIN IMMEDIATE")
+
+def _beginSqliteDeferred(session, transaction, connection):
+    # Read-only sessions still read from one snapshot, but only take a shared lock so they don't queue behind writers.
+    if not transaction.nested:
+        connection.execute("BEGIN")
+
+def createSqlEngine(connectionstring, primary=True):
+    '''Create an SQLAlchemy engine using the configured DB type and connection pool settings.
+    
+    Args:
+        connectionstring (str) - DB connection string, without the DB type prefix.
+        [optional] primary (bool) - False for a read replica's engine, which isn't written through so doesn't need
+            its SQLite transactions managed for DBLOCKING. (default: True)
+    
+    Returns:
+        SQLAlchemy engine object.'''
+    
+    url = "{0}://{1}".format(settings['DBTYPE'], connectionstring)
+    
+    if dbsettings['DBPOOL'] == 'null':
+        engine = create_engine(url, poolclass=NullPool)
+    else:
+        engine = create_engine(url, poolclass=QueuePool, pool_size=int(dbsettings['DBPOOLSIZE']), \
+                               max_overflow=int(dbsettings['DBPOOLOVERFLOW']), pool_recycle=int(dbsettings['DBPOOLRECYCLE']))
+        
+        if dbsettings['DBPOOLPREPING']:
+            event.listen(engine, "checkout", _pingConnection)
+    
+    event.listen(engine, "connect", _logConnection)
+    
+    if primary and dbsettings['DBLOCKING'] and settings['DBTYPE'].startswith('sqlite'):
+        event.listen(engine, "connect", _disableSqliteAutobegin) # Transactions are begun by the session listeners below.
+    
+    return engine
+
+# MariaDB/MySQL error codes for a deadlock or lock wait timeout. The losing transaction is rolled back and can be retried.
+LOCKCONFLICTCODES = (1205, 1213)
+
+def isLockConflict(e):
+    '''Return True if a DB exception was caused by losing a lock race rather than a genuine failure.'''
+    try:
+        code = e.orig.args[0]
+    except (AttributeError, IndexError):
+        code = None
+    
+    return code in LOCKCONFLICTCODES or "database is locked" in str(e)
+
+def retryOnConflict(method):
+    '''Decorator to re-run a transactional method when it loses a deadlock or lock wait.
+    
+    The decorated method must open and close its own session so that a retry starts a fresh transaction.'''
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        attempts = max(int(dbsettings['DBRETRIES']), 1)
+        
+        for attempt in xrange(1, attempts+1):
+            try:
+                return method(*args, **kwargs)
+            except OperationalError as e:
+                if attempt == attempts or not isLockConflict(e):
+                    raise
+                
+                log.warning("Lock conflict in {0} (attempt {1} of {2}), retrying: {3}".format(method.__name__, attempt, attempts, e))
+                time.sleep(random.uniform(0, 0.05*attempt)) # Back off a little so the retry doesn't collide again.
+    
+    return wrapper
+
+# Some ORM stuff for the DB - let's do some alchemy. Sessions which only read from the primary come from
+# PrimaryReadSession, so that on SQLite they don't take the write lock:
+sqlengine = createSqlEngine(settings['CONNECTIONSTRING'])
 Session = sessionmaker(bind=sqlengine)
+PrimaryReadSession = sessionmaker(bind=sqlengine)
+
+if dbsettings['DBLOCKING'] and settings['DBTYPE'].startswith('sqlite'):
+    event.listen(Session, "after_begin", _beginSqliteImmediate)
+    event.listen(PrimaryReadSession, "after_begin", _beginSqliteDeferred)
+
+# Optional read replica. Read-only methods get their session from neoraffle.__readSession, which only uses the
+# replica while it's within REPLICAMAXLAG of the primary:
+replicaengine = createSqlEngine(dbsettings['REPLICACONNECTIONSTRING'], primary=False) if dbsettings['REPLICACONNECTIONSTRING'] else None
+ReadSession = sessionmaker(bind=replicaengine) if replicaengine is not None else PrimaryReadSession
+
+# Members written to by this process in the last REPLICAMAXLAG seconds, whose reads stay on the primary so they see
+# their own writes:
+recentwriters = lrucache(10000, dbsettings['REPLICAMAXLAG'])
+
+_replicastate = {'lastwrite':0, 'lagchecked':0, 'lag':None, 'unsupported':False}
+_replicalock = threading.Lock()
+
+def _recordWrite(connection):
+    _replicastate['lastwrite'] = time.time()
+
+if replicaengine is not None:
+    event.listen(sqlengine, "commit", _recordWrite)
+
+def replicaLag():
+    '''Return how many seconds the read replica is behind the primary, or None if it isn't known (no replica configured,
+    the replica isn't MariaDB/MySQL, replication stopped or the check failed). The lag is measured at most every
+    REPLICALAGCHECK seconds.'''
+    
+    if replicaengine is None:
+        return None
+    
+    if not replicaengine.dialect.name == 'mysql': # SHOW SLAVE STATUS is MariaDB/MySQL only.
+        with _replicalock:
+            if not _replicastate['unsupported']:
+                _replicastate['unsupported'] = True
+                log.warning("The lag of a {0} read replica can't be checked, reading from the primary.".format(replicaengine.dialect.name))
+        
+        return None
+    
+    with _replicalock:
+        if time.time() - _replicastate['lagchecked'] < dbsettings['REPLICALAGCHECK']:
+            return _replicastate['lag']
+        _replicastate['lagchecked'] = time.time()
+    
+    try:
+        status = replicaengine.execute("SHOW SLAVE STATUS").first()
+        lag = status['Seconds_Behind_Master'] if status is not None else None
+        
+        if lag is None:
+            log.warning("Read replica isn't replicating, reading from the primary.")
+        elif lag > dbsettings['REPLICAMAXLAG']:
+            log.warning("Read replica is {0} seconds behind the primary, reading from the primary.".format(lag))
+    except Exception:
+        log.warning("Unable to check the read replica's lag, reading from the primary.", exc_info=True)
+        lag = None
+    
+    _replicastate['lag'] = lag
+    return lag
+
 Base = declarative_base()
 Base.metadata.bind = sqlengine
 
@@ -66,6 +296,7 @@ class Bids(Base):
     '''This table will store all bids placed to retain bid history on an item.'''
     
     __tablename__ = "bids"
+    __table_args__ = (Index('ix_bids_itemid_amount', 'itemid', 'amount'),)
     
     bid = Column('bidid', Integer, primary_key=True)
     bidderid = Column('bidderid', Integer, ForeignKey('users.uid'))
@@ -89,8 +320,29 @@ class TicketPurchases(Base):
     user = relationship("Users", backref="tickets")
     item = relationship("AuctionItems", backref="tickets")
 
+class TicketBlocks(Base):
+    '''Compact alternative to TicketPurchases storing each purchase as a block of consecutive ticket numbers.
+    
+    Ticket numbers in this table are allocated per lot, so a block covers tickets firsttid to firsttid+numtickets-1
+    of its lot. Used when the TICKETSTORAGE setting is 'blocks'.'''
+    
+    __tablename__ = "ticketblocks"
+    __table_args__ = (Index('ix_ticketblocks_itemid_firsttid', 'itemid', 'firsttid'),)
+    
+    blockid = Column('blockid', Integer, primary_key=True)
+    ticketbuyer = Column('ticketbuyerid', Integer, ForeignKey('users.uid'), nullable=False)
+    itemid = Column('itemid', Integer, ForeignKey('auctionitems.iid', ondelete='CASCADE'), nullable=False)
+    firsttid = Column('firsttid', Integer, nullable=False)
+    numtickets = Column('numtickets', Integer, nullable=False)
+    
+    user = relationship("Users", backref="ticketblocks")
+
 class Users(Base):
-    '''Storage table for registered users with the raffle system and their currency.'''
+    '''Storage table for registered users with the raffle system and their currency.
+    
+    currency and heldcurrency are a running summary of the user's entries in the currencyledger table. namechanges
+    counts the times the username was changed, so neoraffle.getRegistrationStamp() changes with it. Usernames changed
+    through the ORM are counted automatically; anything renaming users with plain SQL should increment it too.'''
     
     __tablename__ = "users"
     
@@ -100,6 +352,32 @@ class Users(Base):
     currency = Column(Integer, nullable=False, default=0)
     heldcurrency = Column(Integer, nullable=False, default=0)
     isactive = Column(Boolean, nullable=False, default=True)
+    namechanges = Column(Integer, nullable=True, default=0)
+
+def _countNameChange(user, username, oldusername, initiator):
+    if inspect(user).has_identity and not username == oldusername:
+        user.namechanges = (user.namechanges or 0) + 1
+
+event.listen(Users.username, "set", _countNameChange)
+
+class CurrencyLedger(Base):
+    '''Append-only history of every change to a user's currency and held currency.
+    
+    Summing a user's entries gives their current balances. itemid isn't a foreign key so that entries outlive
+    deleted lots.'''
+    
+    __tablename__ = "currencyledger"
+    __table_args__ = (Index('ix_currencyledger_uid', 'uid'),)
+    
+    entryid = Column('entryid', Integer, primary_key=True)
+    uid = Column('uid', Integer, ForeignKey('users.uid'), nullable=False)
+    entrydate = Column('entrydate', String(255), nullable=False, default=func.now())
+    entrytype = Column('entrytype', String(16), nullable=False)
+    currencydelta = Column('currencydelta', Integer, nullable=False, default=0)
+    helddelta = Column('helddelta', Integer, nullable=False, default=0)
+    itemid = Column('itemid', Integer, nullable=True)
+    
+    user = relationship("Users", backref="ledger")
 
 class AuctionItems(Base):
     '''Raffle items table.'''
@@ -109,21 +387,38 @@ class AuctionItems(Base):
     iid = Column(Integer, primary_key=True, nullable=False)
     title = Column(String(255), nullable=False)
     htmltitle = Column(String(255), nullable=True)
-    description = Column(String(10000), nullable=False)
-    htmldescription = Column(String(15000), nullable=True)
+    
+    # The descriptions are only needed to show an item, so they're left out of item queries and loaded on first
+    # access. Use undefer_group('descriptions') to fetch them with the item, e.g. for listings.
+    description = deferred(Column(String(10000), nullable=False), group='descriptions')
+    htmldescription = deferred(Column(String(15000), nullable=True), group='descriptions')
+    
     quantity = Column(Integer, nullable=False)
     price = Column(Integer, nullable=True)
     auctiontype = Column(Integer, nullable=False)
     offeredby = Column(Integer, ForeignKey('users.uid'), nullable=False)
     
+    # Current top bid for auction lots, kept in step with the bids table by the bid transaction:
+    topbidamount = Column(Integer, nullable=True)
+    topbidderid = Column(Integer, ForeignKey('users.uid'), nullable=True)
+    
     bids = relationship("Bids", order_by="desc(Bids.amount)")
     ticketbuys = relationship("TicketPurchases")
-    offered = relationship("Users", backref="owneditems")
+    offered = relationship("Users", foreign_keys=[offeredby], backref="owneditems")
+    topbidder = relationship("Users", foreign_keys=[topbidderid])
     
     rafflewinner = relationship("Users", secondary="rafflewinners", passive_deletes=True)
     winningticket = relationship("TicketPurchases", secondary="rafflewinners", passive_deletes=True)
     
-    userauctionitems = relationship("Users", backref="auctionitems")
+    userauctionitems = relationship("Users", foreign_keys=[offeredby], backref="auctionitems")
+    
+class MarkupTranslations(Base):
+    '''Item title and description markup already rendered to HTML, keyed by a hash of the markup (see markupHash).'''
+    
+    __tablename__ = "markuptranslations"
+    
+    markuphash = Column(String(64), primary_key=True)
+    html = Column(String(15000), nullable=False)
     
 class AuctionTypes(Base):
     '''Auction types go here. 1 = Raffle, 2 = Auction.'''
@@ -133,6 +428,18 @@ class AuctionTypes(Base):
     tid = Column(Integer, primary_key=True, nullable=False)
     typename = Column(String(255), nullable=False)
     
+class DrawRuns(Base):
+    '''Record of each winner draw with the seed and algorithm used, so the draw can be audited and replayed.'''
+    
+    __tablename__ = "drawruns"
+    
+    runid = Column(Integer, primary_key=True)
+    rundate = Column(String(255), nullable=False, default=func.now())
+    seed = Column(String(255), nullable=False)
+    seedhash = Column(String(64), nullable=False)
+    algorithm = Column(String(32), nullable=False)
+    ticketstorage = Column(String(16), nullable=False)
+
 # Association table for drawing winners.
 class RaffleWinners(Base):
     __tablename__ = "rafflewinners"
@@ -141,6 +448,8 @@ class RaffleWinners(Base):
     winnerid = Column('winnerid', Integer, ForeignKey('users.uid'))
     lotid = Column('lotid', Integer, ForeignKey('auctionitems.iid', ondelete='CASCADE'))
     ticketid = Column('ticketid', Integer, ForeignKey('ticketpurchases.tid', ondelete='CASCADE'))
+    ticketnum = Column('ticketnum', Integer, nullable=True) # Winning ticket number, for either ticket storage mode.
+    runid = Column('runid', Integer, ForeignKey('drawruns.runid'), nullable=True)
     
     winuser = relationship("Users")
     winitem = relationship("AuctionItems")
@@ -164,11 +473,21 @@ class UserAccountIsInactive(Exception): pass
 #=================================================
 # NeoRaffle main class.
 #=================================================
-class neoraffle:
+class _sessionstate(threading.local):
+    '''Per thread transaction state of a neoraffle instance.'''
+    
+    def __init__(self):
+        self.session = None
+        self.staleusers = set()
+
+class neoraffle(object):
     '''Neoseeker raffle system.
     
     Module to handle the operation of the annual Neoseeker Raffle/Auction system and DB interactions.
     
+    The DB session and pending cache invalidations are kept per thread, so a single instance can be used from
+    several threads at once (see asyncneoraffle).
+    
     Attributes:
         session - DB transaction session for raffle instance.'''
     
@@ -178,6 +497,10 @@ class neoraffle:
         Args:
             [optional] initilize (bool) - Set to False to not run the DB initilization procedure on instantiation.'''
         
+        self.__state = _sessionstate()
+        self.__usercache = usercache
+        self.__lotcache = lotcache
+        
         if initilize:
             self.__initilizeRaffleDatabase()
     
@@ -237,7 +560,9 @@ class neoraffle:
         try:
             self.__session = Session()
             self.__session.add(Users(uid=userid, username=username, currency=availableCurrency['totalpts'], isactive=isactive))
-            self.__session.commit()
+            self.__session.add(CurrencyLedger(uid=userid, entrytype='registration', currencydelta=availableCurrency['totalpts']))
+            self.__markUserStale(userid)
+            self.__commit()
         except:
             log.exception("Fatal error attempting to insert user info into Neo Raffle registering DB.  UserID: {0}".format(userid))
             raise
@@ -270,53 +595,13 @@ class neoraffle:
         try:
             self.__session = Session()
             
-            errItems = []
-            logErr = "Validation error when adding item to DB by user {0}".format(userid)
-            
             # Get user item:
             try:    
                 user = self.__getUserFromMemberId(userid)
             except UserNotRegistered:
                 raise("You must be registered to offer items!")
             
-            # Remove any commas from the price/quantity:
-            try:
-                itemprice = itemprice.replace(',','')
-                itemquantity = itemquantity.replace(',','')
-            except (AttributeError, TypeError):
-                pass # They're null/ints, which is fine and expected anyway.
-            
-            if len(itemtitle) == 0:
-                log.error("{0} - Invalid title!".format(logErr))
-                errItems.append("The title of the submitted form was invalid.")
-            if len(itemdescription) == 0:
-                log.error("{0} - Invalid description!".format(logErr))
-                errItems.append("The description of the submitted form was invalid.")
-                
-            if not itemtype == 2: # Don't validate price field for auctions.
-                try:
-                    itemprice = int(itemprice)
-                    if itemprice <= 0 or itemprice > 10000:
-                        log.error("{0} - price out of bounds.".format(logErr))
-                        errItems.append("The price specified was out of bounds! Must be between 1 and 10,000")
-                except ValueError: # The int cast failed - it's not a number.
-                    log.error("{0} - price was not valid integer.".format(logErr))
-                    errItems.append("Price was not a valid number.")
-            else: # Auctions have no pre-defined price, set it to null for the DB call.
-                itemprice = None
-                
-            try:
-                itemquantity = int(itemquantity)
-                if itemquantity <= 0 or itemquantity > 10:
-                    log.error("{0} - quantity out of bounds.".format(logErr))
-                    errItems.append("The quantity specified was out of bounds! Must be between 1 and 10!")
-            except ValueError:
-                log.error("{0} - Quantity was not valid integer.".format(logErr))
-                errItems.append("Quantity was not a valid number.")
-                
-            if errItems:
-                log.debug("Form from user {0} was rejected due to validation errors: {1}".format(userid, ", ".join(errItems)))
-                raise MultipleValidationErrors(*errItems)
+            itemprice, itemquantity = self.__validateItem(userid, itemtitle, itemdescription, itemprice, itemquantity, itemtype)
     
             # Continue with adding the items if all is ok:
             try:
@@ -328,9 +613,11 @@ class neoraffle:
                     item.htmldescription = htmldescription
         
                 self.__session.add(item)
-                self.__session.commit()
+                self.__markUserStale(user.uid)
+                self.__commit()
                 
                 itemid = item.iid
+                self.__lotcache.invalidate(itemid)
             except:
                 log.exception("Error when writing item to DB!")
                 raise
@@ -340,6 +627,74 @@ class neoraffle:
             self.__session.close()
     
     
+    @retryOnConflict
+    def addItemsToDatabase(self, userid, items, bonuspts=0, maxbonus=0):
+        '''Add several auction/raffle items for one user in a single transaction, crediting any bonus for offering them.
+        
+        Every item is validated first and the valid ones are inserted with one multi-row insert. A bonus of bonuspts
+        is credited for each item which takes the user's number of offered items up to maxbonus.
+        
+        Args:
+            userid (str) - Neoseeker MemberID of user adding the items.
+            items (list) - Dicts with keys title, description, price, quantity, type and optionally htmltitle, htmldescription.
+                           See addItemToDatabase for the values.
+            [optional] bonuspts (int) - Currency credited for each bonus earning item. (default: 0)
+            [optional] maxbonus (int) - Number of offered items per user which earn a bonus. (default: 0)
+        
+        Returns:
+            Dict:
+                {"items" => List of dicts in the order given, each with keys: lot, owneditems, bonus, error.
+                            lot is the new lot number, owneditems the user's number of offered items including this
+                            one, and bonus the currency credited for it. error holds the MultipleValidationErrors
+                            instance when the item failed validation, in which case the other values are None.
+                 "bonus" => Total currency credited.}
+        
+        Exceptions:
+            UserNotRegistered - User adding the items isn't registered with the system.'''
+        
+        try:
+            self.__session = Session()
+            user = self.__getUserFromMemberId(userid, lock=True)
+            
+            # With DBLOCKING the user row is locked, so the count can't change until the new lots are committed:
+            owned = self.__countOwnedItems(user.uid)
+            rtn, rows = [], []
+            
+            for item in items:
+                line = {'lot':None, 'owneditems':None, 'bonus':None, 'error':None}
+                
+                try:
+                    price, quantity = self.__validateItem(userid, item['title'], item['description'], item['price'], item['quantity'], item['type'])
+                    rows.append({'title':item['title'], 'description':item['description'], 'price':price, 'quantity':quantity, 'auctiontype':item['type'], \
+                                 'offeredby':user.uid, 'htmltitle':item.get('htmltitle') or None, 'htmldescription':item.get('htmldescription') or None})
+                except MultipleValidationErrors as e:
+                    line['error'] = e
+                
+                rtn.append(line)
+            
+            if rows:
+                # With DBLOCKING the user row is locked for the transaction, so no one else can be adding lots offered by this user:
+                lots = self.__insertRows(AuctionItems.__table__, rows, self.__session.query(AuctionItems.iid).filter(AuctionItems.offeredby == user.uid))
+                
+                for line in (line for line in rtn if line['error'] is None):
+                    owned += 1
+                    line['lot'], line['owneditems'] = lots.pop(0), owned
+                    line['bonus'] = bonuspts if owned <= maxbonus else 0
+                    
+                    if line['bonus']:
+                        self.__adjustBalance(user, 'itembonus', currency=line['bonus'], itemid=line['lot'])
+                    
+                    self.__lotcache.invalidate(line['lot'])
+            
+            self.__markUserStale(user.uid)
+            self.__commit()
+            
+            return {'items':rtn, 'bonus':sum(line['bonus'] or 0 for line in rtn)}
+        finally:
+            self.__session.close()
+            
+    
+    @retryOnConflict
     def makePurchase(self, purchasetype, userid, itemid, **kwargs):
         '''Interface method to handle purchase requests.
         
@@ -363,63 +718,127 @@ class neoraffle:
             BidDoesNotExceedCurrentTopBid - Bid placed was too low.
             UserAccountIsInactive - User is registered, but their account is set to inactive.
         '''
-        try:    
-            types = {"raffle": self.__buyRaffleTickets, "auction": self.__bidOnItem}
-        
+        try:
             self.__session = Session()
             
+            # Rows are locked lot first, then user, so concurrent purchases on a lot queue up on the lot row. Raffle
+            # lots held in the warm lot cache only take a shared lock:
+            item = self.__getCachedRaffleLots([itemid]).get(self.__lotKey(itemid))
+            
+            if item is None:
+                try:
+                    item = self.__getItemFromLotNumber(itemid, lock=True)
+                except DoesNotExist:
+                    item = None
+            
             try:
-                user = self.__getUserFromMemberId(userid)
+                user = self.__getUserFromMemberId(userid, lock=True)
             except NoResultFound:
                 log.error("User {0} attempting attepting to make a purchase on lot {1} but was not registered!".format(userid, itemid))
                 raise UserNotRegistered("The userid specified ({0}) is not registered with the NeoRaffle system".format(userid))    
         
-            try:
-                item = self.__getItemFromLotNumber(itemid)
-            except DoesNotExist:
+            if item is None:
                 log.error("User {0} attempting to make a purchase on lot {1} but the lot number wasn't found in the DB!".format(userid, itemid))
                 raise DoesNotExist("Lot {0} was not found in the DB!".format(itemid))
             
             if user.isactive is False:
                 raise UserAccountIsInactive("Inactive users cannot make purchases!")
             
-            if user.uid == item.offeredby: # User is attempting to bid on own item!
-                raise UserAttemptToPurchaseOwnItem("You cannot buy tickets or bid for your own item!")
+            rtn = self.__processPurchase(purchasetype, user, item, **kwargs)
+            self.__commit()
             
-            try:
-                auctiontype = self.__session.query(AuctionTypes).filter(AuctionTypes.typename == purchasetype.capitalize()).one()  
-            except NoResultFound:
-                raise ValueError("Invalid purchase type passed to method: {0}!".format(purchasetype))
+            return rtn
+        finally:
+            self.__session.close()
+            
+    
+    @retryOnConflict
+    def makePurchases(self, userid, purchases):
+        '''Process several purchases for one user in a single session and transaction.
+        
+        The user is loaded once and every lot referenced by the batch is fetched with a single query. Failures
+        on individual lines are returned alongside the successful ones rather than aborting the whole batch. Each
+        line runs in its own savepoint, so a failed line is rolled back completely.
+        
+        Args:
+            userid (str) - Neoseeker member ID of user making the purchases.
+            purchases (list) - List of (purchasetype, itemid, amount) tuples. amount is the ticket quantity for
+                               raffle purchases and the bid for auction purchases.
+        
+        Returns:
+            Dict:
+                {"purchases" => List of dicts in the order given, each with keys: type, lot, amount, result, error.
+                                result holds the makePurchase return value on success, error holds the exception
+                                instance when that line failed (see makePurchase for the exceptions raised).
+                 "availablecurrency" => User's remaining currency after the batch.}
+        
+        Exceptions:
+            UserNotRegistered - User making the purchases isn't registered with the system.
+            UserAccountIsInactive - User is registered, but their account is set to inactive.
+        '''
+        lineerrors = (DoesNotExist, ValueError, UserAttemptToPurchaseOwnItem, UserCannotAffordItem, InvalidAuctionType, BidDoesNotExceedCurrentTopBid)
+        amountargs = {"raffle": "quantity", "auction": "bid"}
+        
+        try:
+            self.__session = Session()
             
-            if not auctiontype.tid == item.auctiontype: # User is attempting to make a bid on a raffle item or trying to buy an auction item.
-                raise InvalidAuctionType("Method call invalid - invoked {0} call but the item does not match that lot type.".format(purchasetype))
+            items = self.__getCachedRaffleLots([itemid for _, itemid, _ in purchases])
+            items.update(self.__getItemsFromLotNumbers([itemid for _, itemid, _ in purchases if not self.__lotKey(itemid) in items], lock=True))
+            user = self.__getUserFromMemberId(userid, lock=True)
             
-            try:
-                return types[purchasetype](user, item, **kwargs)
-            except KeyError:
-                raise ValueError("Supported purchase types are: {0}".format(", ".join(types.keys())))
-            except TypeError as e:
-                raise ValueError("Parameters were not expected by underlying method. Args: {0}. Err: {1}".format(", ".join(kwargs), e))
-            except UserCannotAffordItem:
-                raise
-            except BidDoesNotExceedCurrentTopBid:
-                raise
-            except:
-                log.exception("An unknown error occurred when running the purchase routine.")
-                raise
+            if user.isactive is False:
+                raise UserAccountIsInactive("Inactive users cannot make purchases!")
+            
+            rtn = []
+            
+            for purchasetype, itemid, amount in purchases:
+                line = {'type':purchasetype, 'lot':itemid, 'amount':amount, 'result':None, 'error':None}
+                
+                try:
+                    # Each line runs in a savepoint, so a line failing part way through leaves none of its changes behind:
+                    savepoint = self.__session.begin_nested()
+                    
+                    try:
+                        try:
+                            item = items[int(itemid)]
+                        except (KeyError, ValueError):
+                            log.error("User {0} attempting to make a purchase on lot {1} but the lot number wasn't found in the DB!".format(userid, itemid))
+                            raise DoesNotExist("Lot {0} was not found in the DB!".format(itemid))
+                        
+                        line['result'] = self.__processPurchase(purchasetype, user, item, **{amountargs.get(str(purchasetype).lower(), "amount"): amount})
+                        savepoint.commit()
+                    except:
+                        savepoint.rollback()
+                        raise
+                except lineerrors as e:
+                    line['error'] = e
+                
+                rtn.append(line)
+            
+            availcur = (user.currency - user.heldcurrency)
+            self.__commit()
+            
+            return {'purchases':rtn, 'availablecurrency':availcur}
         finally:
             self.__session.close()
             
             
-    def pickWinners(self):
+    def pickWinners(self, seed=None, seedhash=None, processes=0):
         '''Method which will populate the rafflewinners table with n*quatity winners for each raffle item.
         
         The method used to select winners generates n*quantity unique winners for each raffle item in the DB.
         If a user is selected as a winner, their remaining tickets will be removed from subsequent random
         rolls.  For auction items, the winner is simply the highest current bidder at the time.
         
+        Each lot is drawn with its own random generator derived from the run's seed. The seed and algorithm
+        version are stored in the drawruns table so the draw can later be checked with verifyDraw.
+        
         Args:
-            None.
+            [optional] seed (str) - Seed for the draw. A random seed is generated if not given.
+            [optional] seedhash (str) - SHA-256 hex digest of the seed published before the draw. If given, the
+                                        seed must match it.
+            [optional] processes (int) - Worker processes to draw with, see drawLots. Only for single threaded
+                                         programs such as the command line draw. (default: 0)
         
         Returns:
             List of dics containing winner informatinon for each item in the DB:
@@ -431,58 +850,123 @@ class neoraffle:
                      title -> Title of the item.
                      type -> lot type
                      winners -> list of usernames drawn as winners for the lot.
+                     runid -> ID of the draw run.
                  }
                 ]
+        
+        Exceptions:
+            ValueError - Raised if the seed doesn't match the committed seed hash.
         '''
+        if seed is None:
+            seed = binascii.hexlify(os.urandom(16))
+        
+        if seedhash is not None and not hashSeed(seed) == seedhash.lower():
+            raise ValueError("The draw seed does not match the committed seed hash {0}!".format(seedhash))
+        
         try:
             session = Session()
             
-            # Get all items:
-            items = session.query(AuctionItems).all()
-            tickets = []
-            rtn = []
+            # Get the raffle lots and every lot's tickets grouped by buyer as plain rows:
+            lots = session.query(AuctionItems.iid, AuctionItems.quantity).filter(AuctionItems.auctiontype == AUCTIONTYPES['raffle']).order_by(AuctionItems.iid).all()
+            holdings = self.__exportTicketHoldings(session)
+            winrows = []
             
-            # Clear existing winners:
-            session.execute("TRUNCATE TABLE rafflewinners;")     
+            # Clear existing winners and record this run:
+            session.query(RaffleWinners).delete(synchronize_session=False)
             
-            for item in items:
-                winners = []
+            run = DrawRuns(seed=seed, seedhash=hashSeed(seed), algorithm=DRAWALGORITHM, ticketstorage=dbsettings['TICKETSTORAGE'])
+            session.add(run)
+            session.flush()
+            
+            log.info("Drawing winners for run {0} (seed hash: {1}).".format(run.runid, run.seedhash))
+            
+            draws = drawLots([(lotid, holdings[lotid], quantity, seed) for lotid, quantity in lots if lotid in holdings], processes)
+            
+            for lotid, quantity in lots:
+                if not lotid in draws:
+                    log.debug("No tickets purchased for item: {0} when running pick winners routine.".format(lotid))
                 
-                if item.auctiontype==1 and item.ticketbuys:                   
-                    tickets = item.ticketbuys
-                    random.shuffle(tickets) # Shuffle list of tickets first to improve randomness.
-                    
-                    for _ in xrange(item.quantity):
-                        try:
-                            winner = random.sample(tickets,1) # Get one winner.
-                        except ValueError:
-                            break # There's less ticket purchases than there are quantity of items.
-                        log.debug("Winner!! (Quant: {0}, ItemID: {1}) = {2} {3}".format(item.quantity, item.iid, winner[0].tid, winner[0].user.username))
-                        
-                        # Remove user's remaining tickets and shuffle again for next draw to create unique winners:
-                        tickets = [ticket for ticket in tickets if not ticket.user == winner[0].user]
-                        random.shuffle(tickets) # Shuffle the new list again.
-                        
-                        # Add winner to DB:
-                        win = RaffleWinners(winuser=winner[0].user, winitem=item, winticket=winner[0])
-                        session.add(win)
-                        session.commit()
-                        
-                        # Append winner for return:
-                        winners.append(winner[0].user.username)
+                for winnerid, ticketnum in draws.get(lotid, []):
+                    log.debug("Winner!! (Quant: {0}, ItemID: {1}) = {2} {3}".format(quantity, lotid, ticketnum, winnerid))
                     
-                elif item.auctiontype == 2 and item.bids:
-                    # Just append the current top bidder as the winner for auctions:
-                    winners.append(item.bids[0].bidder.username)
-                else:
-                    log.debug("No tickets purchased for item: {0} when running pick winners routine.".format(item.iid))
-                
-                # Add item for return:
-                rtn.append({'lot':item.iid,'from':item.offered.username,'quantity':item.quantity, 'title':item.title,'type':item.auctiontype,'winners':winners})
+                    winrows.append({'winnerid':winnerid, 'lotid':lotid, 'ticketnum':ticketnum, 'runid':run.runid, \
+                                    'ticketid':ticketnum if dbsettings['TICKETSTORAGE'] == 'rows' else None})
+            
+            # Add all winners to the DB in one go:
+            if winrows:
+                session.execute(RaffleWinners.__table__.insert(), winrows)
+            
+            rtn = self.__buildWinnersReport(session, run.runid)
+            session.commit()
                     
             return rtn
         finally:
             session.close()
+    
+    def fetchWinners(self, runid=None):
+        '''Return the winners of a draw run without drawing again, e.g. to repost the winners announcement.
+        
+        Args:
+            [optional] runid (int) - ID of the draw run. Defaults to the most recent run.
+        
+        Returns:
+            See pickWinners.
+        
+        Exceptions:
+            DoesNotExist - Raised if the run isn't found, or its winners have been replaced by a later run.
+        '''
+        session = self.__readSession()
+        
+        try:
+            run = self.__getCurrentDrawRun(session, runid)
+            
+            return self.__buildWinnersReport(session, run.runid)
+        finally:
+            session.close()
+            
+    def verifyDraw(self, runid, processes=0):
+        '''Recompute the raffle winners of a draw run from the stored tickets and compare them to the stored winners.
+        
+        Args:
+            runid (int) - ID of the draw run to verify.
+            [optional] processes (int) - Worker processes to draw with, as per pickWinners. (default: 0)
+        
+        Returns:
+            Dict:
+                {"runid" => ID of the run verified.
+                 "seedhash" => Seed hash of the run.
+                 "verified" => True if every raffle lot's winners and winning tickets match the recomputed draw.
+                 "mismatches" => List of lot numbers whose stored winners differ from the recomputed draw.}
+        
+        Exceptions:
+            DoesNotExist - Raised if the run isn't found, or its winners have been replaced by a later run.
+            ValueError - Raised if the run was made with a different drawing algorithm version.
+        '''
+        try:
+            session = PrimaryReadSession()
+            
+            run = self.__getCurrentDrawRun(session, runid)
+            
+            if not run.algorithm == DRAWALGORITHM:
+                raise ValueError("Draw run {0} used algorithm {1}, which can't be reproduced by this version ({2})!".format(runid, run.algorithm, DRAWALGORITHM))
+            
+            holdings = self.__exportTicketHoldings(session, run.ticketstorage)
+            
+            stored = {}
+            for lotid, winnerid, ticketnum in session.query(RaffleWinners.lotid, RaffleWinners.winnerid, RaffleWinners.ticketnum).filter(RaffleWinners.runid == run.runid).order_by(RaffleWinners.rwid):
+                stored.setdefault(lotid, []).append((winnerid, ticketnum))
+            
+            lots = session.query(AuctionItems.iid, AuctionItems.quantity).filter(AuctionItems.auctiontype == AUCTIONTYPES['raffle']).order_by(AuctionItems.iid).all()
+            draws = drawLots([(lotid, holdings.get(lotid, []), quantity, run.seed) for lotid, quantity in lots], processes)
+            
+            mismatches = [lotid for lotid, _ in lots if not draws[lotid] == stored.get(lotid, [])]
+            
+            if mismatches:
+                log.warning("Draw run {0} failed verification for lots: {1}".format(runid, mismatches))
+            
+            return {'runid':run.runid, 'seedhash':run.seedhash, 'verified':not mismatches, 'mismatches':mismatches}
+        finally:
+            session.close()
             
     def isUserRegistered(self, userid):
         '''Determines if a user has registered with the NeoRaffle system.
@@ -493,18 +977,20 @@ class neoraffle:
         Returns:
             True if user is registered.  False otherwise.'''
         
-        res = False
+        details = self.__usercache.get(self.__userCacheKey(userid))
+        
+        if details is not None:
+            return details['registered']
+        
+        session = self.__readSession(userid)
         
         try:
-            session = Session()
-            res = True if session.query(Users).filter(Users.uid==userid).count() else False
+            return self.__userExists(userid, session)
         except:
             log.exception("Fatal error performing a lookup on the users table.")
             raise
         finally:
-            session.close()        
-
-        return res
+            session.close()
     
     def getNumOwnedItems(self, userid):
         '''Return the number of items a user has put up for raffle/auction.
@@ -512,15 +998,7 @@ class neoraffle:
         Args:
             userid - Neoseeker member ID.
         '''
-        try:
-            self.__session = Session()
-            user = self.__getUserFromMemberId(userid)
-            
-            return int(len(user.owneditems))
-        except UserNotRegistered:
-            raise
-        finally:
-            self.__session.close()
+        return self.__getRegisteredUserDetails(userid)['owneditems']
             
         
     def getUserAvailableCurrency(self, userid):
@@ -535,38 +1013,87 @@ class neoraffle:
         Exceptions:
             UserNotRegistered - Raised if user isn't registered with the system.
         '''
+        details = self.__getRegisteredUserDetails(userid)
+        
+        return (details['currency'] - details['heldcurrency'])
+    
+    def getCacheStats(self):
+        '''Return hit/miss counters for the in-process caches.
+        
+        Returns:
+            Dict:
+                {"users" => Member cache counters. Keys: hits, misses, evictions, size, maxsize.
+                 "lots" => Lot cache counters. Keys as per users.}'''
+        
+        return {'users':self.__usercache.stats(), 'lots':self.__lotcache.stats()}
+    
+    def warmLotCache(self):
+        '''Load every lot's details into the lot cache in one query and start serving raffle purchases from it.
+        
+        Lots are effectively read-only during the bidding phase, so this should be called when bidding opens. Edits
+        and deletions made through this module drop the affected lot from the cache, and every purchase re-reads the
+        lot's details in its own transaction, so a lot changed by another process doesn't sell at its cached price.
+        
+        Returns:
+            (int) Number of lots cached.'''
+        
         try:
-            self.__session = Session()
-            user = self.__getUserFromMemberId(userid)
-            availcur = (user.currency - user.heldcurrency)
-            
-            return availcur
-        except UserNotRegistered:
-            raise
+            session = PrimaryReadSession()
+            rows = session.query(*self.__lotInfoColumns()).all()
         finally:
-            self.__session.close()
+            session.close()
+        
+        self.__lotcache.clear()
+        
+        for row in rows:
+            self.__lotcache.set(row.iid, lotinfo(*row))
+        
+        _lotcachestate['warm'] = True
+        log.info("Lot cache warmed with {0} lots.".format(len(rows)))
+        
+        return len(rows)
+    
+    def clearLotCache(self):
+        '''Empty the lot cache and go back to reading lots from the DB on every purchase.'''
+        _lotcachestate['warm'] = False
+        self.__lotcache.clear()
         
-    def setUserAvailableCurrency(self, userid, newcurrency=None, delta=None):
+    @retryOnConflict
+    def setUserAvailableCurrency(self, userid, newcurrency=None, delta=None, entrytype='adminadjust', itemid=None):
         '''Method to manually adjust a user's currency for providing bonuses for contest winnners, etc.
         
         Args:
             userid - Neoseeker member ID.
             [optional] newcurrency - Value to set currency to. Required if no delta specified.
             [optional] delta - If supplied, will add this number to the current currency instead. Required if no newcurrency specified.
+            [optional] entrytype (str) - Ledger entry type to record the change under, see LEDGERTYPES. (default: adminadjust)
+            [optional] itemid (int) - Lot number the change relates to, e.g. for item bonuses.
         
         Exceptions
             UserNotRegistered - Raise if user provided isn't registered.
+            ValueError - Raised if the ledger entry type isn't valid, neither a non-zero delta nor newcurrency was given,
+                         or the value given isn't a whole number.
         '''
+        if not entrytype in LEDGERTYPES:
+            raise ValueError("Invalid ledger entry type: {0}".format(entrytype))
+        
+        if not delta and newcurrency is None:
+            raise ValueError("A new currency value or a non-zero delta must be given to change user {0}'s currency!".format(userid))
+        
+        try:
+            delta, newcurrency = int(delta) if delta else None, int(newcurrency) if newcurrency is not None else None
+        except (TypeError, ValueError):
+            raise ValueError("Currency values must be whole numbers, got newcurrency={0}, delta={1}.".format(newcurrency, delta))
+        
         try:
             self.__session = Session()
-            user = self.__getUserFromMemberId(userid)
+            user = self.__getUserFromMemberId(userid, lock=True)
+            change = delta if delta is not None else newcurrency - user.currency
             
-            if delta:
-                user.currency += delta
-            else:
-                user.currency = newcurrency
+            if change:
+                self.__adjustBalance(user, entrytype, currency=change, itemid=itemid)
             
-            self.__session.commit()
+            self.__commit()
         except UserNotRegistered:
             raise
         finally:
@@ -574,17 +1101,138 @@ class neoraffle:
     
     def fetchRegisteredUsers(self):
         '''Method to return a list of all NeoRaffle registered users.'''
-        try:
-            session = Session()
-            users = session.query(Users).all()
-            rtn = [user.username for user in users]
-            
-            return rtn
-        finally:
-            session.close()
-            
-    def deleteItem(self, itemid, userid=None):
-        ''' Method to delete an item by ID from the DB.
+        return list(self.iterRegisteredUsers())
+    
+    def iterRegisteredUsers(self, pagesize=None, uids=False):
+        '''Generate the usernames of all NeoRaffle registered users in member ID order, a page at a time.
+        
+        Each page is a separate username-only query, so neither the DB result nor the ORM holds every user at once.
+        
+        Args:
+            [optional] pagesize (int) - Usernames fetched per query. (default: USERPAGESIZE setting)
+            [optional] uids (bool) - Generate (member ID, username) tuples instead of usernames.'''
+        
+        pagesize = int(pagesize or dbsettings['USERPAGESIZE'])
+        lastuid = None
+        
+        while True:
+            session = self.__readSession()
+            
+            try:
+                query = session.query(Users.uid, Users.username)
+                
+                if lastuid is not None:
+                    query = query.filter(Users.uid > lastuid)
+                
+                page = query.order_by(Users.uid).limit(pagesize).all()
+            finally:
+                session.close()
+            
+            for lastuid, username in page:
+                yield (lastuid, username) if uids else username
+            
+            if len(page) < pagesize:
+                return
+    
+    def getRegistrationStamp(self):
+        '''Return a value which changes whenever a user registers, is removed or changes username, e.g. to tell when a
+        cached user list is stale.
+        
+        Returns:
+            Tuple of the number of registered users, the sum of their member IDs, the latest registration date and
+            the number of username changes.'''
+        
+        session = self.__readSession()
+        
+        try:
+            return tuple(session.query(func.count(Users.uid), func.sum(Users.uid), func.max(Users.regdate), func.sum(Users.namechanges)).one())
+        finally:
+            session.close()
+            
+    def fetchItems(self, lotnumbers=None, descriptions=False):
+        '''Return the details of the lots in the DB, e.g. for the web listing or an export.
+        
+        Args:
+            [optional] lotnumbers (list) - Lot numbers to fetch. Defaults to every lot.
+            [optional] descriptions (bool) - Include the item descriptions, which are large so left out by default.
+        
+        Returns:
+            List of dicts ordered by lot number, with keys: lot, title, htmltitle, price, quantity, type, offeredby,
+            topbidamount and topbidderid. Also description and htmldescription if descriptions is True.'''
+        
+        session = self.__readSession()
+        
+        try:
+            query = self.__itemQuery(descriptions, session).order_by(AuctionItems.iid)
+            
+            if lotnumbers is not None:
+                query = query.filter(AuctionItems.iid.in_([int(lot) for lot in lotnumbers] or [None]))
+            
+            rtn = []
+            for item in query:
+                lot = {'lot':item.iid, 'title':item.title, 'htmltitle':item.htmltitle, 'price':item.price, 'quantity':item.quantity, \
+                       'type':item.auctiontype, 'offeredby':item.offeredby, 'topbidamount':item.topbidamount, 'topbidderid':item.topbidderid}
+                
+                if descriptions:
+                    lot['description'], lot['htmldescription'] = item.description, item.htmldescription
+                
+                rtn.append(lot)
+            
+            return rtn
+        finally:
+            session.close()
+            
+    def fetchTranslations(self, markups):
+        '''Look up the stored HTML translations of pieces of item markup.
+        
+        Args:
+            markups (list) - Item markup strings.
+        
+        Returns:
+            Dict of markup => HTML for the markup which has been translated before. Markup not found is omitted.'''
+        
+        hashes = dict((markupHash(markup), markup) for markup in markups if markup)
+        
+        if not hashes:
+            return {}
+        
+        session = self.__readSession()
+        
+        try:
+            rows = session.query(MarkupTranslations.markuphash, MarkupTranslations.html).filter(MarkupTranslations.markuphash.in_(hashes.keys()))
+            
+            return dict((hashes[markuphash], html) for markuphash, html in rows)
+        finally:
+            session.close()
+    
+    def saveTranslations(self, translations):
+        '''Store HTML translations of item markup for fetchTranslations. Markup which is already stored is skipped.
+        
+        Args:
+            translations (dict) - Markup => HTML.'''
+        
+        rows = dict((markupHash(markup), html) for markup, html in translations.iteritems() if markup and html is not None)
+        
+        if not rows:
+            return
+        
+        session = Session()
+        
+        try:
+            for markuphash, in session.query(MarkupTranslations.markuphash).filter(MarkupTranslations.markuphash.in_(rows.keys())):
+                del rows[markuphash]
+            
+            if rows:
+                session.execute(MarkupTranslations.__table__.insert(), [{'markuphash':markuphash, 'html':html} for markuphash, html in rows.iteritems()])
+            
+            session.commit()
+        except IntegrityError: # Stored by another thread in the meantime, which is just as good.
+            session.rollback()
+        finally:
+            session.close()
+    
+    def deleteItem(self, itemid, userid=None):
+        ''' Method to delete an item by ID from the DB.
         
         Args:
             itemid - Lot number of the item to delete.
@@ -604,8 +1252,8 @@ class neoraffle:
             self.__session = Session()
             item = self.__getItemFromLotNumber(itemid)
             
-            uid = item.offered.uid
-            itemsowned = len(item.offered.owneditems)-1
+            uid = item.offeredby
+            itemsowned = self.__countOwnedItems(uid)-1
             
             if userid:
                 user = self.__getUserFromMemberId(userid)
@@ -614,7 +1262,9 @@ class neoraffle:
                     raise ValueError("You cannot delete items which do not belong to you!")
             
             self.__session.delete(item)
-            self.__session.commit()
+            self.__markUserStale(uid)
+            self.__commit()
+            self.__lotcache.invalidate(self.__lotKey(itemid))
             
             return {"userid":uid, "owneditems":itemsowned}
         finally:
@@ -634,11 +1284,14 @@ class neoraffle:
         try:
             self.__session= Session()
             item = self.__getItemFromLotNumber(itemid)
+            self.__markUserStale(item.offeredby)
             
             for k,v in kwargs.items():
                 setattr(item,k,v)
-                                
-            self.__session.commit()
+            
+            self.__markUserStale(item.offeredby) # The item may have been re-assigned to another user.
+            self.__commit()
+            self.__lotcache.invalidate(self.__lotKey(itemid))
                 
         except DoesNotExist:
             raise
@@ -646,11 +1299,97 @@ class neoraffle:
             raise ValueError("Cannot change owner of this item as the user specified is not registered!")
         finally:
             self.__session.close()
+    
+    def backfillTopBids(self):
+        '''Recalculate the stored top bid of every lot from the bid history.
+        
+        Used to populate the top bid columns when upgrading an existing DB and to repair them should they ever
+        drift from the bids table.
+        
+        Returns:
+            (int) Number of lots updated.'''
+        
+        items = AuctionItems.__table__
+        topbid = select([Bids.amount, Bids.bidderid]).where(Bids.itemid == items.c.iid).order_by(desc(Bids.amount)).limit(1)
+        
+        try:
+            session = Session()
+            res = session.execute(items.update().values(topbidamount=topbid.with_only_columns([Bids.amount]).as_scalar(), \
+                                                        topbidderid=topbid.with_only_columns([Bids.bidderid]).as_scalar()))
+            session.commit()
+            
+            log.info("Backfilled top bid columns for {0} lots.".format(res.rowcount))
+            return res.rowcount
+        finally:
+            session.close()
+    
+    def openLedger(self):
+        '''Record an opening ledger entry carrying over the balances of every user who has no ledger entries.
+        
+        Used to start the ledger when upgrading a DB created before it existed.
+        
+        Returns:
+            (int) Number of users given an opening entry.'''
+        
+        ledger = CurrencyLedger.__table__
+        
+        try:
+            session = Session()
+            opening = select([Users.uid, func.now(), literal('opening'), Users.currency, Users.heldcurrency]).where(~Users.uid.in_(select([ledger.c.uid])))
+            res = session.execute(ledger.insert().from_select(['uid', 'entrydate', 'entrytype', 'currencydelta', 'helddelta'], opening))
+            session.commit()
+            
+            log.info("Opened currency ledger for {0} users.".format(res.rowcount))
+            return res.rowcount
+        finally:
+            session.close()
+    
+    def reconcile(self):
+        '''Check every user's stored currency and held currency against the totals of their ledger entries.
+        
+        Returns:
+            Dict:
+                {"balanced" => True if every user's balances match their ledger.
+                 "mismatches" => List of dicts for users whose balances don't match. Keys: userid, currency,
+                                 heldcurrency, ledgercurrency, ledgerheld.}'''
+        
+        try:
+            session = PrimaryReadSession()
+            
+            totals = session.query(CurrencyLedger.uid.label('uid'), func.sum(CurrencyLedger.currencydelta).label('currency'), \
+                                   func.sum(CurrencyLedger.helddelta).label('held')).group_by(CurrencyLedger.uid).subquery()
+            ledgercurrency, ledgerheld = func.coalesce(totals.c.currency, 0), func.coalesce(totals.c.held, 0)
+            
+            rows = session.query(Users.uid, Users.currency, Users.heldcurrency, ledgercurrency, ledgerheld).outerjoin(totals, totals.c.uid == Users.uid) \
+                          .filter(or_(Users.currency != ledgercurrency, Users.heldcurrency != ledgerheld)).order_by(Users.uid).all()
+        finally:
+            session.close()
+        
+        mismatches = [{'userid':uid, 'currency':currency, 'heldcurrency':held, 'ledgercurrency':int(lcurrency), 'ledgerheld':int(lheld)} \
+                      for uid, currency, held, lcurrency, lheld in rows]
+        
+        for mismatch in mismatches:
+            log.error("User {0} balances don't match the currency ledger: {1}".format(mismatch['userid'], mismatch))
+        
+        return {'balanced':not mismatches, 'mismatches':mismatches}
         
     
     #=================================================
     # Raffle private methods. Not to be used directly.
     #=================================================
+    @property
+    def __session(self):
+        return self.__state.session
+    
+    @__session.setter
+    def __session(self, session):
+        self.__state.session = session
+    
+    @property
+    def __staleusers(self):
+        return self.__state.staleusers
+    
+    
     def __pointsCalc(self, points, cap):
         '''Method to return number of points as per the cap specified and not less than 0.
         
@@ -685,12 +1424,20 @@ class neoraffle:
             True on success.  Exception when initilization failed.'''
         try:                            
             # Create necessary schema:
+            existingtables = inspect(sqlengine).get_table_names()
             Base.metadata.create_all(sqlengine)
+            addedcolumns = self.__upgradeRaffleDatabase()
+            
+            if "auctionitems.topbidamount" in addedcolumns:
+                self.backfillTopBids()
+            
+            if "users" in existingtables and not "currencyledger" in existingtables:
+                self.openLedger()
                         
             # Add the raffle/auction types to the fresh types table:
             self.__session = Session()
             self.__session.query(AuctionTypes).delete()            
-            self.__session.add_all([AuctionTypes(tid=1,typename="Raffle"),AuctionTypes(tid=2,typename="Auction")])
+            self.__session.add_all([AuctionTypes(tid=tid,typename=typename.capitalize()) for typename, tid in sorted(AUCTIONTYPES.items(), key=lambda t: t[1])])
             self.__session.commit()
         except:
             log.exception("There was an error initilizing the Neo Raffle DB!")
@@ -701,6 +1448,38 @@ class neoraffle:
         return True
     
      
+    def __upgradeRaffleDatabase(self):
+        '''Bring the schema of an existing raffle DB up to date with the ORM classes.
+        
+        create_all() only creates missing tables, so any columns or indexes added to existing tables since the DB
+        was created are added here. New columns must be nullable.
+        
+        Returns:
+            List of "table.column" names which were added.'''
+        
+        inspector = inspect(sqlengine)
+        added = []
+        
+        with sqlengine.begin() as conn:
+            for table in Base.metadata.sorted_tables:
+                existing = set(column['name'] for column in inspector.get_columns(table.name))
+                
+                for column in table.columns:
+                    if column.name not in existing:
+                        log.info("Upgrading raffle DB: adding column {0}.{1}".format(table.name, column.name))
+                        conn.execute("ALTER TABLE {0} ADD COLUMN {1} {2}".format(table.name, column.name, column.type.compile(dialect=sqlengine.dialect)))
+                        added.append("{0}.{1}".format(table.name, column.name))
+                
+                existingindexes = set(index['name'] for index in inspector.get_indexes(table.name))
+                
+                for index in table.indexes:
+                    if index.name not in existingindexes:
+                        log.info("Upgrading raffle DB: adding index {0}".format(index.name))
+                        index.create(conn)
+        
+        return added
+    
+    
     def __buyRaffleTickets(self, user, item, quantity):
         '''Process a user's request to buy raffle tickets.  Requires active session attribute.
         
@@ -725,8 +1504,6 @@ class neoraffle:
             ValueError - Quantity passed was invalid.  Must be number above 0.
             UserCannotAffordItem - Cost exceeds user's available currency.
         '''
-        ticketnums = []
-        
         try:
             if "," in quantity:
                 quantity = quantity.replace(",","")
@@ -742,40 +1519,234 @@ class neoraffle:
               
         # Make the purchase - update user held currency:
         try:
-            self.__updateHeldCurrency(user, purchasecost)
+            self.__updateHeldCurrency(user, purchasecost, 'tickethold', item.iid)
         except UserCannotAffordItem:
             raise
         
-        # Return list of ticket numbers:
-           
-        for _ in range(0, quantity):
-            tickets = TicketPurchases(user=user, item=item)
-            self.__session.add(tickets)
+        if dbsettings['TICKETSTORAGE'] == 'blocks':
+            # One row for the whole purchase. The lot row is locked for the transaction, so the next free ticket
+            # number for the lot can't be taken by a concurrent purchase:
+            firsttid = self.__session.query(func.coalesce(func.max(TicketBlocks.firsttid + TicketBlocks.numtickets), 1)).filter(TicketBlocks.itemid == item.iid).scalar()
+            self.__session.add(TicketBlocks(ticketbuyer=user.uid, itemid=item.iid, firsttid=firsttid, numtickets=quantity))
             self.__session.flush()
             
-            ticketnums.append(tickets.tid)
-        
-        self.__session.commit()
+            ticketnums = range(firsttid, firsttid+quantity)
+        else:
+            # With DBLOCKING the purchaser's row is locked for the transaction, so no one else can be adding tickets held by this user:
+            ticketnums = self.__insertRows(TicketPurchases.__table__, [{'ticketbuyerid':user.uid, 'itemid':item.iid}] * quantity, \
+                                           self.__session.query(TicketPurchases.tid).filter(TicketPurchases.ticketbuyer == user.uid, TicketPurchases.itemid == item.iid))
             
         return {'iteminfo':{'lotnum':item.iid, 'title':item.title},'costinfo':{'ticketprice':item.price,'totalcost':purchasecost},'tickets':ticketnums}
 
     
-    def __updateHeldCurrency(self, user, cost):
+    def __insertRows(self, table, rows, owned):
+        '''Insert rows into a table and return their primary keys in order.  Requires active session attribute.
+        
+        With DBLOCKING the rows are inserted with one multi-row statement and their keys are read back as the newest
+        keys selected by owned. That is only safe because the caller holds a row lock which stops anyone else adding
+        rows matching owned until it commits. Without locking, each row is inserted alone and its key is taken from
+        its own insert.
+        
+        Args:
+            table (obj) - Table to insert into, with a single column primary key.
+            rows (list) - Dicts of column values.
+            owned (obj) - Query for the primary key column of the rows the caller's lock covers.
+        
+        Returns:
+            List of the new rows' primary keys, in the order of rows.'''
+        
+        if not dbsettings['DBLOCKING']:
+            return [self.__session.execute(table.insert(), row).inserted_primary_key[0] for row in rows]
+        
+        key = table.primary_key.columns.values()[0]
+        self.__session.execute(table.insert(), rows)
+        
+        keys = [row[0] for row in owned.order_by(desc(key)).limit(len(rows))]
+        keys.reverse()
+        
+        return keys
+    
+    
+    def __getCurrentDrawRun(self, session, runid=None):
+        '''Return a draw run whose winners are still held in the rafflewinners table.
+        
+        Args:
+            session (obj) - Active DB session.
+            [optional] runid (int) - ID of the draw run. Defaults to the most recent run.
+        
+        Exceptions:
+            DoesNotExist - Raised if the run isn't found, or its winners have been replaced by a later run.'''
+        
+        latest = session.query(DrawRuns).order_by(desc(DrawRuns.runid)).first()
+        
+        if latest is None or (runid is not None and int(runid) > latest.runid):
+            raise DoesNotExist("Draw run {0} was not found in the DB!".format(runid if runid is not None else ""))
+        if runid is not None and int(runid) < latest.runid:
+            raise DoesNotExist("The winners of draw run {0} have been replaced by a later draw!".format(runid))
+        
+        return latest
+    
+    
+    def __buildWinnersReport(self, session, runid):
+        '''Build the winners report for a draw run with a fixed number of queries, however many lots there are.
+        
+        Lots are fetched with their owner's and top bidder's usernames joined in, and raffle winners with their
+        usernames, as plain column rows rather than ORM objects with lazy relationships.
+        
+        Args:
+            session (obj) - Active DB session.
+            runid (int) - ID of the draw run.
+        
+        Returns:
+            See pickWinners.'''
+        
+        offerer, topbidder = aliased(Users), aliased(Users)
+        
+        winners = {}
+        for lotid, username in session.query(RaffleWinners.lotid, Users.username).join(Users, Users.uid == RaffleWinners.winnerid) \
+                                      .filter(RaffleWinners.runid == runid).order_by(RaffleWinners.rwid):
+            winners.setdefault(lotid, []).append(username)
+        
+        lots = session.query(AuctionItems.iid, AuctionItems.title, AuctionItems.quantity, AuctionItems.auctiontype, \
+                             offerer.username.label('offerer'), topbidder.username.label('topbidder')) \
+                      .join(offerer, offerer.uid == AuctionItems.offeredby).outerjoin(topbidder, topbidder.uid == AuctionItems.topbidderid) \
+                      .order_by(AuctionItems.iid)
+        
+        rtn = []
+        for lot in lots:
+            if lot.auctiontype == AUCTIONTYPES['auction']: # The winner of an auction is simply the current top bidder.
+                lotwinners = [lot.topbidder] if lot.topbidder else []
+            else:
+                lotwinners = winners.get(lot.iid, [])
+            
+            rtn.append({'lot':lot.iid,'from':lot.offerer,'quantity':lot.quantity, 'title':lot.title,'type':lot.auctiontype,'winners':lotwinners,'runid':runid})
+        
+        return rtn
+    
+    
+    def __exportTicketHoldings(self, session, ticketstorage=None):
+        '''Fetch every raffle ticket as plain tuples and group them by lot and buyer for the draw engine.
+        
+        Args:
+            session (obj) - Active DB session.
+            [optional] ticketstorage (str) - Ticket storage mode to read, 'rows' or 'blocks'. Defaults to the TICKETSTORAGE setting.
+        
+        Returns:
+            Dict of lot number => list of (buyerid, ranges) tuples, see neoraffledraw.groupTickets.'''
+        
+        lots = {}
+        
+        if (ticketstorage or dbsettings['TICKETSTORAGE']) == 'blocks':
+            for itemid, buyer, first, count in session.query(TicketBlocks.itemid, TicketBlocks.ticketbuyer, TicketBlocks.firsttid, TicketBlocks.numtickets):
+                lots.setdefault(itemid, []).append((buyer, first, count))
+        else:
+            for itemid, buyer, tid in session.query(TicketPurchases.itemid, TicketPurchases.ticketbuyer, TicketPurchases.tid):
+                lots.setdefault(itemid, []).append((buyer, tid, 1))
+        
+        return dict((itemid, groupTickets(tickets)) for itemid, tickets in lots.iteritems())
+    
+    
+    def __validateItem(self, userid, itemtitle, itemdescription, itemprice, itemquantity, itemtype):
+        '''Validate the details of an item being offered.  See addItemToDatabase for the arguments.
+        
+        Returns:
+            Tuple of the item price (None for auctions) and quantity as ints.
+        
+        Exceptions:
+            MultipleValidationErrors - Raises this exception with list of errors on input validation failures.'''
+        
+        errItems = []
+        logErr = "Validation error when adding item to DB by user {0}".format(userid)
+        
+        # Remove any commas from the price/quantity:
+        try:
+            itemprice = itemprice.replace(',','')
+            itemquantity = itemquantity.replace(',','')
+        except (AttributeError, TypeError):
+            pass # They're null/ints, which is fine and expected anyway.
+        
+        if len(itemtitle) == 0:
+            log.error("{0} - Invalid title!".format(logErr))
+            errItems.append("The title of the submitted form was invalid.")
+        if len(itemdescription) == 0:
+            log.error("{0} - Invalid description!".format(logErr))
+            errItems.append("The description of the submitted form was invalid.")
+            
+        if not itemtype == 2: # Don't validate price field for auctions.
+            try:
+                itemprice = int(itemprice)
+                if itemprice <= 0 or itemprice > 10000:
+                    log.error("{0} - price out of bounds.".format(logErr))
+                    errItems.append("The price specified was out of bounds! Must be between 1 and 10,000")
+            except ValueError: # The int cast failed - it's not a number.
+                log.error("{0} - price was not valid integer.".format(logErr))
+                errItems.append("Price was not a valid number.")
+        else: # Auctions have no pre-defined price, set it to null for the DB call.
+            itemprice = None
+            
+        try:
+            itemquantity = int(itemquantity)
+            if itemquantity <= 0 or itemquantity > 10:
+                log.error("{0} - quantity out of bounds.".format(logErr))
+                errItems.append("The quantity specified was out of bounds! Must be between 1 and 10!")
+        except ValueError:
+            log.error("{0} - Quantity was not valid integer.".format(logErr))
+            errItems.append("Quantity was not a valid number.")
+            
+        if errItems:
+            log.debug("Form from user {0} was rejected due to validation errors: {1}".format(userid, ", ".join(errItems)))
+            raise MultipleValidationErrors(*errItems)
+        
+        return itemprice, itemquantity
+    
+    
+    def __updateHeldCurrency(self, user, cost, entrytype, itemid=None):
         '''Update a user's held currency.  Can also handle refunds by passing negative values.  Requires active session attribute.
         
         Args:
             user (obj) - User ORM object for purchaser.
             cost (int) - Amount of currency to hold for given user.
+            entrytype (str) - Ledger entry type to record the change under, see LEDGERTYPES.
+            [optional] itemid (int) - Lot number the currency is held for.
             
         Exceptions:
             UserCannotAffordItem - Raised when passed cost exceeds user's available currency.
         '''
-        availcur = (user.currency - user.heldcurrency)
-        if cost > availcur:
+        if not self.__adjustBalance(user, entrytype, held=cost, itemid=itemid):
+            availcur = (user.currency - user.heldcurrency)
             raise UserCannotAffordItem("Cost of the purchase is {0}, but user only has {1} points remaining!".format(cost, availcur))
+    
+    
+    def __adjustBalance(self, user, entrytype, currency=0, held=0, itemid=None):
+        '''Change a user's currency and/or held currency and record the change in the ledger.  Requires active session attribute.
+        
+        The balances are changed with a single UPDATE relative to their stored values, and a hold is only applied
+        if the stored available currency covers it, so concurrent changes can't be lost or overdraw the user.
+        
+        Args:
+            user (obj) - User ORM object. Its balance attributes are expired and reload on next access.
+            entrytype (str) - Ledger entry type, see LEDGERTYPES.
+            [optional] currency (int) - Change to the user's currency.
+            [optional] held (int) - Change to the user's held currency.
+            [optional] itemid (int) - Lot number the change relates to.
+        
+        Returns:
+            True if the change was applied. False if the hold exceeded the user's available currency.'''
+        
+        query = self.__session.query(Users).filter(Users.uid == user.uid)
         
-        user.heldcurrency += cost
-        self.__session.commit()
+        if held > 0:
+            query = query.filter(Users.currency - Users.heldcurrency >= held)
+        
+        if not query.update({Users.currency: Users.currency + currency, Users.heldcurrency: Users.heldcurrency + held}, synchronize_session=False):
+            return False
+        
+        self.__session.add(CurrencyLedger(uid=user.uid, entrytype=entrytype, currencydelta=currency, helddelta=held, itemid=itemid))
+        self.__session.expire(user, ['currency', 'heldcurrency'])
+        self.__markUserStale(user.uid)
+        self.__session.flush()
+        
+        return True
                 
     
     def __bidOnItem(self, user, item, bid):
@@ -812,32 +1783,30 @@ class neoraffle:
         except:
             raise ValueError("{0} isn't a valid bid quantity!".format(bid))
         
-        try:
-            curtopbid = item.bids[0].amount
-            curtopbidder = item.bids[0].bidder
-            curtopbidderid = curtopbidder.uid
-        except IndexError:
-            curtopbid, curtopbidder, curtopbidderid = None, None, None # There were no bids yet.
-            
+        curtopbid, curtopbidder, curtopbidderid = item.topbidamount, None, item.topbidderid
+        
+        if curtopbidderid is not None:
+            curtopbidder = self.__getUserFromMemberId(curtopbidderid, lock=True)
                 
         if curtopbid >= bid:
             raise BidDoesNotExceedCurrentTopBid("The bid of {0} did not exceed the current top bid for lot {1}, which is: {2}".format(bid, item.iid, curtopbid))
         
-        # Make the bid:    
+        # Make the bid. Hold, bid and refund are flushed into the caller's transaction and committed together:
         try:
-            self.__updateHeldCurrency(user, bid)
+            self.__updateHeldCurrency(user, bid, 'bidhold', item.iid)
             
-            procbid = Bids(bidder=user, item=item, amount=bid)
+            procbid = Bids(bidderid=user.uid, itemid=item.iid, amount=bid)
+            item.topbidamount, item.topbidderid = bid, user.uid
         
             self.__session.add(procbid)
-            self.__session.commit()
+            self.__session.flush()
         except UserCannotAffordItem:
             raise
         
         # Refund previous top bidder if one exists:
         if curtopbid:
             try:
-                self.__updateHeldCurrency(curtopbidder, curtopbid-(curtopbid*2))
+                self.__updateHeldCurrency(curtopbidder, curtopbid-(curtopbid*2), 'bidrefund', item.iid)
             except:
                 log.critical("Critical error refunding bid. User {0} bid of {1} on item {2} wasn't refunded correctly and a later bid was processed - their available currency may be in an incorrect state!".format(curtopbidder.uid, curtopbid, item.iid))
                 raise
@@ -845,11 +1814,245 @@ class neoraffle:
         return {'iteminfo':{'lotnum':item.iid, 'title':item.title},'prevtopbidder':{'userid':curtopbidderid,'amount':curtopbid},'newtopbidder':{'userid':user.uid,'amount':bid}}
         
 
-    def __getUserFromMemberId(self, neomemberid):
+    def __processPurchase(self, purchasetype, user, item, **kwargs):
+        '''Validate and dispatch a single purchase of an already loaded lot.  Requires active session attribute.
+        
+        Changes are flushed but not committed; committing is left to the calling public method.
+        
+        Args:
+            purchasetype (str) - Type of purchase to process. Accepted: raffle, auction
+            user (obj) - User ORM object for purchaser.
+            item (obj) - Item ORM object for the lot, or its lotinfo snapshot for raffle purchases.
+            **kwargs - Purchase type specific values, as per makePurchase.
+        
+        Returns:
+            See makePurchase.
+        
+        Exceptions:
+            See makePurchase.
+        '''
+        types = {"raffle": self.__buyRaffleTickets, "auction": self.__bidOnItem}
+        
+        if user.uid == item.offeredby: # User is attempting to bid on own item!
+            raise UserAttemptToPurchaseOwnItem("You cannot buy tickets or bid for your own item!")
+        
+        try:
+            auctiontype = AUCTIONTYPES[purchasetype.lower()]
+        except (KeyError, AttributeError):
+            raise ValueError("Invalid purchase type passed to method: {0}!".format(purchasetype))
+        
+        if not auctiontype == item.auctiontype: # User is attempting to make a bid on a raffle item or trying to buy an auction item.
+            raise InvalidAuctionType("Method call invalid - invoked {0} call but the item does not match that lot type.".format(purchasetype))
+        
+        try:
+            return types[purchasetype](user, item, **kwargs)
+        except KeyError:
+            raise ValueError("Supported purchase types are: {0}".format(", ".join(types.keys())))
+        except TypeError as e:
+            raise ValueError("Parameters were not expected by underlying method. Args: {0}. Err: {1}".format(", ".join(kwargs), e))
+        except UserCannotAffordItem:
+            raise
+        except BidDoesNotExceedCurrentTopBid:
+            raise
+        except ValueError:
+            raise
+        except:
+            log.exception("An unknown error occurred when running the purchase routine.")
+            raise
+    
+    
+    def __lotKey(self, lotnumber):
+        '''Return a lot number as an int, or None if it isn't a valid lot number.'''
+        try:
+            return int(lotnumber)
+        except (TypeError, ValueError):
+            return None
+    
+    
+    def __getCachedRaffleLots(self, lotnumbers):
+        '''Return lotinfo snapshots of the raffle lots among lotnumbers, using the lot cache.  Requires active session attribute.
+        
+        Snapshots are only used while the cache is warm (see warmLotCache) and tickets are stored as rows, as block
+        storage numbers tickets from the exclusively locked lot row. The cache tells which lots are raffle lots without
+        loading them. Their details are then re-read with one query, under a shared lock when DBLOCKING is enabled. The
+        lock stops the lots being edited or deleted before the purchase commits but lets other purchases of them go
+        ahead, and a lot changed since it was cached is refreshed in the cache rather than sold at its cached price.
+        
+        Returns:
+            Dict of lotinfo tuples keyed by (int) lot number. Lots to load from the DB instead (cache cold, lot not
+            found or auction lot) are omitted.'''
+        
+        if not _lotcachestate['warm'] or not dbsettings['TICKETSTORAGE'] == 'rows':
+            return {}
+        
+        lots = set()
+        
+        for lotnumber in lotnumbers:
+            lot = self.__lotKey(lotnumber)
+            
+            if lot is not None:
+                info = self.__lotcache.get(lot)
+                
+                if info is None or info.auctiontype == AUCTIONTYPES['raffle']: # Lots missing from a warm cache are read once and cached.
+                    lots.add(lot)
+        
+        if not lots:
+            return {}
+        
+        query = self.__session.query(*self.__lotInfoColumns()).filter(AuctionItems.iid.in_(lots)).order_by(AuctionItems.iid)
+        
+        if dbsettings['DBLOCKING']:
+            query = query.with_for_update(read=True)
+        
+        rtn = {}
+        
+        for row in query:
+            info = lotinfo(*row)
+            self.__lotcache.set(info.iid, info)
+            lots.discard(info.iid)
+            
+            if info.auctiontype == AUCTIONTYPES['raffle']:
+                rtn[info.iid] = info
+        
+        for lot in lots: # Deleted since they were cached.
+            self.__lotcache.invalidate(lot)
+        
+        return rtn
+    
+    
+    def __lotInfoColumns(self):
+        '''Return the AuctionItems columns making up a lotinfo snapshot, in order.'''
+        return [getattr(AuctionItems, field) for field in lotinfo._fields]
+    
+    
+    def __commit(self):
+        '''Commit the active session, then drop the cached details of every member it changed.  Requires active session attribute.'''
+        try:
+            self.__session.commit()
+        finally:
+            for userid in self.__staleusers:
+                self.__usercache.invalidate(userid)
+                recentwriters.set(userid, True)
+            self.__staleusers.clear()
+    
+    
+    def __readSession(self, userid=None):
+        '''Return a session for read-only queries, on the read replica when it's safe to read from.
+        
+        The primary is used instead if there's no replica or it's lagging by more than REPLICAMAXLAG. It's also used
+        if the data may have been written too recently to be on the replica yet: for a member's details, if the member
+        was written to in the last REPLICAMAXLAG seconds; otherwise, if anything was.
+        
+        Args:
+            [optional] userid - Neoseeker member ID whose details are being read.'''
+        
+        lag = replicaLag()
+        
+        if lag is None or lag > dbsettings['REPLICAMAXLAG']:
+            return PrimaryReadSession()
+        
+        if userid is not None:
+            recent = recentwriters.get(self.__userCacheKey(userid)) is not None
+        else:
+            recent = time.time() - _replicastate['lastwrite'] < dbsettings['REPLICAMAXLAG']
+        
+        return PrimaryReadSession() if recent else ReadSession()
+    
+    def __userCacheKey(self, userid):
+        '''Normalise a member ID for use as a cache key, as IDs arrive as both ints and strings.'''
+        try:
+            return int(userid)
+        except (TypeError, ValueError):
+            return str(userid)
+    
+    
+    def __markUserStale(self, userid):
+        '''Queue a member's cached details to be dropped when the active session commits.'''
+        self.__staleusers.add(self.__userCacheKey(userid))
+    
+    
+    def __getUserDetails(self, userid):
+        '''Return a member's registration status, currency and owned item count, from the member cache if possible.
+        
+        Args:
+            userid - Neoseeker member ID.
+        
+        Returns:
+            Dict with key registered. Registered members also have keys: currency, heldcurrency, owneditems.'''
+        
+        key = self.__userCacheKey(userid)
+        details = self.__usercache.get(key)
+        
+        if details is None:
+            generation = self.__usercache.generation() # Taken before the read, in case a commit invalidates the member meanwhile.
+            session = self.__readSession(userid)
+            
+            try:
+                owned = select([func.count(AuctionItems.iid)]).where(AuctionItems.offeredby == Users.uid).correlate(Users).as_scalar()
+                user = session.query(Users.currency, Users.heldcurrency, owned).filter(Users.uid == userid).first()
+                
+                if user is None:
+                    details = {'registered':False}
+                else:
+                    details = {'registered':True, 'currency':user[0], 'heldcurrency':user[1], 'owneditems':int(user[2])}
+            finally:
+                session.close()
+            
+            self.__usercache.set(key, details, generation)
+        
+        return details
+    
+    
+    def __countOwnedItems(self, uid, session=None):
+        '''Return the number of items a user has offered, counted in the DB rather than by loading their items.
+        
+        Args:
+            uid (int) - Neoseeker member ID.
+            [optional] session (obj) - Session to query with. Defaults to the active session attribute.'''
+        
+        session = session or self.__session
+        return int(session.query(func.count(AuctionItems.iid)).filter(AuctionItems.offeredby == uid).scalar())
+    
+    def __userExists(self, uid, session=None):
+        '''Return True if a user row exists for a member ID, using an EXISTS query.
+        
+        Args:
+            uid (int) - Neoseeker member ID.
+            [optional] session (obj) - Session to query with. Defaults to the active session attribute.'''
+        
+        session = session or self.__session
+        return bool(session.query(exists().where(Users.uid == uid)).scalar())
+    
+    def __itemQuery(self, descriptions=False, session=None):
+        '''Return a query for AuctionItems.
+        
+        Args:
+            [optional] descriptions (bool) - Load the description columns with the items rather than on first access.
+            [optional] session (obj) - Session to query with. Defaults to the active session attribute.'''
+        
+        query = (session or self.__session).query(AuctionItems)
+        
+        if descriptions:
+            query = query.options(undefer_group('descriptions'))
+        
+        return query
+    
+    def __getRegisteredUserDetails(self, userid):
+        '''As __getUserDetails, but raises UserNotRegistered if the member isn't registered.'''
+        details = self.__getUserDetails(userid)
+        
+        if not details['registered']:
+            raise UserNotRegistered("Attempted to get DB object for user {0} but wasn't found in DB!".format(userid))
+        
+        return details
+    
+    
+    def __getUserFromMemberId(self, neomemberid, lock=False):
         '''Return a DB user object from a Neo member ID.  Requires active session attribute.
         
         Args:
             neomemberid - MemberID of Neo user.
+            [optional] lock (bool) - Lock the user row until the end of the transaction when DBLOCKING is enabled.
         
         Returns:
             User ORM object.
@@ -857,18 +2060,24 @@ class neoraffle:
         Exceptions:
             UserNotRegistered - Returned if user is not registered with the raffle system.'''
         
+        query = self.__session.query(Users).filter(Users.uid == neomemberid)
+        
+        if lock and dbsettings['DBLOCKING']:
+            query = query.populate_existing().with_for_update()
+        
         try:
-            user = self.__session.query(Users).filter(Users.uid == neomemberid).one()
+            user = query.one()
         except NoResultFound:
             raise UserNotRegistered("Attempted to get DB object for user {0} but wasn't found in DB!".format(neomemberid))
         
         return user
     
-    def __getItemFromLotNumber(self, lotnumber):
+    def __getItemFromLotNumber(self, lotnumber, lock=False):
         '''Return an Item DB object reference from a lot number.  Requires active session attribute.
         
         Args:
             lotnumber (int) - Lot number.
+            [optional] lock (bool) - Lock the item row until the end of the transaction when DBLOCKING is enabled.
         
         Returns:
             Item ORM object.
@@ -876,13 +2085,70 @@ class neoraffle:
         Exceptions:
             DoesNotExist - Returned if item is not found within the DB.'''
         
+        query = self.__itemQuery().filter(AuctionItems.iid == lotnumber)
+        
+        if lock and dbsettings['DBLOCKING']:
+            query = query.populate_existing().with_for_update()
+        
         try:
-            item = self.__session.query(AuctionItems).filter(AuctionItems.iid == lotnumber).one()
+            item = query.one()
         except NoResultFound:
             raise DoesNotExist("Call to fetch item {0} from the DB, but it doesn't exist!".format(lotnumber))
         
         return item
+    
+    def __getItemsFromLotNumbers(self, lotnumbers, lock=False):
+        '''Fetch several items with a single query.  Requires active session attribute.
+        
+        Args:
+            lotnumbers (list) - Lot numbers to fetch. Values that aren't valid lot numbers are ignored.
+            [optional] lock (bool) - Lock the item rows (in lot order) until the end of the transaction when DBLOCKING is enabled.
+        
+        Returns:
+            Dict of item ORM objects keyed by (int) lot number. Lots not found in the DB are omitted.'''
+        
+        lots = set()
+        for lotnumber in lotnumbers:
+            try:
+                lots.add(int(lotnumber))
+            except (TypeError, ValueError):
+                pass
+        
+        if not lots:
+            return {}
+        
+        query = self.__itemQuery().filter(AuctionItems.iid.in_(lots)).order_by(AuctionItems.iid)
+        
+        if lock and dbsettings['DBLOCKING']:
+            query = query.populate_existing().with_for_update()
+        
+        return dict((item.iid, item) for item in query)
 
     
 if __name__ == "__main__":
-    logging.basicConfig(level="DEBUG")
\ No newline at end of file
+    import argparse
+    
+    logging.basicConfig(level="DEBUG")
+    
+    # Command line draw. Unlike the bot this runs single threaded, so it can spread the draw over DRAWPROCESSES workers:
+    parser = argparse.ArgumentParser(description="Draw or verify the NeoRaffle winners.")
+    commands = parser.add_subparsers(dest='command')
+    
+    draw = commands.add_parser('draw', help="Draw the winners of every raffle lot and print them.")
+    draw.add_argument('--seed', help="Seed for the draw. A random seed is generated if not given.")
+    draw.add_argument('--seedhash', help="SHA-256 hex digest of the seed published before the draw.")
+    
+    verify = commands.add_parser('verify', help="Recompute a draw run and compare it with the stored winners.")
+    verify.add_argument('runid', type=int, help="ID of the draw run to verify.")
+    
+    for command in (draw, verify):
+        command.add_argument('--processes', type=int, default=int(dbsettings['DRAWPROCESSES']), help="Worker processes to draw with.")
+    
+    args = parser.parse_args()
+    raffle = neoraffle()
+    
+    if args.command == 'draw':
+        for lot in raffle.pickWinners(args.seed, args.seedhash, args.processes):
+            print u"Lot {0} ({1}): {2}".format(lot['lot'], lot['title'], ", ".join(lot['winners']) or "no winners")
+    else:
+        print raffle.verifyDraw(args.runid, args.processes)
\ No newline at end of file
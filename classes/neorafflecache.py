@@ -0,0 +1,101 @@
+'''
+Module: NeoRaffle Cache
+License: Released under WTFPL <http://www.wtfpl.net/txt/copying/>
+
+===========
+Info
+===========
+Small in-process cache used by the NeoRaffle module and plugin to avoid repeating DB and API lookups. Entries are
+evicted least recently used first once the cache is full, and optionally expire after a fixed time to live.
+'''
+import threading, time
+
+from collections import OrderedDict
+
+
+class lrucache:
+    '''Thread-safe LRU cache with optional time to live and hit/miss counters.
+
+    Attributes:
+        maxsize - Maximum number of entries held. 0 disables the cache, so every lookup misses.
+        ttl - Seconds an entry stays valid for, or None for no expiry.'''
+
+    def __init__(self, maxsize=1000, ttl=None):
+        '''Cache constructor.
+
+        Args:
+            [optional] maxsize (int) - Maximum number of entries. (default: 1,000)
+            [optional] ttl (int) - Seconds an entry stays valid for. (default: no expiry)'''
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+        self.__generation = 0 # Number of invalidations, see generation().
+
+    def get(self, key, default=None):
+        '''Return the cached value for key, or default if it isn't cached or has expired.'''
+        with self.__lock:
+            try:
+                value, expires = self.__entries.pop(key)
+            except KeyError:
+                self.__misses += 1
+                return default
+
+            if expires is not None and expires < time.time():
+                self.__misses += 1
+                return default
+
+            self.__entries[key] = (value, expires) # Re-insert as most recently used.
+            self.__hits += 1
+
+            return value
+
+    def generation(self):
+        '''Return a token to pass to set() with a value about to be read from its source. See set().'''
+        with self.__lock:
+            return self.__generation
+
+    def set(self, key, value, generation=None):
+        '''Cache value under key, evicting the least recently used entry if the cache is full.
+
+        A value read while another thread changes its source and invalidates the key may be stale, and caching it
+        after the invalidation would undo it. Passing the generation() taken before the read skips caching the value
+        if anything has been invalidated since.'''
+
+        if self.maxsize <= 0:
+            return
+
+        with self.__lock:
+            if generation is not None and not generation == self.__generation:
+                return
+
+            self.__entries.pop(key, None)
+            self.__entries[key] = (value, time.time() + self.ttl if self.ttl is not None else None)
+
+            while len(self.__entries) > self.maxsize:
+                self.__entries.popitem(last=False)
+                self.__evictions += 1
+
+    def invalidate(self, key):
+        '''Remove key from the cache if present.'''
+        with self.__lock:
+            self.__entries.pop(key, None)
+            self.__generation += 1
+
+    def clear(self):
+        '''Remove every entry from the cache.'''
+        with self.__lock:
+            self.__entries.clear()
+            self.__generation += 1
+
+    def stats(self):
+        '''Return a dict of cache counters. Keys: hits, misses, evictions, size, maxsize.'''
+        with self.__lock:
+            return {'hits':self.__hits, 'misses':self.__misses, 'evictions':self.__evictions, 'size':len(self.__entries), 'maxsize':self.maxsize}
+
+    def __len__(self):
+        return len(self.__entries)
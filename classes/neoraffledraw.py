@@ -0,0 +1,230 @@
+'''
+Module: NeoRaffle Draw
+License: Released under WTFPL <http://www.wtfpl.net/txt/copying/>
+
+===========
+Info
+===========
+Winner drawing engine for the NeoRaffle module. Works purely on in-memory ticket holdings rather than ORM objects
+so that a full year's raffle can be drawn (and re-drawn for verification) quickly.
+
+A lot's holdings are a list of (buyerid, ranges) tuples, where ranges is a list of (firstticket, numtickets) tuples
+covering that buyer's ticket numbers. Buyers are held in a Fenwick tree weighted by their ticket counts, so each
+draw of a unique winner costs O(log n) in the number of buyers rather than a pass over every ticket.
+'''
+import logging, random, multiprocessing, threading
+
+from bisect import bisect_right
+from hashlib import sha256
+
+# Identifies the drawing procedure (seed derivation, holdings ordering and sampling) recorded against each draw run.
+# Bump this whenever any of those change, as draws made with an older version can no longer be reproduced.
+DRAWALGORITHM = "fenwick-sha256-1"
+
+# Module-level instance of logger:
+log = logging.getLogger(__name__)
+
+
+class fenwicktree:
+    '''Binary indexed tree of non-negative integer weights supporting weighted selection.'''
+
+    def __init__(self, weights):
+        '''Build the tree in O(n).
+
+        Args:
+            weights (list) - Initial weight of each position.'''
+
+        self.size = len(weights)
+        self.total = 0
+        self.__tree = [0] * (self.size + 1)
+
+        for i, weight in enumerate(weights, 1):
+            self.__tree[i] += weight
+            self.total += weight
+            parent = i + (i & -i)
+
+            if parent <= self.size:
+                self.__tree[parent] += self.__tree[i]
+
+    def add(self, position, delta):
+        '''Add delta to the weight at a (zero based) position.'''
+        self.total += delta
+        i = position + 1
+
+        while i <= self.size:
+            self.__tree[i] += delta
+            i += i & -i
+
+    def find(self, pick):
+        '''Return (position, offset) for the position whose cumulative weight range contains pick.
+
+        Args:
+            pick (int) - Value in the range 0 <= pick < total.
+
+        Returns:
+            Tuple of the zero based position and the offset of pick within that position's weight.'''
+
+        position = 0
+        step = 1 << self.size.bit_length()
+
+        while step:
+            nxt = position + step
+
+            if nxt <= self.size and self.__tree[nxt] <= pick:
+                position = nxt
+                pick -= self.__tree[nxt]
+            step >>= 1
+
+        return position, pick
+
+
+def hashSeed(seed):
+    '''Return the hex SHA-256 of a draw seed, as published ahead of a draw to commit to the seed.'''
+    return sha256(str(seed)).hexdigest()
+
+
+def lotRandom(seed, lot):
+    '''Return a dedicated random number generator for one lot of a draw.
+
+    The generator is seeded from the draw seed and lot number, so each lot's draw is reproducible on its own
+    regardless of the order lots are drawn in.
+
+    Args:
+        seed (str) - Draw run seed.
+        lot (int) - Lot number.'''
+
+    return random.Random(int(sha256("{0}:{1}".format(seed, lot)).hexdigest(), 16))
+
+
+def groupTickets(tickets):
+    '''Group ticket rows into per-buyer holdings, collapsing consecutive ticket numbers into ranges.
+
+    Args:
+        tickets (iterable) - (buyerid, firstticket, numtickets) tuples. Single ticket rows are passed with numtickets 1.
+
+    Returns:
+        List of (buyerid, ranges) tuples ordered by buyer ID, with ranges ordered by ticket number.'''
+
+    held = {}
+
+    for buyer, first, count in sorted(tickets, key=lambda ticket: (ticket[0], ticket[1])):
+        ranges = held.setdefault(buyer, [])
+
+        if ranges and ranges[-1][0] + ranges[-1][1] == first:
+            ranges[-1] = (ranges[-1][0], ranges[-1][1] + count)
+        else:
+            ranges.append((first, count))
+
+    return sorted(held.items())
+
+
+def drawBuyers(weights, quantity, rng=random):
+    '''Draw up to quantity unique positions from a list of buyer weights.
+
+    Each draw picks one ticket uniformly from the tickets still in the draw, which weights buyers by the number
+    of tickets they hold. A winning buyer is then removed so their remaining tickets can't win again.
+
+    Args:
+        weights (list) - Number of tickets held by each buyer.
+        quantity (int) - Number of winners to draw.
+        [optional] rng - Random number generator providing randrange(). Defaults to the random module.
+
+    Returns:
+        List of (position, offset) tuples in draw order, where offset is the index of the winning ticket among
+        that buyer's tickets. Shorter than quantity if there are fewer buyers.'''
+
+    tree = fenwicktree(weights)
+    draws = []
+
+    while tree.total > 0 and len(draws) < quantity:
+        position, offset = tree.find(rng.randrange(tree.total))
+        draws.append((position, offset))
+        tree.add(position, -weights[position])
+
+    return draws
+
+
+def resolveTicket(ranges, offset):
+    '''Return the ticket number at an offset within a buyer's ticket ranges.'''
+    ends, end = [], 0
+
+    for _, count in ranges:
+        end += count
+        ends.append(end)
+
+    block = bisect_right(ends, offset)
+    first, count = ranges[block]
+
+    return first + count - (ends[block] - offset)
+
+
+def drawWinners(holdings, quantity, rng=random):
+    '''Draw up to quantity unique winners from a lot's ticket holdings. See drawBuyers for the draw procedure.
+
+    Args:
+        holdings (list) - (buyerid, ranges) tuples as returned by groupTickets.
+        quantity (int) - Number of winners to draw.
+        [optional] rng - Random number generator providing randrange(). Defaults to the random module.
+
+    Returns:
+        List of (buyerid, ticketnumber) tuples in draw order. Shorter than quantity if there are fewer buyers.'''
+
+    weights = [sum(count for _, count in ranges) for _, ranges in holdings]
+
+    return [(holdings[position][0], resolveTicket(holdings[position][1], offset)) for position, offset in drawBuyers(weights, quantity, rng)]
+
+
+def drawLot(task):
+    '''Draw one lot from a (lot, weights, quantity, seed) task tuple.
+
+    Kept at module level so that tasks can be handed to worker processes.
+
+    Returns:
+        Tuple of the lot number and its list of (position, offset) draws, see drawBuyers.'''
+
+    lot, weights, quantity, seed = task
+    return lot, drawBuyers(weights, quantity, lotRandom(seed, lot))
+
+
+def drawLots(tasks, processes=0):
+    '''Draw the winners of many lots, optionally spread across a pool of worker processes.
+
+    Only each buyer's ticket count is sent to the workers; winning ticket numbers are resolved from the ranges in
+    the calling process. Every lot is drawn with its own generator derived from the seed, so results are identical
+    however the lots are split between processes, and match drawWinners with lotRandom.
+
+    Worker processes are forked, so they may only be used from a single threaded program such as the command line
+    draw in neoraffle.py. A child forked from a threaded program like the bot inherits locks held by its other
+    threads (e.g. logging's) which will never be released. If other threads are running, the lots are drawn in the
+    calling process instead.
+
+    Args:
+        tasks (list) - (lot, holdings, quantity, seed) tuples, with holdings as returned by groupTickets.
+        [optional] processes (int) - Number of worker processes. 0 or 1 draws in the calling process.
+
+    Returns:
+        Dict of lot number => list of (buyerid, ticketnumber) draws.'''
+
+    holdings = dict((lot, lotholdings) for lot, lotholdings, _, _ in tasks)
+    work = [(lot, [sum(count for _, count in ranges) for _, ranges in lotholdings], quantity, seed) for lot, lotholdings, quantity, seed in tasks]
+
+    if processes > 1 and threading.active_count() > 1:
+        log.warning("Not drawing with {0} processes as other threads are running, drawing in this process.".format(processes))
+        processes = 0
+
+    if processes > 1 and len(work) > 1:
+        pool = multiprocessing.Pool(processes)
+
+        try:
+            results = pool.map(drawLot, work, chunksize=max(1, len(work) // (processes * 4)))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        results = map(drawLot, work)
+
+    return dict((lot, [(holdings[lot][position][0], resolveTicket(holdings[lot][position][1], offset)) for position, offset in draws]) \
+                for lot, draws in results)
@@ -0,0 +1,91 @@
+'''
+Module: NeoRaffle Post
+License: Released under WTFPL <http://www.wtfpl.net/txt/copying/>
+
+===========
+Info
+===========
+Builds the forum posts made by the NeoRaffle plugin. Text is collected in pieces and joined once at the end rather
+than grown by repeated concatenation, and a post which would go over the forum's length limit is split into several.
+
+Each write() is kept whole, so a split only ever falls between pieces. Tags left open across a split (e.g. a list
+or spoiler) are closed at the end of one post and reopened at the start of the next:
+
+    writer = postwriter(50000)
+    writer.write("Winners:\\n")
+    writer.begin("[ul]\\n", "[/ul]\\n")
+    for lot in lots:
+        writer.write(renderLot(lot))
+    writer.end()
+    for body in writer.posts():
+        neo.postToForums(thread, title, body)
+'''
+
+
+class postwriter:
+    '''Collects the pieces of a forum post, splitting it into several posts to stay within a length limit.
+
+    Attributes:
+        maxlength - Longest post body produced, unless a single piece is longer by itself.'''
+
+    def __init__(self, maxlength):
+        '''Writer constructor.
+
+        Args:
+            maxlength (int) - Longest post body to produce.'''
+
+        self.maxlength = maxlength
+        self.__posts = []
+        self.__pieces = []
+        self.__length = 0
+        self.__blank = 0 # Length of the current post before anything but reopened tags was written to it.
+        self.__open = [] # (opening, closing) tags of the blocks currently open, outermost first.
+
+    def write(self, text):
+        '''Add a piece of text, starting a new post first if it won't fit in the current one.'''
+        if self.__length + len(text) + self.__closinglength() > self.maxlength and self.__length > self.__blank:
+            self.__split()
+
+        self.__add(text)
+
+    def begin(self, opening, closing):
+        '''Open a block, e.g. a list or spoiler. Should the post be split before end() is called, closing is
+        written at the end of the post and opening is repeated at the start of the next.'''
+
+        self.write(opening)
+        self.__open.append((opening, closing))
+
+    def end(self):
+        '''Close the innermost open block.'''
+        opening, closing = self.__open.pop()
+        self.__add(closing)
+
+    def posts(self):
+        '''Return the list of post bodies written so far, in order. Any blocks still open are closed.'''
+        while self.__open:
+            self.end()
+
+        if self.__length > self.__blank or not self.__posts:
+            self.__posts.append("".join(self.__pieces))
+            self.__pieces, self.__length, self.__blank = [], 0, 0
+
+        return self.__posts
+
+    def __add(self, text):
+        self.__pieces.append(text)
+        self.__length += len(text)
+
+    def __closinglength(self):
+        return sum(len(closing) for _, closing in self.__open)
+
+    def __split(self):
+        for _, closing in reversed(self.__open):
+            self.__add(closing)
+
+        self.__posts.append("".join(self.__pieces))
+        self.__pieces, self.__length = [], 0
+
+        for opening, _ in self.__open:
+            self.__add(opening)
+
+        self.__blank = self.__length
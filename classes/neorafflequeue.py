@@ -0,0 +1,348 @@
+'''
+Module: NeoRaffle Queue
+License: Released under WTFPL <http://www.wtfpl.net/txt/copying/>
+
+===========
+Info
+===========
+Queues used by the NeoRaffle plugin to smooth out bursts of forum activity.
+
+keyeddispatcher processes forum notifications on a pool of worker threads. Work is queued against a key (the member
+ID for notifications). All work for a key is handled by the same worker in the order it was queued, so one member's
+bids keep their order while different members are processed in parallel. Each worker's queue is bounded; once full,
+queueing blocks (or fails) instead of letting a burst grow without limit.
+
+replyqueue sends the plugin's forum replies from a background thread at a limited rate. Replies to the same thread
+made within a short window of each other are combined into one post. Posts to a thread are made in the order they were
+queued, and a post which failed without reaching the forum is retried with backoff before any later post to its thread.
+'''
+import errno, logging, socket, threading, time, urllib2, Queue
+
+# Module-level instance of logger:
+log = logging.getLogger(__name__)
+
+# Raised by put() when a worker's queue stays full for the whole timeout:
+QueueFull = Queue.Full
+
+_STOP = object() # Sentinel telling a worker to exit.
+
+# Socket errors raised before a request could be sent:
+_UNSENTERRNOS = (errno.ECONNREFUSED, errno.EHOSTUNREACH, errno.ENETUNREACH)
+
+
+def undelivered(error):
+    '''Return True if error shows a forum post was never made, so it can be retried without posting twice: the host
+    lookup or the connection failed. Timeouts, dropped connections and HTTP errors may come after the forum took the
+    post, so they aren't counted.
+
+    Args:
+        error (Exception) - Error raised by the send callable, e.g. a urllib2.URLError or socket.error.'''
+
+    if isinstance(error, urllib2.URLError) and not isinstance(error, urllib2.HTTPError):
+        error = error.reason
+
+    if isinstance(error, socket.gaierror):
+        return True
+
+    return isinstance(error, socket.error) and not isinstance(error, socket.timeout) and error.errno in _UNSENTERRNOS
+
+
+class keyeddispatcher:
+    '''Pool of worker threads with a bounded FIFO queue each, processing work serially per key.
+
+    Attributes:
+        workers - Number of worker threads.
+        maxsize - Maximum number of waiting items per worker queue.'''
+
+    def __init__(self, workers=4, maxsize=100, name="dispatcher"):
+        '''Dispatcher constructor. Worker threads are started straight away.
+
+        Args:
+            [optional] workers (int) - Number of worker threads. (default: 4)
+            [optional] maxsize (int) - Maximum number of waiting items per worker. (default: 100)
+            [optional] name (str) - Prefix for the worker thread names.'''
+
+        self.workers = max(int(workers), 1)
+        self.maxsize = max(int(maxsize), 1)
+        self.__queues = [Queue.Queue(self.maxsize) for _ in xrange(self.workers)]
+        self.__lock = threading.Lock()
+        self.__counters = {'queued':0, 'completed':0, 'failed':0, 'rejected':0, 'blocked':0, 'peakdepth':0}
+        self.__threads = []
+
+        for i, queue in enumerate(self.__queues):
+            thread = threading.Thread(target=self.__work, args=(queue,), name="{0}-{1}".format(name, i))
+            thread.daemon = True
+            thread.start()
+            self.__threads.append(thread)
+
+    def put(self, key, function, *args, **kwargs):
+        '''Queue a call to function(*args, **kwargs) behind any earlier work for the same key.
+
+        Blocks while the key's worker queue is full.
+
+        Args:
+            key - Hashable value work is serialised on, e.g. a member ID.
+            function - Callable to run.
+            *args, **kwargs - Arguments for the callable.
+            [optional] timeout (float) - Seconds to wait for queue space before giving up. (default: wait forever)
+
+        Exceptions:
+            QueueFull - Raised if there was no queue space within the timeout.'''
+
+        timeout = kwargs.pop('timeout', None)
+        queue = self.__queues[hash(key) % self.workers]
+
+        if queue.full():
+            self.__count('blocked') # Backpressure: the caller has to wait for this worker to catch up.
+
+        try:
+            queue.put((function, args, kwargs), True, timeout)
+        except QueueFull:
+            self.__count('rejected')
+            log.warning("Work queue for key {0} is full ({1} waiting), rejecting work.".format(key, self.maxsize))
+            raise
+
+        with self.__lock:
+            self.__counters['queued'] += 1
+            self.__counters['peakdepth'] = max(self.__counters['peakdepth'], queue.qsize())
+
+    def depth(self):
+        '''Return the total number of items waiting across all worker queues.'''
+        return sum(queue.qsize() for queue in self.__queues)
+
+    def stats(self):
+        '''Return a dict of queue metrics.
+
+        Keys:
+            depth - Items currently waiting. depths - Items waiting per worker. peakdepth - Most items seen waiting
+            on one worker. queued/completed/failed - Work counters. blocked - Puts which had to wait for queue space.
+            rejected - Puts which timed out. workers, maxsize - Configuration.'''
+
+        with self.__lock:
+            stats = dict(self.__counters)
+
+        stats['depths'] = [queue.qsize() for queue in self.__queues]
+        stats['depth'] = sum(stats['depths'])
+        stats['workers'], stats['maxsize'] = self.workers, self.maxsize
+
+        return stats
+
+    def drain(self):
+        '''Block until all the work queued so far has been processed, e.g. before acting on the results of everything
+        already received. Work queued while waiting is waited for too.'''
+
+        for queue in self.__queues:
+            queue.join()
+
+    def close(self, wait=True):
+        '''Stop the workers once the work already queued has been processed.
+
+        Args:
+            [optional] wait (bool) - Block until the workers have exited. (default: True)'''
+
+        for queue in self.__queues:
+            queue.put(_STOP)
+
+        if wait:
+            for thread in self.__threads:
+                thread.join()
+
+    def __count(self, counter):
+        with self.__lock:
+            self.__counters[counter] += 1
+
+    def __work(self, queue):
+        while True:
+            item = queue.get()
+
+            if item is _STOP:
+                queue.task_done()
+                return
+
+            function, args, kwargs = item
+
+            try:
+                function(*args, **kwargs)
+                self.__count('completed')
+            except Exception:
+                self.__count('failed')
+                log.exception("Unhandled error processing queued work {0}.".format(getattr(function, '__name__', function)))
+            finally:
+                queue.task_done()
+
+
+class replyqueue:
+    '''Sends forum posts from a background thread, limiting the post rate and combining replies to the same thread.
+
+    A reply waits up to window seconds before it's sent. Replies to the same thread which arrive in the meantime are
+    added to the same post, as long as it stays within maxlength. Only the oldest waiting post for a thread is sent, so
+    a thread's posts keep their order, including while a failed post waits to be retried.
+
+    Attributes:
+        rate - Maximum number of posts sent per minute.
+        window - Seconds a reply is held for so later replies to its thread can be combined with it.
+        retries - Number of times a post which wasn't made is retried before it's dropped.
+        backoff - Seconds before the first retry of a failed post. Doubled for each further retry.
+        maxlength - Longest combined post body, or None for no limit.'''
+
+    def __init__(self, send, rate=20, window=5, retries=3, backoff=10, maxlength=None, separator="\n\n", combinedtitle=None, name="replies", retryable=undelivered):
+        '''Reply queue constructor. The sender thread is started straight away.
+
+        Args:
+            send - Callable making a post, called as send(thread, title, body), e.g. neo.postToForums.
+            [optional] rate (int) - Maximum posts per minute. (default: 20)
+            [optional] window (float) - Seconds replies are held for combining. 0 sends each reply alone. (default: 5)
+            [optional] retries (int) - Retries of a failed post. (default: 3)
+            [optional] backoff (float) - Seconds before the first retry. (default: 10)
+            [optional] maxlength (int) - Longest combined post body. (default: no limit)
+            [optional] separator (str) - Text placed between combined replies. (default: a blank line)
+            [optional] combinedtitle (str) - Title of a combined post whose replies have different titles. (default: the first title)
+            [optional] name (str) - Name of the sender thread.
+            [optional] retryable - Callable given the error of a failed post, returning True if the post certainly
+                wasn't made and can be retried. Other failed posts are dropped. (default: undelivered)'''
+
+        self.rate = max(int(rate), 1)
+        self.window = window
+        self.retries = retries
+        self.backoff = backoff
+        self.maxlength = maxlength
+        self.__send = send
+        self.__retryable = retryable
+        self.__separator = separator
+        self.__combinedtitle = combinedtitle
+        self.__pending = [] # Batches waiting to be sent, oldest first.
+        self.__nextsend = 0 # Earliest time the rate limit allows the next post.
+        self.__closed = False
+        self.__condition = threading.Condition()
+        self.__counters = {'queued':0, 'combined':0, 'sent':0, 'retried':0, 'failed':0}
+
+        self.__thread = threading.Thread(target=self.__work, name=name)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def post(self, thread, title, body, combine=True):
+        '''Queue a post, combining it with a reply already waiting for the same thread if possible.
+
+        Args:
+            thread - ID of the thread to post in.
+            title (str) - Post title.
+            body (str) - Post body.
+            [optional] combine (bool) - False makes the post by itself with its own title, without holding it for
+                combining, e.g. for announcements. It's still made after the posts already waiting for its thread. (default: True)'''
+
+        with self.__condition:
+            if self.__closed:
+                raise ValueError("Reply queue has been closed.")
+
+            self.__counters['queued'] += 1
+            batch = self.__lastBatch(thread) if combine else None
+
+            if batch is not None and (self.maxlength is None or batch['length'] + len(self.__separator) + len(body) <= self.maxlength):
+                batch['titles'].append(title)
+                batch['bodies'].append(body)
+                batch['length'] += len(self.__separator) + len(body)
+                self.__counters['combined'] += 1
+            else:
+                self.__pending.append({'thread':thread, 'titles':[title], 'bodies':[body], 'length':len(body), \
+                                       'due':time.time() + (self.window if combine else 0), 'attempts':0, 'combine':combine})
+                self.__condition.notify()
+
+    def depth(self):
+        '''Return the number of posts waiting to be sent.'''
+        with self.__condition:
+            return len(self.__pending)
+
+    def stats(self):
+        '''Return a dict of reply metrics.
+
+        Keys:
+            depth - Posts waiting to be sent. queued - Replies queued. combined - Replies added to another reply's post.
+            sent - Posts made. retried - Failed posts queued for another attempt. failed - Posts dropped, either because they
+            may have been made or because every retry failed.'''
+
+        with self.__condition:
+            stats = dict(self.__counters)
+            stats['depth'] = len(self.__pending)
+
+        return stats
+
+    def close(self, wait=True):
+        '''Send everything waiting without holding it for combining, then stop the sender. The rate limit still applies.
+
+        Args:
+            [optional] wait (bool) - Block until the waiting posts have been sent. (default: True)'''
+
+        with self.__condition:
+            self.__closed = True
+            self.__condition.notify()
+
+        if wait:
+            self.__thread.join()
+
+    def __lastBatch(self, thread):
+        # Only the newest waiting post for a thread is added to, so replies stay in the order they were made:
+        for batch in reversed(self.__pending):
+            if batch['thread'] == thread:
+                return batch if batch['combine'] and batch['attempts'] == 0 else None
+
+        return None
+
+    def __next(self):
+        # Wait for the next post which is due and allowed by the rate limit. Returns None once closed and empty.
+        with self.__condition:
+            while True:
+                if not self.__pending:
+                    if self.__closed:
+                        return None
+
+                    self.__condition.wait()
+                    continue
+
+                # Pending posts are kept in each thread's order, so only the first post for each thread can be sent:
+                heads = {}
+
+                for pending in self.__pending:
+                    heads.setdefault(pending['thread'], pending)
+
+                batch = min(heads.itervalues(), key=lambda pending: pending['due'])
+                now = time.time()
+                start = max(now if self.__closed and not batch['attempts'] else batch['due'], self.__nextsend)
+
+                if start <= now:
+                    self.__pending.remove(batch)
+                    self.__nextsend = now + 60.0 / self.rate
+                    return batch
+
+                self.__condition.wait(start - now)
+
+    def __work(self):
+        while True:
+            batch = self.__next()
+
+            if batch is None:
+                return
+
+            titles = batch['titles']
+            title = titles[0] if len(set(titles)) == 1 or self.__combinedtitle is None else self.__combinedtitle
+
+            try:
+                self.__send(batch['thread'], title, self.__separator.join(batch['bodies']))
+            except Exception as e:
+                with self.__condition:
+                    batch['attempts'] += 1
+
+                    if not self.__retryable(e):
+                        self.__counters['failed'] += 1
+                        log.exception("Post to thread {0} failed and may have been made, so it won't be retried.".format(batch['thread']))
+                    elif batch['attempts'] > self.retries:
+                        self.__counters['failed'] += 1
+                        log.exception("Giving up on post to thread {0} after {1} attempts.".format(batch['thread'], batch['attempts']))
+                    else:
+                        # Back at the front, ahead of any later posts to the same thread:
+                        self.__counters['retried'] += 1
+                        batch['due'] = time.time() + self.backoff * 2 ** (batch['attempts'] - 1)
+                        self.__pending.insert(0, batch)
+                        log.warning("Post to thread {0} failed (attempt {1} of {2}), retrying.".format(batch['thread'], batch['attempts'], self.retries + 1), exc_info=True)
+            else:
+                with self.__condition:
+                    self.__counters['sent'] += 1
@@ -2,35 +2,204 @@ import logging, re
 log = logging.getLogger(__name__)
 
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
+from classes.asyncneoraffle import asyncneoraffle
+from classes.neorafflequeue import keyeddispatcher, replyqueue
+from classes.neorafflepost import postwriter
+from classes.neorafflecache import lrucache
 from classes.neoraffle import neoraffle, UserAlreadyRegistered, MultipleValidationErrors, DoesNotExist, UserNotRegistered, InvalidAuctionType, UserCannotAffordItem, BidDoesNotExceedCurrentTopBid, UserAttemptToPurchaseOwnItem, UserAccountIsInactive
 
+# Scanner for the NeoRaffle commands and purchase lines in a line of a post. Alternatives are tried in order at each
+# position and a match consumes its text, so e.g. "NEORAFFLE BID 1 50" isn't also picked up as a "Bid 1 50" line:
+POSTSCANNER = re.compile("|".join([
+	"NEORAFFLE (?P<shorttype>BUY|BID) (?P<shortitem>\\d+?) (?P<shortamount>[0-9,]+)", # Single purchase commands.
+	"NEORAFFLE DELETE (?P<deletions>[0-9, ]+)", # Lot ID CSV.
+	"NEORAFFLE (?P<command>REGISTER|ITEM ADD|PURCHASE|BUY|BID|DELETE)",
+	"(?P<linetype>[Bb][Uu][Yy]|[Bb][Ii][Dd]):?\\s?#?(?P<lineitem>\\d+?) (?P<lineamount>[0-9,]+)", # Buy: ItemID Quantity, Bid: ItemID Pts
+]))
+
+# Item forms. A form starts at its header, wherever it is in a line, and ends at its Quantity line. Field labels only
+# count at the start of a line (after any indentation), and each field runs until the next label. See scanPost:
+FORMHEADERS = (("[b]RAFFLE ITEM[/b]", "RAFFLE"), ("[b]AUCTION ITEM[/b]", "AUCTION"))
+FORMLABELS = (("Item Title:", "title"), ("Item Description:", "description"), ("Ticket Price:", "price"), ("Quantity:", "quantity"))
+FORMFIELDNAMES = dict((field, label[:-1]) for label, field in FORMLABELS)
+FORMFIELDS = {"RAFFLE": ("title", "description", "price", "quantity"), "AUCTION": ("title", "description", "quantity")}
+
+def scanPost(postbody):
+	'''Find every NeoRaffle command, item form and purchase line in a post with one pass over its lines.
+	
+	Each line is looked at once, either as part of an item form or by the command scanner, so the time taken is linear
+	in the length of the post whatever it contains.
+	
+	Item forms are read as follows:
+		- A form starts at its header, e.g. "[b]RAFFLE ITEM[/b]", wherever it appears in a line, and ends at its
+		  Quantity line or at the next form header.
+		- Field labels such as "Ticket Price:" are only recognised at the start of a line, after any indentation. A
+		  label further along a line is just part of the text of the field before it.
+		- Everything outside a form is scanned for commands and purchase lines. That includes the text between one
+		  form's Quantity line and the next header, and any text before a header on the header's own line.
+	
+	Returns:
+		Dict:
+			{"commands" => Set of the NEORAFFLE commands found, e.g. "REGISTER", "ITEM ADD", "BID".
+			 "forms" => List of item form dicts in post order. Keys: type, title, description, price, quantity, errors.
+			            errors lists problems with the form's fields; the form should only be used if it's empty.
+			 "purchases" => List of (type, lot, amount) tuples in post order, type being "Buy" or "Bid" as written.
+			 "deletions" => Lot ID CSV from the first NEORAFFLE DELETE command, or None.}'''
+	
+	scan = {'commands':set(), 'forms':[], 'purchases':[], 'deletions':None}
+	form = None
+	
+	for line in postbody.splitlines():
+		if "ITEM[/b]" in line: # Quick check before looking for each form header.
+			for header, formtype in FORMHEADERS:
+				start = line.find(header)
+			
+				if start >= 0:
+					if form is not None:
+						scan['forms'].append(_finishForm(form))
+				
+					form = {'type':formtype, 'fields':{}, 'field':None, 'errors':[]}
+					line, before = line[start+len(header):], line[:start]
+					_scanLine(before, scan)
+					break
+		
+		if form is None:
+			_scanLine(line, scan)
+		elif _formLine(form, line):
+			scan['forms'].append(_finishForm(form))
+			form = None
+	
+	if form is not None:
+		scan['forms'].append(_finishForm(form))
+	
+	return scan
+
+def _scanLine(line, scan):
+	'''Add the commands and purchase lines in a line of a post outside of any item form to a scan.'''
+	for match in POSTSCANNER.finditer(line):
+		kind = match.lastgroup # Name of the last group of the alternative which matched.
+		
+		if kind == 'lineamount':
+			scan['purchases'].append(match.group('linetype', 'lineitem', 'lineamount'))
+		elif kind == 'shortamount':
+			scan['commands'].add(match.group('shorttype'))
+			scan['purchases'].append(match.group('shorttype', 'shortitem', 'shortamount'))
+		elif kind == 'deletions':
+			scan['commands'].add("DELETE")
+			if scan['deletions'] is None:
+				scan['deletions'] = match.group('deletions')
+		else:
+			scan['commands'].add(match.group('command'))
+
+def _formLine(form, line):
+	'''Add a line of a post to the item form it's part of. Returns True if the line ends the form.'''
+	stripped = line.lstrip()
+	
+	for label, field in FORMLABELS:
+		if stripped.startswith(label):
+			duplicate = "{0} was given more than once.".format(FORMFIELDNAMES[field])
+			
+			if field in form['fields'] and not duplicate in form['errors']:
+				form['errors'].append(duplicate)
+			
+			form['fields'][field] = [stripped[len(label):]]
+			form['field'] = field
+			
+			return field == "quantity"
+	
+	if form['field'] is not None: # Continuation of a multi-line field, e.g. the description.
+		form['fields'][form['field']].append(line)
+	
+	return False
+
+def _finishForm(form):
+	'''Return the fields of a parsed item form, with an error for each field that is missing, empty or not expected.'''
+	rtn = {'type':form['type'], 'title':None, 'description':None, 'price':None, 'quantity':None, 'errors':form['errors']}
+	
+	for field, lines in form['fields'].items():
+		if not field in FORMFIELDS[form['type']]:
+			rtn['errors'].append("{0} isn't used by {1} items.".format(FORMFIELDNAMES[field], form['type'].lower()))
+			continue
+		
+		rtn[field] = "\n".join(lines).strip()
+		
+		if not rtn[field]:
+			rtn['errors'].append("{0} is empty.".format(FORMFIELDNAMES[field]))
+	
+	for field in FORMFIELDS[form['type']]:
+		if not field in form['fields']:
+			rtn['errors'].append("{0} is missing.".format(FORMFIELDNAMES[field]))
+	
+	return rtn
+
 class raffleplugin():
 	MAXBONUS = 4 # Maximum number of items a user can earn bonus points for offering.
 	BONUSPTS = 250 # Number of bonus points given for each item offered in the raffle/auction.
+	NOTIFYWORKERS = 4 # Number of threads processing forum notifications.
+	NOTIFYQUEUESIZE = 100 # Notifications waiting per thread before the bot is made to wait.
+	MAXPOSTLENGTH = 50000 # Longest post body sent to the forums. Longer announcements are split over several posts.
+	RESOLVERCACHESIZE = 10000 # Usernames and notify strings remembered, to save repeating Neoseeker API lookups.
+	RESOLVERCACHETTL = 3600 # Seconds a remembered username or notify string is used for, in case a member is renamed.
+	REPLYRATE = 20 # Maximum forum posts made per minute.
+	REPLYWINDOW = 5 # Seconds a reply is held for so that other replies in the same thread can be combined into one post.
+	REPLYRETRIES = 3 # Number of times a forum post which failed to reach the forum is retried.
+	REPLYBACKOFF = 10 # Seconds before a failed forum post is first retried. Doubled for each further retry.
+	TRANSLATEWORKERS = 4 # Number of item markup to HTML translations made at once.
 	
 	def __init__(self, salemhook, neohook):
 		self.salem = salemhook
 		self.neo = neohook
 		self.raffle = neoraffle()
-		
+		self.asyncraffle = asyncneoraffle(self.raffle)
+		self.notifyqueue = keyeddispatcher(raffleplugin.NOTIFYWORKERS, raffleplugin.NOTIFYQUEUESIZE, name="neoraffle-notify")
+		self.replies = replyqueue(self.neo.postToForums, raffleplugin.REPLYRATE, raffleplugin.REPLYWINDOW, raffleplugin.REPLYRETRIES, raffleplugin.REPLYBACKOFF, \
+					raffleplugin.MAXPOSTLENGTH, combinedtitle="NeoRaffle Replies", name="neoraffle-replies")
+		self.notifybox = (None, []) # Registration stamp and notify strings of the registered users when last rendered.
+		self.usernames = lrucache(raffleplugin.RESOLVERCACHESIZE, raffleplugin.RESOLVERCACHETTL) # Member ID => username.
+		self.notifystrings = lrucache(raffleplugin.RESOLVERCACHESIZE, raffleplugin.RESOLVERCACHETTL) # Username => forum notify string.
+		self.translatepool = ThreadPool(raffleplugin.TRANSLATEWORKERS)
+		
+		if self.salem.getSalemConfig("NEORAFFLE_PHASE") == "bidding": # Restarted mid-bidding.
+			self.raffle.warmLotCache()
+			self.__warmUsernames()
+	
+	# Bot entry points. Handlers run on worker threads so slow DB calls don't hold up the bot. Notifications are
+	# queued per member so that each member's posts are processed in the order they were made, and in the phase
+	# they were made in:
 	def notificationHandler(self, apiPostInfo, apiMemberInfo):
-		curRafflePhase = self.salem.getSalemConfig("NEORAFFLE_PHASE")
+		phase = self.salem.getSalemConfig("NEORAFFLE_PHASE")
+		self.notifyqueue.put(apiMemberInfo['memberid'], self.processNotification, apiPostInfo, apiMemberInfo, phase)
+	
+	def ircHandler(self, irctarget, ircsource, ircmsg):
+		if ircmsg and ircmsg[0] == "@neoraffle":
+			return self.asyncraffle.submit(self.processIrcCommand, irctarget, ircsource, ircmsg)
+	
+	def die(self):
+		# Called when the plugin is unloaded. Work already queued is finished first, so that its replies are posted
+		# along with everything else waiting in the reply queue:
+		self.notifyqueue.close()
+		self.asyncraffle.close()
+		self.replies.close()
+		self.translatepool.close()
+		
+	def processNotification(self, apiPostInfo, apiMemberInfo, phase=None):
+		curRafflePhase = phase if phase is not None else self.salem.getSalemConfig("NEORAFFLE_PHASE")
 		
 		if apiPostInfo['thread']['threadid'] == self.salem.getSalemConfig("NEORAFFLE_THREAD"): # Only catch notifs from defined thread.
-			if curRafflePhase == "userreg" and "NEORAFFLE REGISTER" in apiPostInfo['body']:
+			scan = scanPost(apiPostInfo['body'].encode('ascii', errors='ignore'))
+			commands = scan['commands']
+			
+			if curRafflePhase == "userreg" and "REGISTER" in commands:
 				self.__registration(apiMemberInfo, apiPostInfo)
-			if curRafflePhase == "itemreg" and "NEORAFFLE ITEM ADD" in apiPostInfo['body']:
-				self.__itemaddition(apiMemberInfo, apiPostInfo)
-			if curRafflePhase == "bidding" and "NEORAFFLE PURCHASE" in apiPostInfo['body']:
-				self.__purchasing(apiMemberInfo, apiPostInfo)
-			if curRafflePhase == "bidding" and "NEORAFFLE BID" in apiPostInfo['body']:
-				self.__purchasing(apiMemberInfo, apiPostInfo, shortMethod=True)
-			if curRafflePhase == "bidding" and "NEORAFFLE BUY" in apiPostInfo['body']:
-				self.__purchasing(apiMemberInfo, apiPostInfo, shortMethod=True)
-			if curRafflePhase == "itemreg" and "NEORAFFLE DELETE" in apiPostInfo['body']:
-				self.__userdeleteitem(apiMemberInfo, apiPostInfo)
+			if curRafflePhase == "itemreg" and "ITEM ADD" in commands:
+				self.__itemaddition(apiMemberInfo, apiPostInfo, scan)
+			if curRafflePhase == "bidding" and commands & set(["PURCHASE", "BID", "BUY"]): # Purchase lines and single purchase commands are handled together.
+				self.__purchasing(apiMemberInfo, apiPostInfo, scan)
+			if curRafflePhase == "itemreg" and "DELETE" in commands:
+				self.__userdeleteitem(apiMemberInfo, apiPostInfo, scan)
 	
-	def ircHandler(self, irctarget, ircsource, ircmsg):
+	def processIrcCommand(self, irctarget, ircsource, ircmsg):
 		try:
 			if ircmsg[0] == "@neoraffle":
 				if ircmsg[1] == "phase":
@@ -43,28 +212,30 @@ class raffleplugin():
 					self.__editItem(irctarget, ircmsg)
 				elif ircmsg[1] == "currency":
 					self.__usercurrency(irctarget, ircmsg)
+				elif ircmsg[1] == "stats":
+					self.__stats(irctarget)
 				else:
-					self.salem.send_message(irctarget, "** [06NeoRaffle] Invalid option! Available options: currency <user> [newcurrency], thread <id>, phase <off/userreg/itemreg/bidding/winners>, delete <id>, edit <id> <params>")
+					self.salem.send_message(irctarget, "** [06NeoRaffle] Invalid option! Available options: currency <user> [newcurrency], thread <id>, phase <off/userreg/itemreg/bidding/winners>, delete <id>, edit <id> <params>, stats")
 		except IndexError:
-			self.salem.send_message(irctarget, "** [06NeoRaffle] Initilized database successfully. Available options: currency <user> [newcurrency], thread <id>, phase <off/userreg/itemreg/bidding/winners>, delete <id>, edit <id> <params>")
+			self.salem.send_message(irctarget, "** [06NeoRaffle] Initilized database successfully. Available options: currency <user> [newcurrency], thread <id>, phase <off/userreg/itemreg/bidding/winners>, delete <id>, edit <id> <params>, stats")
 		except:
 			log.exception("Unknown error from IRC command.")
 			self.salem.send_message(irctarget, "** [06NeoRaffle] Unknown error occurred in NeoRaffle IRC handler.")
 		
 	# Notification processes:
 	def __registration(self, apiMemberInfo, apiPostInfo):
-		notifyUser = self.neo.getForumNotifyStringForUsername(apiMemberInfo['username'])
+		notifyUser = self.__notifyString(apiMemberInfo['username'])
 		
 		try:
 			res = self.raffle.handleNeoraffleRegistration(apiMemberInfo['memberid'], apiMemberInfo['username'], \
 											apiMemberInfo['neopoints'], apiMemberInfo['gamegreppoints'], apiMemberInfo['forum_msgs_count'], apiMemberInfo['wikiedits_count'])
 		except UserAlreadyRegistered:
 			output = "Hi {0}.\n\nI detected you're trying to register in your post ({1}), but we already have a record for you in the Neo Raffle DB. You are already registered and your account is ready to participate. :)".format(notifyUser, apiPostInfo['messageid'])
-			self.neo.postToForums(apiPostInfo['thread']['threadid'], "NeoRaffle Registration: Already Registered!", output)
+			self.replies.post(apiPostInfo['thread']['threadid'], "NeoRaffle Registration: Already Registered!", output)
 			return
 		except:
 			output = "Hi {0}\n\nAn unknown error occurred when attempting to register your account from post: {1}.  Sorry. :(\n\n@Dynamite should fix me!".format(notifyUser, apiPostInfo['messageid'])
-			self.neo.postToForums(apiPostInfo['thread']['threadid'], "NeoRaffle Registration: Error!", output)
+			self.replies.post(apiPostInfo['thread']['threadid'], "NeoRaffle Registration: Error!", output)
 			log.exception("Unknown error from NeoRaffle user registration handler!")
 			return
 		
@@ -77,13 +248,12 @@ class raffleplugin():
 			output += "[li][b]Wiki Points[/b]: {0}\n".format(res['wikipts'])
 			output += "[/ul]"
 			
-			self.neo.postToForums(apiPostInfo['thread']['threadid'], "NeoRaffle Registration for {0}".format(apiMemberInfo['username']), output)
+			self.replies.post(apiPostInfo['thread']['threadid'], "NeoRaffle Registration for {0}".format(apiMemberInfo['username']), output)
 			return True
 	
-	def __itemaddition(self, apiMemberInfo, apiPostInfo):
-		notifyUser = self.neo.getForumNotifyStringForUsername(apiMemberInfo['username'])
-		postbody = apiPostInfo['body'].encode('ascii', errors='ignore')
-		log.debug("Post body received for NeoRaffle item addition: {0}".format(postbody))
+	def __itemaddition(self, apiMemberInfo, apiPostInfo, scan):
+		notifyUser = self.__notifyString(apiMemberInfo['username'])
+		log.debug("Post body received for NeoRaffle item addition: {0}".format(apiPostInfo['body'].encode('ascii', errors='ignore')))
 		
 		# Check if user is registered first.  If they are not, create an inactive user account for them:
 		if not self.raffle.isUserRegistered(apiMemberInfo['memberid']):
@@ -91,141 +261,114 @@ class raffleplugin():
 											   apiMemberInfo['neopoints'], apiMemberInfo['gamegreppoints'], \
 											   apiMemberInfo['forum_msgs_count'], apiMemberInfo['wikiedits_count'], isactive=False)
 		
-		extractedForms = []
+		extractedForms = scan['forms']
+		log.debug("Item forms found: {0}".format(extractedForms))
 		
-		# Regex for form and individual item acquisition:
-		raffleFormRegex = re.compile("\[b\]RAFFLE ITEM\[\/b\].+?Quantity:\s?[^\n]+\n?", re.DOTALL)		
-		raffleItemRegex = re.compile("\[b\](?P<type>RAFFLE) ITEM\[\/b\].+?Item Title:\s?(?P<title>.+?)\nItem Description:\s?(?P<description>.+?)Ticket Price:\s?(?P<price>.+?)Quantity:\s?(?P<quantity>[^\n]+)", re.DOTALL)
-		
-		# Auction items:
-		auctionFormRegex = re.compile("\[b\]AUCTION ITEM\[\/b\].+?Quantity:\s?[^\n]+\n?", re.DOTALL)
-		auctionItemRegex = re.compile("\[b\](?P<type>AUCTION) ITEM\[\/b\].+?Item Title:\s?(?P<title>.+?)\nItem Description:\s?(?P<description>.+?)Quantity:\s?(?P<quantity>[^\n]+)", re.DOTALL)
-		
-		# Find all instances of raffle item forms in the post and return each as a list element:
-		raffleForms = raffleFormRegex.findall(postbody)
-		log.debug("Raffle forms found: {0}".format(raffleForms))
-		
-		# ... and auction forms:
-		auctionForms = auctionFormRegex.findall(postbody)
-		log.debug("Auction forms found: {0}".format(auctionForms))
-		
-		if not raffleForms and not auctionForms: # User has requested item addition, but no forms were found in the post.
-			output = "Hi {0}.\n\nI was unable to find any valid forms in your post ({1}). Please ensure you copy/paste the code for the form exactly and do not modify it. You should also ensure you use numeric values where appropriate.".format(notifyUser, apiPostInfo['messageid'])
+		if not extractedForms: # User has requested item addition, but no forms were found in the post.
+			output = "Hi {0}.\n\nI was unable to find any valid forms in your post ({1}). Please ensure you copy/paste the code for the form exactly and do not modify it. Each field (Item Title:, Item Description:, Ticket Price:, Quantity:) must start on a new line. You should also ensure you use numeric values where appropriate.".format(notifyUser, apiPostInfo['messageid'])
 			log.error("User {0} requested NeoRaffle item addition from post {1}, but no valid forms were found!".format(apiMemberInfo['username'], apiPostInfo['messageid']))
-			self.neo.postToForums(apiPostInfo['thread']['threadid'], "NeoRaffle Item Addition: Error", output)
+			self.replies.post(apiPostInfo['thread']['threadid'], "NeoRaffle Item Addition: Error", output)
 			return
 	
-		# Now to extract each element in the form:
-		for form in raffleForms:
-			itemMatch = raffleItemRegex.search(form) # G1: type, G2: title, G3: description, G4: price, G5: quantity.
-			extractedForms.append(itemMatch.groupdict()) # Add the match dict to the list.
+		# Translate the markup of every readable form together, then add them all in one go:
+		items = []
 		
-		for form in auctionForms:
-			itemMatch = auctionItemRegex.search(form) # G1: type, G2: title, G3: description, G4: quantity
-			extractedForms.append(itemMatch.groupdict())
+		for extractedData in extractedForms:
+			extractedData['listtype'] = 1 if extractedData['type'] == "RAFFLE" else 2
+			
+			if not extractedData['errors']:
+				items.append({'title':extractedData['title'], 'description':extractedData['description'], 'price':extractedData['price'], \
+						'quantity':extractedData['quantity'], 'type':extractedData['listtype']})
+		
+		html = self.__translateMarkup([item[field] for item in items for field in ('title', 'description')])
+		
+		for item in items: # Items whose markup couldn't be translated are still added, just without the HTML.
+			item['htmltitle'], item['htmldescription'] = html.pop(0), html.pop(0)
 		
 		output = "Hi {0}.  I'm processing the following forms from your post ({1}):\n\n".format(notifyUser, apiPostInfo['messageid'])
+		
+		try:
+			res = self.raffle.addItemsToDatabase(apiMemberInfo['memberid'], items, bonuspts=raffleplugin.BONUSPTS, maxbonus=raffleplugin.MAXBONUS)['items'] if items else []
+		except:
+			output += "Fatal error attempting to add items from post {0}. :(  @Dynamite should fix me.".format(apiPostInfo['messageid'])
+			log.exception("An error occurred when attempting to add items to the auction database!")
+			self.replies.post(apiPostInfo['thread']['threadid'], "NeoRaffle Item Addition for {0}".format(apiMemberInfo['username']), output)
+			return
+		
 		for i, extractedData in enumerate(extractedForms):
 			output += "[b][u]Form: {0} ({1})[/u][/b]\n\n".format(i+1, extractedData['type'])
 			
-			if extractedData['type'] == "RAFFLE":
-				listtype = 1
-			elif extractedData['type'] == "AUCTION":
-				listtype = 2
-				extractedData['price'] = None # Price isn't specified in auctions, set it to null for the DB call.
+			if extractedData['errors']: # The form itself couldn't be read, so it wasn't added.
+				output += "There was a problem reading this form from your post ({0}). Remember that each field must start on a new line. The following errors were detected:\n\n[ul]".format(apiPostInfo['messageid'])
+				for err in extractedData['errors']:
+					output += "[li] {0}".format(err)
+				output += "[/ul]\n\n"
+				continue
 			
-			try:				
-				htmltitle = self.neo.translateMarkupToHtml(extractedData['title'])
-				htmlbody = self.neo.translateMarkupToHtml(extractedData['description'])
-				
-				res = self.raffle.addItemToDatabase(apiMemberInfo['memberid'], extractedData['title'], extractedData['description'], \
-											extractedData['price'], extractedData['quantity'], itemtype=listtype, htmltitle=htmltitle, htmldescription=htmlbody)
-				
-				tnum = self.raffle.getNumOwnedItems(apiMemberInfo['memberid'])
-				
-				if res:
-					output += "[color=green][b]Item was successfully added as a [i]{0}[/i] lot![/b][/color]\n\n".format("raffle" if listtype == 1 else "auction")
-					output += "[size=4][b]Lot Number: [color=red]{0}[/color][/b][/size]\n\n[ul]".format(res)
-					output += "[li][b]Item[/b]: {0}".format(extractedData['title'])
-					output += "[li][b]Description[/b]: {0}".format(extractedData['description'])
-					if listtype == 1:
-						output += "[li][b]Price[/b]: {0}".format(extractedData['price'])
-					output += "[li][b]Quantity[/b]: {0}".format(extractedData['quantity'])
-					output += "[/ul]\n\n"
-					
-					# Add a bonus of +250 points to user up to the first 4 items added (max 1,000):
-					if tnum <= raffleplugin.MAXBONUS:						
-						self.raffle.setUserAvailableCurrency(apiMemberInfo['memberid'], delta=raffleplugin.BONUSPTS)
-						
-						output += "[b]Note[/b]: You have been credited with +[b]{}[/b] bonus points for offering an item. You've earned [b]{}[/b] of a maximum [b]{}[/b] bonuses for offering items.\n\n".format(raffleplugin.BONUSPTS, raffleplugin.BONUSPTS*tnum, raffleplugin.BONUSPTS*raffleplugin.MAXBONUS)
-			except MultipleValidationErrors as e:
+			added = res.pop(0)
+			
+			if added['error']:
 				output += "There was a problem processing the form from your post ({0}).  The following errors were detected:\n\n[ul]".format(apiPostInfo['messageid'])
-				for err in e:
+				for err in added['error']:
 					output += "[li] {0}".format(err)
 				output += "[/ul]\n\n"
-			except:
-				output += "Fatal error attempting to add item from post {0}. :(  @Dynamite should fix me.".format(apiPostInfo['messageid'])
-				log.exception("An error occurred when attempting to add an item to the auction database!")
+				continue
 			
-		if output:
-			self.neo.postToForums(apiPostInfo['thread']['threadid'], "NeoRaffle Item Addition for {0}".format(apiMemberInfo['username']), output)
+			output += "[color=green][b]Item was successfully added as a [i]{0}[/i] lot![/b][/color]\n\n".format("raffle" if extractedData['listtype'] == 1 else "auction")
+			output += "[size=4][b]Lot Number: [color=red]{0}[/color][/b][/size]\n\n[ul]".format(added['lot'])
+			output += "[li][b]Item[/b]: {0}".format(extractedData['title'])
+			output += "[li][b]Description[/b]: {0}".format(extractedData['description'])
+			if extractedData['listtype'] == 1:
+				output += "[li][b]Price[/b]: {0}".format(extractedData['price'])
+			output += "[li][b]Quantity[/b]: {0}".format(extractedData['quantity'])
+			output += "[/ul]\n\n"
 			
-	def __purchasing(self, apiMemberInfo, apiPostInfo, shortMethod=False):
-		notifyUser = self.neo.getForumNotifyStringForUsername(apiMemberInfo['username'])
-		postbody = apiPostInfo['body'].encode('ascii', errors='ignore')
-				
-		extractedBids = []
-
-		buyRegex = re.compile("(?P<type>Buy):?\s?#?(?P<item>\d+?) (?P<quantity>[0-9,]+)", re.IGNORECASE) # ItemID, Quantity
-		bidRegex = re.compile("(?P<type>Bid):?\s?#?(?P<item>\d+?) (?P<bid>[0-9,]+)", re.IGNORECASE) # ItemID, Bid (Pts)
-		
-		# Find all instances of bids in the post and return each as a list element:
-		raffleBids = buyRegex.findall(postbody)
-		auctionBids = bidRegex.findall(postbody)
-		
-		# Added for convenience for single purchases:
-		if shortMethod is True:
-			buyShortRegex = re.compile("NEORAFFLE BUY (?P<item>\d+?) (?P<quantity>[0-9,]+)")
-			bidShortRegex = re.compile("NEORAFFLE BID (?P<item>\d+?) (?P<bid>[0-9,]+)")
+			# A bonus of +250 points is given for each of the user's first 4 items (max 1,000):
+			if added['bonus']:
+				output += "[b]Note[/b]: You have been credited with +[b]{}[/b] bonus points for offering an item. You've earned [b]{}[/b] of a maximum [b]{}[/b] bonuses for offering items.\n\n".format(added['bonus'], raffleplugin.BONUSPTS*added['owneditems'], raffleplugin.BONUSPTS*raffleplugin.MAXBONUS)
 			
-			shortBuys = buyShortRegex.search(postbody)
-			shortBids = bidShortRegex.search(postbody)
+		if output:
+			self.replies.post(apiPostInfo['thread']['threadid'], "NeoRaffle Item Addition for {0}".format(apiMemberInfo['username']), output)
 			
-			try:
-				if shortBuys:
-					raffleBids.append(["Buy", shortBuys.group('item'), shortBuys.group('quantity')])
-				if shortBids:
-					auctionBids.append(["Bid", shortBids.group('item'), shortBids.group('bid')])
-			except (AttributeError, IndexError):
-				pass # There were inconsistencies with the group names/data extracted, just let it pass and it'll be handled below.
-				
-		
-		if not raffleBids and not auctionBids: # No bids found:
+	def __purchasing(self, apiMemberInfo, apiPostInfo, scan):
+		notifyUser = self.__notifyString(apiMemberInfo['username'])
+		extractedBids = scan['purchases'] # Buy/Bid lines and NEORAFFLE BUY/BID commands, in post order.
+
+		if not extractedBids: # No bids found:
 			output = "Hi {0}.\n\nI was unable to find any bids in your post ({1}). Please check the first post again and ensure you use the correct format!".format(notifyUser, apiPostInfo['messageid'])
 			log.error("User {0} requested NeoRaffle bid post {1}, but no valid bids were found!".format(apiMemberInfo['username'], apiPostInfo['messageid']))
-			self.neo.postToForums(apiPostInfo['thread']['threadid'], "NeoRaffle Bid: Error", output)
+			self.replies.post(apiPostInfo['thread']['threadid'], "NeoRaffle Bid: Error", output)
 			return
 		
-		extractedBids = raffleBids + auctionBids
+		purchases = [("auction" if extractedData[0].upper() == "BID" else "raffle", extractedData[1], extractedData[2]) for extractedData in extractedBids]
 			
 		output = "Hi {0}.  I'm processing the following bids from your post ({1}):\n\n".format(notifyUser, apiPostInfo['messageid'])
-		for i, extractedData in enumerate(extractedBids):
+		
+		try:
+			res = self.raffle.makePurchases(apiMemberInfo['memberid'], purchases)
+		except UserNotRegistered:
+			output = "[color=red][b]Error[/b][/color]: Unfortunately, {0}, you do not appear to be registered with the NeoRaffle system. You may only bid on items if you registered during stage 1 of the annual raffle event.".format(notifyUser)
+			self.replies.post(apiPostInfo['thread']['threadid'], "NeoRaffle Bid: Error", output)
+			return
+		except UserAccountIsInactive:
+			output += "[color=red][b]Error[/b][/color]: {0}, your user account is not eligible to participate in purchasing. You must have registered with the NeoRaffle system during phase 1 in order to be able to purchase items. ".format(notifyUser)
+			self.replies.post(apiPostInfo['thread']['threadid'], "NeoRaffle Bid: Error", output)
+			return
+		except:
+			log.exception("Unknown error when attempting to process purchases")
+			output += "[color=red][b]Error[/b]: An unknown error occurred when attempting to record your purchases. @Dynamite should fix me. :("
+			self.replies.post(apiPostInfo['thread']['threadid'], "NeoRaffle Bid: Error", output)
+			return
+		
+		for i, (extractedData, purchase) in enumerate(zip(extractedBids, res['purchases'])):
 			rtn = None
 			output += "[b][u]Purchase {0} ({1} on lot {2})[/u][/b]\n\n".format(i+1, extractedData[0], extractedData[1])
 			
 			try:
-				if extractedData[0].upper() == "BID":
-					rtn = self.raffle.makePurchase("auction", apiMemberInfo['memberid'], extractedData[1], bid=extractedData[2])  
-				elif extractedData[0].upper() == "BUY":
-					rtn = self.raffle.makePurchase("raffle", apiMemberInfo['memberid'], extractedData[1], quantity=extractedData[2])
-			except UserNotRegistered:
-				output = "[color=red][b]Error[/b][/color]: Unfortunately, {0}, you do not appear to be registered with the NeoRaffle system. You may only bid on items if you registered during stage 1 of the annual raffle event.".format(notifyUser)
-				self.neo.postToForums(apiPostInfo['thread']['threadid'], "NeoRaffle Bid: Error", output)
-				return
-			except UserAccountIsInactive:
-				output += "[color=red][b]Error[/b][/color]: {0}, your user account is not eligible to participate in purchasing. You must have registered with the NeoRaffle system during phase 1 in order to be able to purchase items. ".format(notifyUser)
-				self.neo.postToForums(apiPostInfo['thread']['threadid'], "NeoRaffle Bid: Error", output)
-				return
+				if purchase['error']:
+					raise purchase['error']
+				
+				rtn = purchase['result']
 			except DoesNotExist:
 				output += "[color=red][b]Error[/b][/color]: The lot number you specified ({0}) was not found in the items database! Please check and try again.".format(extractedData[1])
 			except ValueError as e:
@@ -249,7 +392,7 @@ class raffleplugin():
 				if extractedData[0].upper() == "BID":
 					try:
 						if rtn['prevtopbidder']['userid']:
-							prevbiddernotify = self.neo.getForumNotifyStringForUsername(self.neo.getMemberIdFromUsernameOrId(rtn['prevtopbidder']['userid']))
+							prevbiddernotify = self.__notifyString(self.__username(rtn['prevtopbidder']['userid']))
 							prevtopbid = rtn['prevtopbidder']['amount']
 					except:
 						log.exception("Error occurred when attempting to get previous bidder to notify!")
@@ -264,25 +407,18 @@ class raffleplugin():
 					output += "[color=green][b]Raffle Purchase Successful![/b][/color] You have successfully bought [b]{}[/b] tickets for lot {} ([http://raffle.pwnsu.com/items/{}/ {}]) at the cost of [b]{}[/b] per ticket, totalling [b]{}[/b].".format(extractedData[2], rtn['iteminfo']['lotnum'], rtn['iteminfo']['lotnum'], rtn['iteminfo']['title'], rtn['costinfo']['ticketprice'], rtn['costinfo']['totalcost'])
 			
 			output += "\n\n"
-		output += "You have [color=red][b]{0}[/b][/color] points remaining.".format(self.raffle.getUserAvailableCurrency(apiMemberInfo['memberid']))
-		self.neo.postToForums(apiPostInfo['thread']['threadid'], "NeoRaffle Purchase", output)
+		output += "You have [color=red][b]{0}[/b][/color] points remaining.".format(res['availablecurrency'])
+		self.replies.post(apiPostInfo['thread']['threadid'], "NeoRaffle Purchase", output)
 		
-	def __userdeleteitem(self, apiMemberInfo, apiPostInfo):	 
-		notifyUser = self.neo.getForumNotifyStringForUsername(apiMemberInfo['username'])
-		postbody = apiPostInfo['body'].encode('ascii', errors='ignore')
-				
-		deletions = ""
-		delRegex = re.compile("NEORAFFLE DELETE (?P<item>[0-9, ]+)") # Lot ID CSV.
-		
-		# Find all instances of bids in the post and return each as a list element:
-		deletions = delRegex.search(postbody)
+	def __userdeleteitem(self, apiMemberInfo, apiPostInfo, scan):	 
+		notifyUser = self.__notifyString(apiMemberInfo['username'])
+		deletions = scan['deletions'] # Lot ID CSV.
 		
 		if not deletions: # No deletions found.
 			output = "Hi {0}.\n\nI was unable to find any specified items to delete in your post ({1}). Please check the first post again and ensure you use the correct format!".format(notifyUser, apiPostInfo['messageid'])
-			self.neo.postToForums(apiPostInfo['thread']['threadid'], "NeoRaffle Deletion: Error", output)
+			self.replies.post(apiPostInfo['thread']['threadid'], "NeoRaffle Deletion: Error", output)
 			return
 		
-		deletions = deletions.group('item')
 		deletions.replace(' ','')
 		deletions = deletions.split(',')
 			
@@ -298,7 +434,7 @@ class raffleplugin():
 				
 				# Remove bonus points given for adding items which were awarded them
 				if numitems <= raffleplugin.MAXBONUS: 
-					self.raffle.setUserAvailableCurrency(apiMemberInfo['memberid'], delta=raffleplugin.BONUSPTS - raffleplugin.BONUSPTS*2)
+					self.raffle.setUserAvailableCurrency(apiMemberInfo['memberid'], delta=raffleplugin.BONUSPTS - raffleplugin.BONUSPTS*2, entrytype='itembonus', itemid=int(deletion))
 					output += " Note: {} bonus points removed for adding this item!".format(raffleplugin.BONUSPTS)
 			except DoesNotExist:
 				output += "[li] Item {0} was not found in the DB!".format(deletion)
@@ -309,7 +445,7 @@ class raffleplugin():
 				output += "[li] Item {0} doesn't belong to you! You can't delete it!".format(deletion)
 		
 		output += "[/ul]"	
-		self.neo.postToForums(apiPostInfo['thread']['threadid'], "NeoRaffle Deletion", output)
+		self.replies.post(apiPostInfo['thread']['threadid'], "NeoRaffle Deletion", output)
 	
 	# IRC command processes:
 	def __configRaffleThread(self, channel, ircmsg):
@@ -328,16 +464,8 @@ class raffleplugin():
 	def __changePhase(self, channel, ircmsg):
 		thread = self.salem.getSalemConfig("NEORAFFLE_THREAD")
 		curphase = self.salem.getSalemConfig("NEORAFFLE_PHASE")
+		post = postwriter(raffleplugin.MAXPOSTLENGTH)
 		
-		raffleusers = self.raffle.fetchRegisteredUsers()
-		
-		# Build notification box:
-		notifybox = "[spoiler=Notification for Raffle Users]"
-		
-		for user in raffleusers:
-			notifybox += "{0} ".format(self.neo.getForumNotifyStringForUsername(user))
-		notifybox += "[/spoiler]"
-			
 		try:
 			newphase = ircmsg[2]
 		except IndexError:
@@ -355,82 +483,198 @@ class raffleplugin():
 		# Phase sets begin:	
 		if newphase == "off":
 			self.salem.setSalemConfig("NEORAFFLE_PHASE", "off")
+			self.raffle.clearLotCache()
 			
 			posttopic = "NeoRaffle Disabled!"
 			
-			output = "The NeoRaffle system has been disabled at [date]{0}[/date]!\n\nWe're not presently \
-			processing NeoRaffle operations at this time.".format(datetime.strftime(datetime.now(),'%Y-%m-%d %H:%M:%S'))
+			post.write("The NeoRaffle system has been disabled at [date]{0}[/date]!\n\nWe're not presently \
+			processing NeoRaffle operations at this time.".format(datetime.strftime(datetime.now(),'%Y-%m-%d %H:%M:%S')))
 		
 		elif newphase == "userreg":
 			self.salem.setSalemConfig("NEORAFFLE_PHASE", "userreg")
+			self.raffle.clearLotCache()
 			
 			posttopic = "Now Accepting User Registrations!"
 			
-			output = "The NeoRaffle user registration phase has begun at [date]{0}[/date]!\n\nDuring this phase of the raffle, \
+			post.write("The NeoRaffle user registration phase has begun at [date]{0}[/date]!\n\nDuring this phase of the raffle, \
 			users will be able to register with the system using the command in the opening post. Registering \
 			will record your available points total to spend in the raffle from a combination of your post count, \
 			NeoPoints, GameGrep points and NeoWiki edits.\n\nUser registration will close at the date specified in the opening \
 			post. Please note that users who have not registered before the deadline [b]will not[/b] be eligible \
-			to participate in this year's raffle!".format(datetime.strftime(datetime.now(),'%Y-%m-%d %H:%M:%S'))
+			to participate in this year's raffle!".format(datetime.strftime(datetime.now(),'%Y-%m-%d %H:%M:%S')))
 			
 		elif newphase == "itemreg":
 			self.salem.setSalemConfig("NEORAFFLE_PHASE", "itemreg")
+			self.raffle.clearLotCache()
 			
 			posttopic = "Now Accepting Item Registrations!"
 			
-			output = "The NeoRaffle item registration phase has begun at [date]{0}[/date]!\n\nDuring this phase, users are \
+			post.write("The NeoRaffle item registration phase has begun at [date]{0}[/date]!\n\nDuring this phase, users are \
 			free to register items they wish to put up for raffle or auction following the guidelines within the opening \
-			post.\n\n{1}".format(datetime.strftime(datetime.now(),'%Y-%m-%d %H:%M:%S'), notifybox)
+			post.\n\n".format(datetime.strftime(datetime.now(),'%Y-%m-%d %H:%M:%S')))
+			self.__writeNotifyBox(post)
 			
 	
 		elif newphase == "bidding":
 			self.salem.setSalemConfig("NEORAFFLE_PHASE", "bidding")
+			self.raffle.warmLotCache() # Lots are fixed while bidding, so purchases can read them from memory.
+			self.__warmUsernames() # Outbid notices name the previous top bidder.
 			
 			posttopic = "Now Accepting Bids!"
 			
-			output = "The NeoRaffle bidding phase has begun at [date]{0}[/date]!\n\nDuring this time, you are free to spend \
+			post.write("The NeoRaffle bidding phase has begun at [date]{0}[/date]!\n\nDuring this time, you are free to spend \
 			your points by bidding on items and purchasing raffle tickets. Please see the opening post for details on how to \
-			go about that.\n\nHappy bidding!\n\n{1}".format(datetime.strftime(datetime.now(),'%Y-%m-%d %H:%M:%S'), notifybox)
+			go about that.\n\nHappy bidding!\n\n".format(datetime.strftime(datetime.now(),'%Y-%m-%d %H:%M:%S')))
+			self.__writeNotifyBox(post)
 			
 		elif newphase == "winners":
 			self.salem.setSalemConfig("NEORAFFLE_PHASE", "off")
 			
-			posttopic = "Winners Announced!"
-			
-			winners = self.raffle.pickWinners()
-			
-			output = "The NeoRaffle has been closed at [date]{0}[/date] and we are ready to announce the winners!\n\n \
-			They are as follows: \n[ul]\n".format(datetime.strftime(datetime.now(),'%Y-%m-%d %H:%M:%S'))
+			# Bids posted before the phase changed may still be queued or in progress. They're finished before the draw
+			# reads the tickets, so that nothing is charged for but left out of the draw:
+			self.notifyqueue.drain()
+			self.raffle.clearLotCache()
 			
-			for win in winners:
-				output += "[size=4][b]Lot {0} ({1}): [http://raffle.pwnsu.com/items/{2}/ {3}][/b][/size]\n".format(win['lot'], "Raffle" if win['type']==1 else "Auction", win['lot'], win['title'])
-				output += "[i]{}x {} by {}[/i]\n\n".format(win['quantity'], "Raffled" if win['type']==1 else "Auctioned", self.neo.getForumNotifyStringForUsername(win['from']))
-				
-				if len(win['winners']) == 0:
-					output += "No winners for this item. No-one {0} for it. :(\n\n".format("bought tickets" if win['type']==1 else "bidded")
-				else:
-					output += "[color=red][b]{0}[/b][/color]:\n[ul]".format("Winner" if len(win['winners']) < 2 else "Winners")
-					
-					for winner in win['winners']:
-						output += "{0}\n".format(self.neo.getForumNotifyStringForUsername(winner))
-					output += "[/ul]\n"
-				
-			output += "[/ul]\nThanks to everyone for participating! This is your raffle kitty signing out...\n\n{0}".format(notifybox)
+			# IRC commands run on the asyncraffle pool, so the draw doesn't hold up the bot and die() waits for it to
+			# finish. It's drawn in this process: drawLots won't fork worker processes while the bot's other threads
+			# are running, so DRAWPROCESSES only applies to the command line draw.
+			self.salem.send_message(channel, "** [06NeoRaffle] Phase set to {0}. Drawing winners, they will be posted once the draw completes.".format(newphase))
+			self.__announceWinners(channel, thread)
+			return
 		
 		else:
 			self.salem.send_message(channel, "** [06NeoRaffle] Invalid phase option specified. Must be: off, userreg, itemreg, bidding, winners")
 			return
 		
-		self.neo.postToForums(thread, "NeoRaffle Phase Change: {0}".format(posttopic), output)
+		self.__postAnnouncement(thread, posttopic, post)
 		self.salem.send_message(channel, "** [06NeoRaffle] Phase set to {0}.".format(newphase))	
 		
+	def __announceWinners(self, channel, thread):
+		posttopic = "Winners Announced!"
+		post = postwriter(raffleplugin.MAXPOSTLENGTH)
+		
+		try:
+			winners = self.raffle.pickWinners()
+		except:
+			log.exception("Error drawing NeoRaffle winners!")
+			self.salem.send_message(channel, "** [06NeoRaffle] An error occurred when drawing the winners! Nothing has been posted.")
+			return
+		
+		post.write("The NeoRaffle has been closed at [date]{0}[/date] and we are ready to announce the winners!\n\n \
+		They are as follows: \n".format(datetime.strftime(datetime.now(),'%Y-%m-%d %H:%M:%S')))
+		post.begin("[ul]\n", "[/ul]\n")
+		
+		for win in winners: # Each lot is written as one piece so that a split never falls within a lot.
+			lot = ["[size=4][b]Lot {0} ({1}): [http://raffle.pwnsu.com/items/{2}/ {3}][/b][/size]\n".format(win['lot'], "Raffle" if win['type']==1 else "Auction", win['lot'], win['title']),
+			       "[i]{}x {} by {}[/i]\n\n".format(win['quantity'], "Raffled" if win['type']==1 else "Auctioned", self.__notifyString(win['from']))]
+			
+			if len(win['winners']) == 0:
+				lot.append("No winners for this item. No-one {0} for it. :(\n\n".format("bought tickets" if win['type']==1 else "bidded"))
+			else:
+				lot.append("[color=red][b]{0}[/b][/color]:\n[ul]".format("Winner" if len(win['winners']) < 2 else "Winners"))
+				lot.extend("{0}\n".format(self.__notifyString(winner)) for winner in win['winners'])
+				lot.append("[/ul]\n")
+			
+			post.write("".join(lot))
+			
+		post.end()
+		post.write("Thanks to everyone for participating! This is your raffle kitty signing out...\n\n")
+		self.__writeNotifyBox(post)
+		
+		self.__postAnnouncement(thread, posttopic, post)
+		self.salem.send_message(channel, "** [06NeoRaffle] Winners for draw run {0} have been posted.".format(winners[0]['runid'] if winners else "-"))
+		
+	def __writeNotifyBox(self, post):
+		# The box mentions every registered user, so it's only re-rendered once registrations have changed:
+		stamp = self.raffle.getRegistrationStamp()
+		laststamp, notifystrings = self.notifybox
+		
+		if not stamp == laststamp:
+			notifystrings = ["{0} ".format(self.__notifyString(user)) for user in self.raffle.iterRegisteredUsers()]
+			self.notifybox = (stamp, notifystrings)
+		
+		post.begin("[spoiler=Notification for Raffle Users]", "[/spoiler]")
+		
+		for notifystring in notifystrings:
+			post.write(notifystring)
+		post.end()
+		
+	# Neoseeker API lookups, remembered for a while as they're repeated across posts and announcements:
+	def __username(self, userid):
+		username = self.usernames.get(self.__userKey(userid))
+		
+		if username is None:
+			username = self.neo.getMemberIdFromUsernameOrId(userid)
+			self.usernames.set(self.__userKey(userid), username)
+		
+		return username
+	
+	def __userKey(self, userid):
+		# Member IDs arrive as both ints and strings, e.g. from the DB and from IRC, so they're keyed as ints where possible:
+		try:
+			return int(userid)
+		except (TypeError, ValueError):
+			return str(userid)
+	
+	def __notifyString(self, username):
+		notifystring = self.notifystrings.get(username)
+		
+		if notifystring is None:
+			notifystring = self.neo.getForumNotifyStringForUsername(username)
+			self.notifystrings.set(username, notifystring)
+		
+		return notifystring
+	
+	def __translateMarkup(self, markups):
+		# Returns the HTML for each piece of markup, or None where it couldn't be translated. Markup translated before
+		# is read from the DB; the rest is translated concurrently and stored for next time. The stored translations
+		# only save API calls, so if the DB can't be used the markup is translated without them.
+		try:
+			html = self.raffle.fetchTranslations(markups)
+		except:
+			log.exception("Unable to read stored markup translations, translating it all.")
+			html = {}
+		
+		missing = list(set(markup for markup in markups if markup and not markup in html))
+		
+		if missing:
+			translated = dict(zip(missing, self.translatepool.map(self.__translateOne, missing)))
+			
+			try:
+				self.raffle.saveTranslations(translated)
+			except:
+				log.exception("Unable to store markup translations.")
+			
+			html.update(translated)
+		
+		return [html.get(markup) for markup in markups]
+	
+	def __translateOne(self, markup):
+		try:
+			return self.neo.translateMarkupToHtml(markup)
+		except:
+			log.exception("An error occurred when translating item markup to HTML!")
+			return None
+	
+	def __warmUsernames(self):
+		# Registered members' usernames are already in the users table, so they needn't be looked up one by one:
+		for userid, username in self.raffle.iterRegisteredUsers(uids=True):
+			self.usernames.set(self.__userKey(userid), username)
+		
+	def __postAnnouncement(self, thread, posttopic, post):
+		posts = post.posts()
+		
+		for i, body in enumerate(posts, 1):
+			part = " ({0}/{1})".format(i, len(posts)) if len(posts) > 1 else ""
+			self.replies.post(thread, "NeoRaffle Phase Change: {0}{1}".format(posttopic, part), body, combine=False)
+		
 	def __deleteItem(self, channel, ircmsg):
 		try:
 			res = self.raffle.deleteItem(ircmsg[2])
 			
 			# Refund bonus points from user if applicable:
 			if res['owneditems']+1 <= raffleplugin.MAXBONUS:
-				self.raffle.setUserAvailableCurrency(res['userid'], delta=raffleplugin.BONUSPTS - raffleplugin.BONUSPTS*2)
+				self.raffle.setUserAvailableCurrency(res['userid'], delta=raffleplugin.BONUSPTS - raffleplugin.BONUSPTS*2, entrytype='itembonus', itemid=int(ircmsg[2]))
 			
 			self.salem.send_message(channel, "** [06NeoRaffle] Item {0} has been deleted!".format(ircmsg[2]))
 		except DoesNotExist as e:
@@ -446,10 +690,11 @@ class raffleplugin():
 			# Build dictionary from input: title=hi whatever|description=this salemtest etc
 			params = dict((k.strip(), v.strip()) for k,v in(item.split('=') for item in command.split('|')))
 			
-			if "title" in params.keys():
-				params['htmltitle'] = self.neo.translateMarkupToHtml(params['title'])
-			if "description" in params.keys():
-				params['htmldescription'] = self.neo.translateMarkupToHtml(params['description'])
+			for field in ("title", "description"):
+				if field in params.keys():
+					# None if the new markup couldn't be translated. That clears the HTML rendered from the old markup
+					# rather than showing it next to the new text:
+					params['html' + field] = self.__translateMarkup([params[field]])[0]
 			
 			self.raffle.editItem(item, **params)
 			
@@ -462,6 +707,22 @@ class raffleplugin():
 			self.salem.send_message(channel, "** [06NeoRaffle] Invalid parameters specified! If you are trying to re-assign an item's owner, ensure who you're assigning it to is registered.")
 			
 	
+	def __stats(self, channel):
+		queue = self.notifyqueue.stats()
+		caches = self.raffle.getCacheStats()
+		
+		output = "** [06NeoRaffle] Notification queue: {0} waiting (peak {1} of {2} per worker), {3} processed, {4} failed, {5} waits for space, {6} rejected.".format( \
+					queue['depth'], queue['peakdepth'], queue['maxsize'], queue['completed'], queue['failed'], queue['blocked'], queue['rejected'])
+		replies = self.replies.stats()
+		caches['usernames'], caches['notifystrings'] = self.usernames.stats(), self.notifystrings.stats()
+		
+		output += " Cache hits: " + ", ".join("{0} {1}/{2}".format(name, caches[name]['hits'], caches[name]['hits'] + caches[name]['misses']) \
+					for name in ('users', 'lots', 'usernames', 'notifystrings')) + "."
+		output += " Replies: {0} waiting, {1} posted ({2} combined into other posts), {3} retried, {4} failed.".format(replies['depth'], \
+					replies['sent'], replies['combined'], replies['retried'], replies['failed'])
+		
+		self.salem.send_message(channel, output)
+	
 	def __usercurrency(self, channel, ircmsg):
 		try:
 			user = int(ircmsg[2])
@@ -482,7 +743,7 @@ class raffleplugin():
 		
 		try:
 			currency = self.raffle.getUserAvailableCurrency(user)
-			username = self.neo.getMemberIdFromUsernameOrId(user)
+			username = self.__username(user)
 		except UserNotRegistered:
 			self.salem.send_message(channel, "** [06NeoRaffle] User {0} was not registered in the DB.".format(user))
 			return
@@ -0,0 +1,465 @@
+'''
+Tests for the NeoRaffle DB module, run against a scratch SQLite DB (see tests/support.py):
+
+    python -m unittest discover -s tests -t .
+'''
+import logging, random, threading, time, unittest
+
+from tests import support
+from sqlalchemy import event
+from classes import neoraffle as module
+from classes.neoraffle import neoraffle, DoesNotExist, UserCannotAffordItem, BidDoesNotExceedCurrentTopBid
+
+
+class purchasetests(unittest.TestCase):
+    def setUp(self):
+        self.raffle = support.resetDatabase()
+        support.registerUsers(self.raffle, (1, 2, 3))
+        self.rafflelot = self.raffle.addItemToDatabase(1, "Raffle lot", "Description", "10", "1", 1)
+        self.auctionlot = self.raffle.addItemToDatabase(1, "Auction lot", "Description", None, "1", 2)
+
+    def testFailedLineIsRolledBack(self):
+        # A line failing after its hold was applied must not leave the hold behind:
+        def failingbid(**kwargs):
+            raise ValueError("Bid rejected after the hold was applied.")
+
+        available = self.raffle.getUserAvailableCurrency(2)
+        bids, module.Bids = module.Bids, failingbid
+
+        try:
+            res = self.raffle.makePurchases(2, [('raffle', self.rafflelot, '3'), ('auction', self.auctionlot, '50'), ('raffle', 999, '1')])
+        finally:
+            module.Bids = bids
+
+        self.assertEqual([line['error'].__class__ for line in res['purchases']], [type(None), ValueError, DoesNotExist])
+        self.assertEqual(res['availablecurrency'], available - 30)
+        self.assertEqual(self.raffle.getUserAvailableCurrency(2), available - 30)
+        self.assertTrue(self.raffle.reconcile()['balanced'])
+
+    def testLineErrorsDontStopTheBatch(self):
+        available = self.raffle.getUserAvailableCurrency(2)
+        res = self.raffle.makePurchases(2, [('raffle', self.rafflelot, str(available)), ('raffle', self.rafflelot, '2')])
+
+        self.assertTrue(isinstance(res['purchases'][0]['error'], UserCannotAffordItem))
+        self.assertEqual(res['purchases'][1]['result']['tickets'], [1, 2])
+        self.assertEqual(self.raffle.getUserAvailableCurrency(2), available - 20)
+
+
+    def testCurrencyChangesAreValidated(self):
+        currency = self.raffle.getUserAvailableCurrency(2)
+
+        self.assertRaises(ValueError, self.raffle.setUserAvailableCurrency, 2, delta=0)
+        self.assertRaises(ValueError, self.raffle.setUserAvailableCurrency, 2)
+        self.assertRaises(ValueError, self.raffle.setUserAvailableCurrency, 2, newcurrency="lots")
+        self.assertRaises(ValueError, self.raffle.setUserAvailableCurrency, 2, delta=5, entrytype='refund')
+
+        self.raffle.setUserAvailableCurrency(2, delta="-5")
+        self.raffle.setUserAvailableCurrency(3, newcurrency=0)
+
+        self.assertEqual(self.raffle.getUserAvailableCurrency(2), currency - 5)
+        self.assertEqual(self.raffle.getUserAvailableCurrency(3), 0)
+        self.assertTrue(self.raffle.reconcile()['balanced'])
+
+    def testTicketNumbersComeFromTheirOwnInserts(self):
+        # Reading back "the newest tickets of this user" is only safe while the user row is locked, so without
+        # DBLOCKING the numbers must come from the inserts themselves:
+        for locking in (True, False):
+            module.dbsettings['DBLOCKING'] = locking
+
+            try:
+                with support.statements() as statements:
+                    first = self.raffle.makePurchase('raffle', 2, self.rafflelot, quantity='3')['tickets']
+                    other = self.raffle.makePurchase('raffle', 3, self.rafflelot, quantity='2')['tickets']
+                    second = self.raffle.makePurchase('raffle', 2, self.rafflelot, quantity='2')['tickets']
+            finally:
+                module.dbsettings['DBLOCKING'] = True
+
+            self.assertEqual(len(set(first + other + second)), 7)
+            self.assertEqual(sorted(first + second), self.__ticketsHeld(2)[-5:])
+            self.assertEqual(any(statement.startswith("SELECT ticketpurchases.tid") for statement in statements), locking)
+
+    def testLotNumbersComeFromTheirOwnInserts(self):
+        items = [{'title':"Lot {0}".format(i), 'description':"Description", 'price':"5", 'quantity':"1", 'type':1} for i in xrange(3)]
+        items.insert(1, dict(items[0], price="free"))
+
+        for locking in (True, False):
+            module.dbsettings['DBLOCKING'] = locking
+
+            try:
+                with support.statements() as statements:
+                    added = self.raffle.addItemsToDatabase(3, items)['items']
+                    self.raffle.addItemToDatabase(2, "Other", "Description", "5", "1", 1)
+            finally:
+                module.dbsettings['DBLOCKING'] = True
+
+            lots = [line['lot'] for line in added]
+            self.assertEqual(lots[1], None)
+            self.assertEqual([item['title'] for item in self.raffle.fetchItems([lot for lot in lots if lot])], ["Lot 0", "Lot 1", "Lot 2"])
+            self.assertEqual(any(statement.startswith("SELECT auctionitems.iid") for statement in statements), locking)
+
+    def __ticketsHeld(self, uid):
+        session = module.Session()
+
+        try:
+            return [tid for tid, in session.query(module.TicketPurchases.tid).filter(module.TicketPurchases.ticketbuyer == uid).order_by(module.TicketPurchases.tid)]
+        finally:
+            session.close()
+
+
+class usercachetests(unittest.TestCase):
+    def setUp(self):
+        self.raffle = support.resetDatabase()
+        support.registerUsers(self.raffle, (1, 2))
+
+    def testIdsAreNormalised(self):
+        self.assertEqual(self.raffle.getUserAvailableCurrency(2), self.raffle.getUserAvailableCurrency("2"))
+        self.assertEqual(module.usercache.stats()['size'], 1)
+
+    def testInvalidationDuringReadIsntUndone(self):
+        # A purchase committed while the member's details are being read invalidates them. The details read
+        # may predate the purchase, so they mustn't be cached afterwards:
+        def invalidate(conn, cursor, statement, parameters, context, executemany):
+            if "FROM users" in statement:
+                module.usercache.invalidate(2)
+
+        event.listen(module.sqlengine, "before_cursor_execute", invalidate)
+
+        try:
+            self.raffle.getUserAvailableCurrency(2)
+        finally:
+            event.remove(module.sqlengine, "before_cursor_execute", invalidate)
+
+        self.assertEqual(module.usercache.get(2), None)
+
+        self.raffle.getUserAvailableCurrency(2)
+        self.assertNotEqual(module.usercache.get(2), None)
+
+
+class lotcachetests(unittest.TestCase):
+    def setUp(self):
+        self.raffle = support.resetDatabase()
+        support.registerUsers(self.raffle, (1, 2))
+        self.lot = self.raffle.addItemToDatabase(1, "Raffle lot", "Description", "10", "1", 1)
+
+    def changeLot(self, statement):
+        # Change a lot behind the module's back, as another process would, so the cache isn't told:
+        session = module.Session()
+
+        try:
+            session.execute(statement)
+            session.commit()
+        finally:
+            session.close()
+
+    def testCacheIsSharedBetweenInstances(self):
+        neoraffle(initilize=False).warmLotCache()
+        hits = self.raffle.getCacheStats()['lots']['hits']
+        self.raffle.makePurchase('raffle', 2, self.lot, quantity='1')
+
+        self.assertEqual(self.raffle.getCacheStats()['lots']['hits'], hits + 1)
+
+    def testRepricedLotIsntSoldAtItsCachedPrice(self):
+        self.raffle.warmLotCache()
+        self.changeLot(module.AuctionItems.__table__.update().where(module.AuctionItems.iid == self.lot).values(price=25))
+        res = self.raffle.makePurchases(2, [('raffle', self.lot, '2')])
+
+        self.assertEqual(res['purchases'][0]['result']['costinfo'], {'ticketprice':25, 'totalcost':50})
+        self.assertEqual(module.lotcache.get(self.lot).price, 25)
+
+    def testDeletedLotStopsSelling(self):
+        self.raffle.warmLotCache()
+        self.changeLot(module.AuctionItems.__table__.delete().where(module.AuctionItems.iid == self.lot))
+
+        self.assertRaises(DoesNotExist, self.raffle.makePurchase, 'raffle', 2, self.lot, quantity='1')
+        self.assertEqual(module.lotcache.get(self.lot), None)
+
+
+class querycounttests(unittest.TestCase):
+    # Listing and summary calls must make the same number of queries however many lots and users there are:
+    def populate(self, lots):
+        raffle = support.resetDatabase()
+        support.registerUsers(raffle, range(1, 11))
+
+        for lot in xrange(lots):
+            raffle.addItemToDatabase(1 + lot % 3, "Lot {0}".format(lot), "Description", "1" if lot % 2 else None, "2", 1 if lot % 2 else 2)
+
+        for lot in xrange(1, lots + 1):
+            if lot % 2:
+                raffle.makePurchase('auction', 4 + lot % 5, lot, bid=str(10 + lot))
+            else:
+                raffle.makePurchases(4 + lot % 5, [('raffle', lot, '3')])
+                raffle.makePurchases(5 + lot % 5, [('raffle', lot, '2')])
+
+        return raffle
+
+    def counts(self, raffle):
+        counts = {}
+        calls = (('pickWinners', lambda: raffle.pickWinners("seed")), ('fetchWinners', raffle.fetchWinners), ('fetchItems', raffle.fetchItems),
+                 ('fetchRegisteredUsers', raffle.fetchRegisteredUsers), ('getRegistrationStamp', raffle.getRegistrationStamp))
+
+        for name, call in calls:
+            with support.statements() as sql:
+                call()
+            counts[name] = len(sql)
+
+        return counts
+
+    def testQueryCountsDontGrowWithTheRaffle(self):
+        small, large = self.counts(self.populate(5)), self.counts(self.populate(50))
+
+        self.assertEqual(small, large)
+        self.assertEqual(large, {'pickWinners':7, 'fetchWinners':3, 'fetchItems':1, 'fetchRegisteredUsers':1, 'getRegistrationStamp':1})
+
+
+class registrationstamptests(unittest.TestCase):
+    def setUp(self):
+        self.raffle = support.resetDatabase()
+        support.registerUsers(self.raffle, (1, 2, 5))
+        self.stamp = self.raffle.getRegistrationStamp()
+
+    def changeUsers(self, change):
+        session = module.Session()
+
+        try:
+            change(session)
+            session.commit()
+        finally:
+            session.close()
+
+    def testRenameChangesTheStamp(self):
+        def rename(session):
+            session.query(module.Users).get(2).username = "renamed"
+
+        self.changeUsers(rename)
+
+        self.assertNotEqual(self.raffle.getRegistrationStamp(), self.stamp)
+        self.assertEqual(self.raffle.fetchRegisteredUsers(), ["user1", "renamed", "user5"])
+
+    def testReplacedUserChangesTheStamp(self):
+        # The same number of users with the same highest member ID:
+        self.changeUsers(lambda session: session.execute(module.Users.__table__.delete().where(module.Users.uid == 2)))
+        support.registerUsers(self.raffle, (3,))
+
+        self.assertNotEqual(self.raffle.getRegistrationStamp(), self.stamp)
+
+    def testCurrencyChangesLeaveTheStamp(self):
+        lot = self.raffle.addItemToDatabase(1, "Raffle lot", "Description", "10", "1", 1)
+        self.raffle.makePurchases(2, [('raffle', lot, '1')])
+
+        self.assertEqual(self.raffle.getRegistrationStamp(), self.stamp)
+
+
+class descriptiontests(unittest.TestCase):
+    # Item descriptions run to 25,000 characters, so only the calls which show them may fetch them:
+    def setUp(self):
+        self.raffle = support.resetDatabase()
+        support.registerUsers(self.raffle, (1, 2))
+        self.lots = [self.raffle.addItemToDatabase(1, "Lot {0}".format(i), "Description", "1", "1", 1) for i in xrange(3)]
+        self.raffle.makePurchases(2, [('raffle', self.lots[0], '1')])
+        module.usercache.clear()
+
+    def assertNoDescriptionFetched(self, call):
+        with support.statements() as sql:
+            call()
+
+        self.assertTrue(sql)
+        self.assertEqual([statement for statement in sql if 'description' in statement], [])
+
+    def testListingsDontFetchDescriptions(self):
+        self.assertNoDescriptionFetched(self.raffle.fetchItems)
+        self.assertNoDescriptionFetched(lambda: self.raffle.fetchItems(self.lots[:2]))
+        self.raffle.pickWinners("seed")
+        self.assertNoDescriptionFetched(self.raffle.fetchWinners)
+
+    def testCountsAndChecksDontFetchDescriptions(self):
+        self.assertNoDescriptionFetched(lambda: self.raffle.getNumOwnedItems(1))
+        self.assertNoDescriptionFetched(lambda: self.raffle.isUserRegistered(2))
+        self.assertNoDescriptionFetched(lambda: self.raffle.makePurchases(2, [('raffle', self.lots[1], '1')]))
+        self.assertNoDescriptionFetched(lambda: self.raffle.deleteItem(self.lots[2], 1))
+
+    def testDescriptionsAreFetchedWhenAskedFor(self):
+        with support.statements() as sql:
+            items = self.raffle.fetchItems(descriptions=True)
+
+        self.assertEqual(len(sql), 1)
+        self.assertIn('description', sql[0])
+        self.assertEqual(set(item['description'] for item in items), set(["Description"]))
+
+
+@unittest.skipUnless(support.isSqlite(), "SQLite locking only.")
+class readlocktests(unittest.TestCase):
+    # On SQLite only sessions which write take the DB write lock, so reads don't queue behind purchases:
+    def setUp(self):
+        self.raffle = support.resetDatabase()
+        support.registerUsers(self.raffle, (1, 2))
+        self.lot = self.raffle.addItemToDatabase(1, "Raffle lot", "Description", "10", "1", 1)
+        module.usercache.clear()
+
+    def testReadsDontWaitForTheWriteLock(self):
+        writer = module.Session()
+        writer.execute(module.Users.__table__.update().values(isactive=True)) # Holds the write lock until rolled back.
+
+        try:
+            start = time.time()
+            results = (self.raffle.isUserRegistered(2), len(self.raffle.fetchItems()), self.raffle.getRegistrationStamp()[0])
+            elapsed = time.time() - start
+        finally:
+            writer.rollback()
+            writer.close()
+
+        self.assertEqual(results, (True, 1, 2))
+        self.assertTrue(elapsed < 1, "Reads took {0:.1f} s.".format(elapsed))
+
+    def testOnlyWritesBeginImmediate(self):
+        begins = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith("BEGIN"):
+                begins.append(statement)
+
+        event.listen(module.sqlengine, "before_cursor_execute", record)
+
+        try:
+            self.raffle.makePurchases(2, [('raffle', self.lot, '1')])
+            purchase, begins[:] = list(begins), []
+            self.raffle.fetchItems()
+            self.raffle.isUserRegistered(2)
+        finally:
+            event.remove(module.sqlengine, "before_cursor_execute", record)
+
+        self.assertEqual(set(purchase), set(["BEGIN IMMEDIATE"]))
+        self.assertEqual(begins, ["BEGIN", "BEGIN"])
+
+
+class _records(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class concurrencytests(unittest.TestCase):
+    USERS = 8
+    ROUNDS = 30
+    PRICE = 3
+
+    def setUp(self):
+        # Run on whichever DB the tests are configured for (see tests/support.py), as long as it can be locked:
+        if not module.dbsettings['DBLOCKING'] or not module.settings['DBTYPE'].startswith(('sqlite', 'mysql')):
+            self.skipTest("Needs DBLOCKING on an SQLite or MariaDB/MySQL DB.")
+
+        self.raffle = support.resetDatabase()
+        support.registerUsers(self.raffle, range(1, self.USERS + 2), neopts=100, postcount=500)
+        self.auctionlot = self.raffle.addItemToDatabase(1, "Auction lot", "Description", None, "1", 2)
+        self.rafflelot = self.raffle.addItemToDatabase(1, "Raffle lot", "Description", str(self.PRICE), "1", 1)
+
+    def testCurrencyIsConservedUnderRacingPurchases(self):
+        # Purchases race on the same lot row and outbid each other, refunding the previous top bidder each time.
+        # On SQLite BEGIN IMMEDIATE serialises the transactions, and on MariaDB/MySQL SELECT ... FOR UPDATE locks the
+        # user and lot rows. A short busy or lock wait timeout makes them lose the lock often, so retryOnConflict
+        # has to re-run them:
+        def locktimeout(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute("PRAGMA busy_timeout = 5" if support.isSqlite() else "SET SESSION innodb_lock_wait_timeout = 1")
+            cursor.close()
+
+        records = _records()
+        logging.getLogger('classes.neoraffle').addHandler(records)
+        module.sqlengine.dispose() # So that every connection used is opened with the timeout.
+        event.listen(module.sqlengine, "connect", locktimeout)
+        errors = []
+
+        def purchaser(uid):
+            raffle = neoraffle(initilize=False)
+
+            for i in xrange(self.ROUNDS):
+                try:
+                    if i % 3 == 0:
+                        raffle.makePurchases(uid, [('raffle', self.rafflelot, '2'), ('auction', self.auctionlot, str(random.randint(1, 600)))])
+                    else:
+                        raffle.makePurchase('auction', uid, self.auctionlot, bid=str(random.randint(1, 600)))
+                except (BidDoesNotExceedCurrentTopBid, UserCannotAffordItem):
+                    pass
+                except Exception as e:
+                    errors.append(e)
+
+        total = self.__balances()[0]
+        threads = [threading.Thread(target=purchaser, args=(uid,)) for uid in xrange(2, self.USERS + 2)]
+
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            event.remove(module.sqlengine, "connect", locktimeout)
+            module.sqlengine.dispose()
+            logging.getLogger('classes.neoraffle').removeHandler(records)
+
+        currency, held, overdrawn = self.__balances()
+        session = module.Session()
+
+        try:
+            topbid = session.query(module.AuctionItems.topbidamount).filter(module.AuctionItems.iid == self.auctionlot).scalar() or 0
+            tickets = session.query(module.TicketPurchases).count()
+        finally:
+            session.close()
+
+        self.assertEqual(errors, [])
+
+        if support.isSqlite(): # Row locks mostly wait rather than conflict, so MariaDB/MySQL may have nothing to retry.
+            self.assertTrue([message for message in records.messages if message.startswith("Lock conflict")], "No lock conflicts were retried.")
+
+        self.assertEqual(currency, total)
+        self.assertEqual(held, topbid + tickets * self.PRICE)
+        self.assertEqual(overdrawn, [])
+        self.assertTrue(self.raffle.reconcile()['balanced'])
+
+    def __balances(self):
+        session = module.Session()
+
+        try:
+            users = session.query(module.Users.uid, module.Users.currency, module.Users.heldcurrency).all()
+        finally:
+            session.close()
+
+        return sum(user.currency for user in users), sum(user.heldcurrency for user in users), \
+               [user.uid for user in users if user.heldcurrency > user.currency]
+
+
+@unittest.skipUnless(support.isSqlite(), "Uses the SQLite test DB as a replica.")
+class replicatests(unittest.TestCase):
+    def setUp(self):
+        self.replica = module.createSqlEngine(module.settings['CONNECTIONSTRING'], primary=False)
+        self.engine, self.state = module.replicaengine, dict(module._replicastate)
+        module.replicaengine = self.replica
+        module._replicastate.update(lagchecked=0, lag=None, unsupported=False)
+
+    def tearDown(self):
+        module.replicaengine = self.engine
+        module._replicastate.update(self.state)
+        self.replica.dispose()
+
+    def testReplicaDoesntTakeTheWriteLock(self):
+        self.assertTrue(event.contains(module.sqlengine, "connect", module._disableSqliteAutobegin))
+        self.assertFalse(event.contains(self.replica, "connect", module._disableSqliteAutobegin))
+
+    def testUncheckableLagIsLoggedOnce(self):
+        records = _records()
+        logging.getLogger('classes.neoraffle').addHandler(records)
+        module.dbsettings['REPLICALAGCHECK'], lagcheck = 0, module.dbsettings['REPLICALAGCHECK']
+
+        try:
+            lags = [module.replicaLag() for _ in xrange(3)]
+        finally:
+            module.dbsettings['REPLICALAGCHECK'] = lagcheck
+            logging.getLogger('classes.neoraffle').removeHandler(records)
+
+        self.assertEqual(lags, [None] * 3)
+        self.assertEqual(records.messages, ["The lag of a sqlite read replica can't be checked, reading from the primary."])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+'''
+Tests for the NeoRaffle LRU cache.
+'''
+import time, unittest
+
+from tests import support # Makes the classes package importable.
+from classes.neorafflecache import lrucache
+
+
+class lrucachetests(unittest.TestCase):
+    def testEvictsLeastRecentlyUsed(self):
+        cache = lrucache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def testEntriesExpire(self):
+        cache = lrucache(10, 0.05)
+        cache.set('a', 1)
+        time.sleep(0.1)
+
+        self.assertEqual(cache.get('a'), None)
+
+    def testStaleSetAfterInvalidateIsSkipped(self):
+        # A reader takes the generation, a writer invalidates while the reader is querying, then the reader's
+        # (possibly stale) value must not be cached:
+        cache = lrucache(10)
+        generation = cache.generation()
+        cache.invalidate('a')
+        cache.set('a', 'stale', generation)
+
+        self.assertEqual(cache.get('a'), None)
+
+        cache.set('a', 'fresh', cache.generation())
+        self.assertEqual(cache.get('a'), 'fresh')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+'''
+Tests for the NeoRaffle winner drawing engine.
+'''
+import threading, unittest
+
+from tests import support # Makes the classes package importable.
+from classes import neoraffledraw
+from classes.neoraffledraw import groupTickets, drawLots, drawWinners, lotRandom
+
+
+class drawtests(unittest.TestCase):
+    def setUp(self):
+        self.tasks = [(lot, groupTickets([(buyer, lot * 1000 + buyer * 10, buyer + 1) for buyer in xrange(20)]), 3, "seed") for lot in xrange(1, 6)]
+
+    def testDrawLotsMatchesDrawWinners(self):
+        draws = drawLots(self.tasks)
+
+        for lot, holdings, quantity, seed in self.tasks:
+            self.assertEqual(draws[lot], drawWinners(holdings, quantity, lotRandom(seed, lot)))
+
+    def testNoProcessPoolWhileOtherThreadsRun(self):
+        # Forking from a threaded program (the bot) is unsafe, so drawLots must stay in process there:
+        def nopool(*args, **kwargs):
+            raise AssertionError("A process pool was created while other threads were running.")
+
+        expected, results = drawLots(self.tasks), []
+        waiting = threading.Event()
+        other = threading.Thread(target=waiting.wait)
+        other.start()
+        pool, neoraffledraw.multiprocessing.Pool = neoraffledraw.multiprocessing.Pool, nopool
+
+        try:
+            results.append(drawLots(self.tasks, processes=4))
+        finally:
+            neoraffledraw.multiprocessing.Pool = pool
+            waiting.set()
+            other.join()
+
+        self.assertEqual(results, [expected])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+'''
+Tests for the NeoRaffle reply queue, posting through a stub sender.
+'''
+import errno, socket, threading, time, unittest, urllib2
+
+from tests import support # Makes the classes package importable.
+from classes.neorafflequeue import keyeddispatcher, replyqueue, undelivered
+
+
+class stubposter(object):
+    # Records the posts made, and fails the posts whose body is in failures with the error given there, once each:
+    def __init__(self, failures=None):
+        self.posts = []
+        self.attempts = []
+        self.failures = dict(failures or {})
+        self.lock = threading.Lock()
+
+    def __call__(self, thread, title, body):
+        with self.lock:
+            self.attempts.append((time.time(), thread, body))
+            error = self.failures.pop(body, None)
+
+            if error is not None:
+                raise error
+
+            self.posts.append((thread, title, body))
+
+
+class keyeddispatchertests(unittest.TestCase):
+    def testDrainWaitsForQueuedWork(self):
+        dispatcher = keyeddispatcher(workers=2)
+        done = []
+
+        for key in xrange(6):
+            dispatcher.put(key, lambda key: (time.sleep(0.02), done.append(key)), key)
+
+        dispatcher.drain()
+        self.assertEqual(sorted(done), range(6))
+        dispatcher.close()
+
+
+class replyqueuetests(unittest.TestCase):
+    def testRepliesAreCombinedPerThread(self):
+        poster = stubposter()
+        replies = replyqueue(poster, rate=6000, window=0.2, separator="|", combinedtitle="Replies")
+        replies.post(1, "A", "a1")
+        replies.post(2, "B", "b1")
+        replies.post(1, "A", "a2")
+        replies.post(1, "C", "a3")
+        replies.close()
+
+        self.assertEqual(sorted(poster.posts), [(1, "Replies", "a1|a2|a3"), (2, "B", "b1")])
+        self.assertEqual(replies.stats()['combined'], 2)
+
+    def testUncombinedPostsKeepTheirTitleAndOrder(self):
+        poster = stubposter()
+        replies = replyqueue(poster, rate=6000, window=0.2, separator="|", combinedtitle="Replies")
+        replies.post(1, "Reply", "r1")
+        replies.post(1, "Announcement", "big", combine=False)
+        replies.post(1, "Reply", "r2")
+        replies.close()
+
+        self.assertEqual(poster.posts, [(1, "Reply", "r1"), (1, "Announcement", "big"), (1, "Reply", "r2")])
+
+    def testRateIsLimited(self):
+        poster = stubposter()
+        replies = replyqueue(poster, rate=600, window=0)
+
+        for thread in xrange(4):
+            replies.post(thread, "T", "body")
+        replies.close()
+
+        times = [attempt[0] for attempt in poster.attempts]
+        self.assertEqual(len(times), 4)
+        self.assertTrue(all(later - earlier >= 0.09 for earlier, later in zip(times, times[1:])), times)
+
+    def testRetryIsMadeBeforeLaterPostsToItsThread(self):
+        poster = stubposter({"first": socket.error(errno.ECONNREFUSED, "Connection refused")})
+        replies = replyqueue(poster, rate=6000, window=0, backoff=0.2)
+        replies.post(1, "T", "first")
+        time.sleep(0.05)
+        replies.post(1, "T", "second")
+        replies.post(2, "T", "other")
+        replies.close()
+
+        self.assertEqual([post[2] for post in poster.posts if post[0] == 1], ["first", "second"])
+        self.assertEqual([attempt[2] for attempt in poster.attempts], ["first", "other", "first", "second"])
+        self.assertEqual(replies.stats()['retried'], 1)
+
+    def testPostWhichMayHaveBeenMadeIsntRetried(self):
+        poster = stubposter({"slow": socket.timeout("timed out")})
+        replies = replyqueue(poster, rate=6000, window=0, backoff=0)
+        replies.post(1, "T", "slow")
+        time.sleep(0.05)
+        replies.post(1, "T", "next")
+        replies.close()
+
+        self.assertEqual(poster.posts, [(1, "T", "next")])
+        self.assertEqual((replies.stats()['retried'], replies.stats()['failed']), (0, 1))
+
+    def testUndelivered(self):
+        self.assertTrue(undelivered(socket.gaierror(socket.EAI_NONAME, "Name or service not known")))
+        self.assertTrue(undelivered(urllib2.URLError(socket.error(errno.EHOSTUNREACH, "No route to host"))))
+        self.assertFalse(undelivered(socket.timeout("timed out")))
+        self.assertFalse(undelivered(socket.error(errno.ECONNRESET, "Connection reset by peer")))
+        self.assertFalse(undelivered(urllib2.HTTPError("http://neoseeker.com/", 502, "Bad Gateway", {}, None)))
+        self.assertFalse(undelivered(ValueError()))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,246 @@
+'''
+Tests for the NeoRaffle plugin (plugins/neoraffle.py).
+'''
+import random, threading, time, unittest
+
+from tests import support
+from sqlalchemy.exc import OperationalError
+
+plugin = support.loadPlugin()
+scanPost = plugin.scanPost
+
+
+class stubsalem(object):
+    def __init__(self, config=None):
+        self.config = dict(config or {})
+        self.messages = []
+
+    def getSalemConfig(self, key):
+        return self.config.get(key)
+
+    def setSalemConfig(self, key, value):
+        self.config[key] = value
+
+    def send_message(self, target, message):
+        self.messages.append((target, message))
+
+
+class stubneo(object):
+    # Records the Neoseeker API lookups made, answering them without the network:
+    def __init__(self):
+        self.lookups = []
+        self.posts = []
+        self.untranslatable = set()
+
+    def getMemberIdFromUsernameOrId(self, userid):
+        self.lookups.append(userid)
+        return "user{0}".format(userid)
+
+    def getForumNotifyStringForUsername(self, username):
+        self.lookups.append(username)
+        return "@{0}".format(username)
+
+    def translateMarkupToHtml(self, markup):
+        if markup in self.untranslatable:
+            raise IOError("Translation failed")
+
+        return "<p>{0}</p>".format(markup)
+
+    def postToForums(self, thread, title, body):
+        self.posts.append((thread, title, body))
+
+
+class scannertests(unittest.TestCase):
+    # Longest a single post may take to scan. Well above the few milliseconds normal posts take, but far below the
+    # seconds the old form regexes spent on the pathological posts below:
+    CEILING = 0.1
+
+    def assertFast(self, body, name):
+        start = time.time()
+        scanPost(body)
+        elapsed = time.time() - start
+
+        self.assertTrue(elapsed < self.CEILING, "Scanning {0} took {1:.0f} ms.".format(name, elapsed * 1000))
+
+    def testForm(self):
+        scan = scanPost("NEORAFFLE ITEM ADD\n[b]RAFFLE ITEM[/b]\nItem Title: Game\nItem Description: Boxed\nwith manual\nTicket Price: 10\nQuantity: 2\n")
+
+        self.assertEqual(scan['commands'], set(["ITEM ADD"]))
+        self.assertEqual(scan['forms'], [{'type':"RAFFLE", 'title':"Game", 'description':"Boxed\nwith manual", 'price':"10", 'quantity':"2", 'errors':[]}])
+
+    def testLabelsOnlyCountAtTheStartOfALine(self):
+        form = scanPost("[b]AUCTION ITEM[/b]\nItem Title: Rare Quantity: 1 edition\n  Item Description: Signed\nQuantity: 1\n")['forms'][0]
+
+        self.assertEqual((form['title'], form['description'], form['quantity'], form['errors']), ("Rare Quantity: 1 edition", "Signed", "1", []))
+
+    def testTextBetweenFormsIsScannedForCommands(self):
+        scan = scanPost("[b]AUCTION ITEM[/b]\nItem Title: A\nItem Description: B\nQuantity: 1\nNEORAFFLE DELETE 4\nBid 3 50 [b]AUCTION ITEM[/b]\nItem Title: C\n")
+
+        self.assertEqual(scan['deletions'], "4")
+        self.assertEqual(scan['purchases'], [("Bid", "3", "50")])
+        self.assertEqual([form['title'] for form in scan['forms']], ["A", "C"])
+        self.assertEqual(scan['forms'][1]['errors'], ["Item Description is missing.", "Quantity is missing."])
+
+    def testFieldErrors(self):
+        form = scanPost("[b]AUCTION ITEM[/b]\nItem Title: A\nItem Title: B\nItem Description:\nTicket Price: 4\nQuantity: 1\n")['forms'][0]
+
+        self.assertEqual(sorted(form['errors']), sorted(["Item Title was given more than once.", "Item Description is empty.", "Ticket Price isn't used by auction items."]))
+
+    def testShortCommandIsntAlsoAPurchaseLine(self):
+        scan = scanPost("NEORAFFLE BID 2 90\nBuy: #5 1,000\n")
+
+        self.assertEqual(scan['purchases'], [("BID", "2", "90"), ("Buy", "5", "1,000")])
+
+    def testPathologicalPosts(self):
+        posts = {
+            "headers without a Quantity": "[b]RAFFLE ITEM[/b]\n" * 2000,
+            "repeated titles": "[b]RAFFLE ITEM[/b]\n" + "Item Title: x\n" * 3000 + "Quantity: 1\n",
+            "label fragments": "[b]RAFFLE ITEM[/b]\nItem Title: t\nItem Description: " + "Ticket Pric " * 2000 + "\nQuantity: 1\n",
+            "long description": "[b]RAFFLE ITEM[/b]\nItem Title: t\nItem Description: " + "a\n" * 5000 + "Ticket Price: 5\nQuantity: 2\n",
+            "long purchase line": "Buy 1" + " 1" * 20000,
+            "digits": "NEORAFFLE BUY " + "1" * 20000,
+        }
+
+        for name, body in posts.iteritems():
+            self.assertFast(body, name)
+
+    def testFuzz(self):
+        rng = random.Random(1)
+        tokens = ["[b]RAFFLE ITEM[/b]", "[b]AUCTION ITEM[/b]", "Item Title:", "Item Description:", "Ticket Price:", "Quantity:", "\n", " ", "x", "1",
+                  ",", "#", ":", "Bid 1 2", "Buy", "NEORAFFLE ", "BUY 1 2", "DELETE 1, 2", "REGISTER", "ITEM ADD"]
+
+        for i in xrange(300):
+            body = "".join(rng.choice(tokens) for _ in xrange(rng.randint(1, 3000)))
+            scan = scanPost(body)
+
+            self.assertEqual(sorted(scan.keys()), ['commands', 'deletions', 'forms', 'purchases'])
+            self.assertFast(body, "fuzz post {0}".format(i))
+
+
+class resolvercachetests(unittest.TestCase):
+    def setUp(self):
+        support.resetDatabase()
+        self.neo = stubneo()
+        self.plugin = plugin.raffleplugin(stubsalem(), self.neo)
+
+    def tearDown(self):
+        self.plugin.die()
+
+    def testIntAndStrMemberIdsShareAnEntry(self):
+        username = self.plugin._raffleplugin__username
+
+        self.assertEqual([username(5), username("5"), username(u"5")], ["user5"] * 3)
+        self.assertEqual(self.neo.lookups, [5])
+        self.assertEqual(len(self.plugin.usernames), 1)
+
+    def testWarmedUsernamesAreFoundByStrIds(self):
+        support.registerUsers(self.plugin.raffle, (7, 8))
+        self.plugin._raffleplugin__warmUsernames()
+
+        self.assertEqual(self.plugin._raffleplugin__username("8"), "user8")
+        self.assertEqual(self.neo.lookups, [])
+
+
+class announcementtests(unittest.TestCase):
+    def setUp(self):
+        support.resetDatabase()
+        self.neo = stubneo()
+        self.plugin = plugin.raffleplugin(stubsalem(), self.neo)
+        self.plugin.replies.rate = 6000
+
+    def testAnnouncementsArentCombinedWithReplies(self):
+        announcement = plugin.postwriter(plugin.raffleplugin.MAXPOSTLENGTH)
+        announcement.write("Bidding is open!")
+
+        self.plugin.replies.post("100", "NeoRaffle Purchase", "before")
+        self.plugin._raffleplugin__postAnnouncement("100", "Bidding", announcement)
+        self.plugin.replies.post("100", "NeoRaffle Purchase", "after")
+        self.plugin.die()
+
+        self.assertEqual(self.neo.posts, [("100", "NeoRaffle Purchase", "before"), ("100", "NeoRaffle Phase Change: Bidding", "Bidding is open!"),
+                                          ("100", "NeoRaffle Purchase", "after")])
+
+
+class itemedittests(unittest.TestCase):
+    def setUp(self):
+        raffle = support.resetDatabase()
+        support.registerUsers(raffle, (1,))
+        self.lot = raffle.addItemToDatabase(1, "Old", "Old", "10", "1", 1, htmltitle="<p>Old</p>", htmldescription="<p>Old</p>")
+        self.neo = stubneo()
+        self.plugin = plugin.raffleplugin(stubsalem(), self.neo)
+
+    def tearDown(self):
+        self.plugin.die()
+
+    def edit(self, params):
+        self.plugin._raffleplugin__editItem("#raffle", ["@neoraffle", "edit", str(self.lot), params])
+        item = self.plugin.raffle.fetchItems([self.lot], descriptions=True)[0]
+
+        return item['title'], item['htmltitle'], item['description'], item['htmldescription']
+
+    def testUntranslatedFieldLosesItsOldHtml(self):
+        self.neo.untranslatable.add("New description")
+
+        self.assertEqual(self.edit("title=New title|description=New description"), ("New title", "<p>New title</p>", "New description", None))
+
+    def testTranslationsAreMadeWithoutTheDb(self):
+        def unavailable(*args):
+            raise OperationalError("SELECT", {}, Exception("database is locked"))
+
+        self.plugin.raffle.fetchTranslations = self.plugin.raffle.saveTranslations = unavailable
+
+        self.assertEqual(self.edit("title=New title"), ("New title", "<p>New title</p>", "Old", "<p>Old</p>"))
+
+
+class phasetests(unittest.TestCase):
+    # Bids are processed in the phase they were posted in, however long they wait in the notification queue:
+    def setUp(self):
+        raffle = support.resetDatabase()
+        support.registerUsers(raffle, (1, 2))
+        self.lot = raffle.addItemToDatabase(1, "Raffle lot", "Description", "10", "1", 1)
+        self.salem = stubsalem({'NEORAFFLE_THREAD':"100", 'NEORAFFLE_PHASE':"bidding"})
+        self.plugin = plugin.raffleplugin(self.salem, stubneo())
+        self.plugin.replies.rate = 6000
+        self.currency = self.plugin.raffle.getUserAvailableCurrency(2)
+
+    def tearDown(self):
+        self.plugin.die()
+
+    def bid(self, gate):
+        # Queue a bid behind work which waits for gate, so it's still queued when the phase changes:
+        self.plugin.notifyqueue.put(2, gate.wait)
+        self.plugin.notificationHandler({'thread':{'threadid':"100"}, 'body':u"NEORAFFLE BUY {0} 2".format(self.lot), 'messageid':1},
+                                        {'memberid':2, 'username':"user2"})
+
+    def testQueuedBidKeepsItsPhase(self):
+        gate = threading.Event()
+        self.bid(gate)
+        self.salem.setSalemConfig("NEORAFFLE_PHASE", "off")
+        gate.set()
+        self.plugin.notifyqueue.drain()
+
+        self.assertEqual(self.plugin.raffle.getUserAvailableCurrency(2), self.currency - 20)
+
+    def testWinnersPhaseWaitsForQueuedBids(self):
+        gate = threading.Event()
+        self.bid(gate)
+        threading.Timer(0.1, gate.set).start()
+        self.plugin.processIrcCommand("#raffle", "admin", ["@neoraffle", "phase", "winners"])
+
+        self.assertEqual(self.plugin.raffle.getUserAvailableCurrency(2), self.currency - 20)
+        self.assertEqual(self.plugin.notifyqueue.depth(), 0)
+        self.assertEqual(self.plugin.raffle.fetchWinners()[0]['winners'], ["user2"])
+
+    def testUnloadWaitsForTheDraw(self):
+        pickWinners = self.plugin.raffle.pickWinners
+        self.plugin.raffle.pickWinners = lambda *args: (time.sleep(0.2), pickWinners(*args))[1] # A draw which takes a while.
+        self.plugin.notificationHandler({'thread':{'threadid':"100"}, 'body':u"NEORAFFLE BUY {0} 2".format(self.lot), 'messageid':1},
+                                        {'memberid':2, 'username':"user2"})
+        self.plugin.ircHandler("#raffle", "admin", ["@neoraffle", "phase", "winners"])
+        self.plugin.die()
+
+        self.assertIn("NeoRaffle Phase Change: Winners Announced!", [title for thread, title, body in self.plugin.neo.posts])
+
+
+if __name__ == "__main__":
+    unittest.main()